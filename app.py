@@ -6,13 +6,21 @@ LastEditTime: 2026-02-02 15:19:19
 FilePath: /量化/app.py
 Description: 这是默认设置,请设置`customMade`, 打开koroFileHeader查看配置 进行设置: https://github.com/OBKoro1/koro1FileHeader/wiki/%E9%85%8D%E7%BD%AE
 '''
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 from flask_cors import CORS
 from datetime import datetime, timedelta
+from threading import Lock, Thread
 import json
 import os
+import time
 from strategy_engine import StrategyEngine
 from data_fetcher import DataFetcher
+from market_snapshot import process_memory
+from standing import StandingStrategies
+from significance import SignificanceTester, load_matches
+from similarity import DEFAULT_WINDOW, SimilarityIndex
+from preview import DEFAULT_FRACTION
+from http_cache import ResponseCache, choose_encoding, compress, MIN_COMPRESS_SIZE
 
 app = Flask(__name__)
 CORS(app)
@@ -27,8 +35,88 @@ except ImportError:
 # 初始化数据获取器和策略引擎
 # 使用 AKShare（免费、数据准确）
 data_fetcher = DataFetcher()
-# 使用30个并发线程加速回测（提高速度）
+# 所有回测请求共享 30 个工作线程，并发回测之间公平轮转
 strategy_engine = StrategyEngine(data_fetcher, max_workers=30)
+standing = StandingStrategies(data_fetcher, strategy_engine)
+
+# 序列化后的响应体缓存，绑定数据版本，下次入库后失效
+response_cache = ResponseCache()
+
+# 形态索引（按快照版本、窗口长度），每日任务保存快照后已建好，这里只做内存映射
+similarity_indexes = {}
+similarity_lock = Lock()
+
+# 预热状态：后台映射快照 + 登录 Baostock，/api/health 报告是否就绪
+warm_state = {'ready': False, 'snapshot_version': None, 'snapshot_last_date': None,
+              'snapshot_memory': None, 'stocks': 0, 'warm_seconds': None, 'error': None}
+
+
+def warm_start():
+    """后台预热：映射最新快照（并预读数据页）、恢复股票列表、登录 Baostock"""
+    start = time.time()
+    try:
+        snapshot = data_fetcher.load_snapshot(prefault=True)
+        if snapshot is not None:
+            warm_state['snapshot_version'] = snapshot.version
+            warm_state['snapshot_last_date'] = snapshot.last_date
+            report = snapshot.memory_report()
+            warm_state['snapshot_memory'] = {k: report[k] for k in ('rows', 'bytes', 'bytes_per_row', 'ratio')}
+        warm_state['stocks'] = len(data_fetcher.get_stock_list())
+        data_fetcher.login()
+    except Exception as e:
+        warm_state['error'] = str(e)
+    warm_state['warm_seconds'] = round(time.time() - start, 3)
+    warm_state['ready'] = True
+
+
+Thread(target=warm_start, daemon=True).start()
+
+
+def cached_json(key, build):
+    """返回缓存的 JSON 响应：同一数据版本内只构建、序列化、压缩一次，附带 ETag/Last-Modified，条件请求命中返回 304
+
+    只用于无副作用的 GET 接口（命中时 build 不执行）
+
+    Args:
+        key: 缓存键（接口及其参数）
+        build: 无参函数，返回要序列化的对象
+    """
+    version, last_modified = data_fetcher.get_data_version()
+    entry = response_cache.get(key, version)
+    if entry is None:
+        body = json.dumps(build(), ensure_ascii=False, default=str).encode('utf-8')
+        # 构建过程本身可能补拉缺失的交易日写入缓存而改变数据版本，按构建后的版本保存，下次相同请求才能命中
+        version, last_modified = data_fetcher.get_data_version()
+        entry = response_cache.put(key, version, body, last_modified)
+    if entry.not_modified(request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since')):
+        response = Response(status=304)
+    else:
+        body, encoding = entry.encoded(choose_encoding(request.headers.get('Accept-Encoding')))
+        response = Response(body, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = entry.etag
+    response.headers['Last-Modified'] = entry.last_modified_http
+    response.headers['Cache-Control'] = 'no-cache'  # 可缓存，但每次使用前向服务器复查
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """压缩未经缓存的大 JSON 响应（如回测结果）"""
+    if (response.status_code != 200 or response.direct_passthrough or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    body = response.get_data()
+    if encoding is None or len(body) < MIN_COMPRESS_SIZE:
+        return response
+    response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 
 @app.route('/')
 def index():
@@ -42,10 +130,29 @@ def backtest():
         data = request.json
         strategy = data.get('strategy', {})
         strategy_name = data.get('strategy_name', None)  # 可选：策略名称
-        
-        # 执行回测
+
+        if data.get('explain'):
+            # 剖析模式：每次实际执行，返回各条件的作用/通过候选数与耗时，不走缓存
+            results, profile = strategy_engine.backtest(strategy, strategy_name=strategy_name, explain=True)
+            return jsonify({
+                'success': True,
+                'data': results,
+                'count': len(results),
+                'profile': profile.to_dict()
+            })
+
+        if data.get('preview'):
+            # 预览模式：分层抽样估计匹配数；随后不带 preview 提交同一策略即继续完整回测（复用样本的判断结果）
+            fraction = data['preview'] if not isinstance(data['preview'], bool) else DEFAULT_FRACTION
+            fraction = float(fraction)
+            if not 0 < fraction <= 1:
+                return jsonify({'success': False, 'error': 'preview 应为 (0, 1] 内的抽样比例'}), 400
+            report = strategy_engine.preview(strategy, fraction=fraction, seed=data.get('seed'))
+            return jsonify({'success': True, 'preview': report})
+
+        # 执行回测（每次实际执行：回测会写出结果文件，响应不缓存）
         results = strategy_engine.backtest(strategy, strategy_name=strategy_name)
-        
+
         return jsonify({
             'success': True,
             'data': results,
@@ -61,10 +168,9 @@ def backtest():
 def get_stocks():
     """获取股票列表"""
     try:
-        stocks = data_fetcher.get_stock_list()
-        return jsonify({
+        return cached_json(('stocks',), lambda: {
             'success': True,
-            'data': stocks
+            'data': data_fetcher.get_stock_list()
         })
     except Exception as e:
         return jsonify({
@@ -72,5 +178,161 @@ def get_stocks():
             'error': str(e)
         }), 500
 
+@app.route('/api/health', methods=['GET'])
+def health():
+    """健康检查：预热完成前返回 503；memory 为本进程内存（shared 含与其他进程共享的快照页）"""
+    state = dict(warm_state)
+    snapshot = data_fetcher.refresh_snapshot() if warm_state['ready'] else None
+    if snapshot is not None:
+        state['snapshot_version'] = snapshot.version
+        state['snapshot_last_date'] = snapshot.last_date
+    return jsonify({'success': True, **state, 'pid': os.getpid(), 'memory': process_memory(),
+                    'scheduler': strategy_engine.scheduler.stats(), 'universe': data_fetcher.universe.info(),
+                    'cache_versions': data_fetcher.cache_versions.versions(),
+                    'writer': data_fetcher.writer.stats()}), \
+        (200 if warm_state['ready'] else 503)
+
+@app.route('/api/market_breadth', methods=['GET'])
+def get_market_breadth():
+    """获取市场宽度（每日涨停家数、炸板率、涨跌家数、成交额等），可选 start/end（YYYY-MM-DD）"""
+    try:
+        start, end = request.args.get('start'), request.args.get('end')
+
+        def build():
+            data = data_fetcher.market_breadth.query(start, end)
+            return {
+                'success': True,
+                'data': data,
+                'count': len(data)
+            }
+
+        return cached_json(('market_breadth', start, end), build)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/standing', methods=['GET'])
+def list_standing():
+    """常驻策略列表（含最新判断日、当前结果数和最近一次的变化）"""
+    try:
+        return jsonify({'success': True, 'data': standing.list()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/standing', methods=['POST'])
+def save_standing():
+    """保存常驻策略：{name, strategy}，每日任务入库后增量判断"""
+    try:
+        data = request.json
+        entry = standing.add(data['name'], data.get('strategy', {}))
+        return jsonify({'success': True, 'name': entry['name']})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/standing/<name>', methods=['DELETE'])
+def delete_standing(name):
+    """删除常驻策略"""
+    try:
+        return jsonify({'success': standing.remove(name)})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/significance', methods=['POST'])
+def significance():
+    """策略结果的显著性检验：{results: [{code, match_date}] 或 strategy_name, horizons, resamples, seed}"""
+    try:
+        data = request.json or {}
+        matches = data.get('results')
+        if matches is None:
+            matches = load_matches(strategy_engine.get_results_path(data['strategy_name']))
+        snapshot = data_fetcher.refresh_snapshot() if data_fetcher.snapshot is not None else data_fetcher.load_snapshot()
+        if snapshot is None:
+            return jsonify({'success': False, 'error': '没有快照，请先运行每日任务生成快照'}), 503
+        tester = SignificanceTester(snapshot, data_fetcher.get_stock_list())
+        report = tester.test(matches, horizons=data.get('horizons') or [1, 3, 5, 10, 20],
+                             resamples=min(int(data.get('resamples', 10000)), 100000),
+                             start_date=data.get('start'), end_date=data.get('end'), seed=data.get('seed'))
+        return jsonify({'success': True, 'data': report})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def get_similarity_index(window):
+    snapshot = data_fetcher.refresh_snapshot() if data_fetcher.snapshot is not None else data_fetcher.load_snapshot()
+    if snapshot is None:
+        return None
+    key = (snapshot.version, window)
+    with similarity_lock:
+        if key not in similarity_indexes:
+            similarity_indexes.clear()  # 旧快照的索引不再使用
+            root = os.path.join(data_fetcher.cache_dir, 'similarity')
+            similarity_indexes[key] = SimilarityIndex.load_or_build(root, snapshot, window)
+        return similarity_indexes[key]
+
+@app.route('/api/similar', methods=['GET'])
+def similar():
+    """形态相似搜索：与 code 以 date（YYYY-MM-DD）为终点的 window 日形态最相似的 k 个窗口（全市场全部历史）
+
+    默认用 LSH 索引近似查找（毫秒级），exact=1 时精确计算全部窗口
+    """
+    try:
+        code, date = request.args['code'], request.args['date']
+        k = min(int(request.args.get('k', 20)), 200)
+        window = int(request.args.get('window', DEFAULT_WINDOW))
+        distinct = request.args.get('distinct', '1') != '0'
+        exact = request.args.get('exact', '0') == '1'
+
+        def build():
+            index = get_similarity_index(window)
+            if index is None:
+                raise ValueError('没有快照，请先运行每日任务生成快照')
+            data = index.search_like(code, date, k=k, distinct=distinct, exact=exact)
+            return {'success': True, 'data': data, 'count': len(data)}
+
+        return cached_json(('similar', code, date, k, window, distinct, exact), build)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/stock/<code>/bars', methods=['GET', 'POST'])
+def stock_bars(code):
+    """单只股票的K线（按列），用于查看回测结果
+
+    参数（GET 查询参数或 POST JSON）: start/end（YYYY-MM-DD，默认近 90 天）、adjust（qfq/hfq，默认不复权）；
+    可选 date（匹配日 T）+ conditions（条件列表，GET 时为 JSON 字符串）或 standing（常驻策略名），
+    返回 T 时每个条件的取值与是否成立。快照覆盖时直接由内存映射切片，服务端耗时在 1 毫秒内
+    """
+    try:
+        params = request.args.to_dict() if request.method == 'GET' else (request.json or {})
+        start, end, adjust, date = params.get('start'), params.get('end'), params.get('adjust') or None, params.get('date')
+        conditions = params.get('conditions')
+        if isinstance(conditions, str):
+            conditions = json.loads(conditions)
+        if conditions is None and params.get('standing'):
+            strategy = standing.get(params['standing'])
+            if strategy is None:
+                return jsonify({'success': False, 'error': f"常驻策略不存在: {params['standing']}"}), 404
+            conditions = strategy.get('conditions', [])
+
+        def build():
+            bars = data_fetcher.get_bars(code, start, end, adjust=adjust)
+            if bars is None:
+                raise ValueError(f'{code} 在该范围内没有数据')
+            data = {'code': code, 'adjust': adjust, 'count': len(bars['date']), 'bars': bars}
+            if date and conditions:
+                data['match'] = strategy_engine.inspect_match(code, conditions, date)
+            return {'success': True, 'data': data}
+
+        if request.method != 'GET':
+            return jsonify(build())
+        # 默认窗口随当天日期变化，先换算成实际日期再作为缓存键，跨天后不会命中前一天的窗口
+        today = datetime.now()
+        start = start or (today - timedelta(days=90)).strftime('%Y-%m-%d')
+        end = end or today.strftime('%Y-%m-%d')
+        key = ('bars', code, start, end, adjust, date, json.dumps(conditions, sort_keys=True) if date else None)
+        return cached_json(key, build)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=8086)
@@ -0,0 +1,268 @@
+"""
+日线缓存版本（快照隔离）
+
+cache/stock_data/ 下每个版本一个目录（v时间戳），CURRENT 记录当前版本，原子替换。
+
+    入库（每日任务、补今日数据、批量导入）: begin() 建立下一个版本目录，先用硬链接复制当前版本中每只股票
+        最新的一份缓存文件（不复制数据），之后的写入都落在新目录：tmp + os.replace 生成新文件，
+        替换/删除只影响新目录里的链接，旧版本的文件保持不变；完成后 publish() 原子替换 CURRENT。
+    读取（回测）: acquire() 登记租约并固定版本，整个回测读同一个版本，不会读到写了一半的入库，
+        也不会因为文件被改名/删除而静默漏掉股票；release() 后若旧版本已无租约即被回收。
+    回收: gc() 删除既不是当前版本、也没有存活租约的版本目录（租约记录进程号，进程退出后自动失效）。
+
+入库之外的单只写入（Web 服务按需补拉缺失数据）写入读取方固定的版本（通常就是当前版本；已被取代的旧版本中
+补拉的数据随该版本回收），被替换的旧文件不删除（可能有读取方刚列出它），按 start 最早、end 最晚取最新的一份；下一次 begin() 只链接最新的一份，旧文件随旧版本回收。
+发布时，构建期间其他进程直接写入当前版本、而本次入库没有写过的股票会补链接进新版本，不会丢失。
+
+版本切换、租约登记和回收在 .lock 文件锁（fcntl）下进行，多个进程（Web 服务、每日任务）共用一个缓存目录。
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+import glob
+import itertools
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # 非 POSIX 平台只在进程内互斥
+
+
+def parse_cache_name(name):
+    """'{code}_{start}_{end}.json' -> (code, start, end)，不是日线缓存文件名返回 None"""
+    if not name.endswith('.json'):
+        return None
+    parts = name[:-5].split('_')
+    if len(parts) != 3:
+        return None
+    code, start_str, end_str = parts
+    if len(code) != 6 or len(start_str) != 8 or len(end_str) != 8:
+        return None
+    return code, start_str, end_str
+
+
+def latest_files(directory):
+    """目录中每只股票最新的一份缓存 {code: (start, end, path)}（start 最早、覆盖范围最大；start 相同取 end 最晚）"""
+    best = {}
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return best
+    for name in names:
+        parsed = parse_cache_name(name)
+        if parsed is None:
+            continue
+        code, start_str, end_str = parsed
+        item = (start_str, end_str, os.path.join(directory, name))
+        current = best.get(code)
+        if current is None or (start_str, -int(end_str)) < (current[0], -int(current[1])):
+            best[code] = item
+    return best
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _link(src, dst):
+    """硬链接（同一文件系统，不复制数据）；不支持硬链接时复制"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class CacheVersions:
+    """日线缓存的版本目录、CURRENT 指针、读取租约与回收"""
+
+    def __init__(self, root):
+        self.root = root
+        self.pointer = os.path.join(root, 'CURRENT')
+        self.lease_dir = os.path.join(root, '.leases')
+        os.makedirs(self.lease_dir, exist_ok=True)
+        self._lock = Lock()
+        self._lease_seq = itertools.count()
+
+    @contextmanager
+    def _exclusive(self):
+        """进程内 + 进程间互斥"""
+        with self._lock:
+            fd = os.open(os.path.join(self.root, '.lock'), os.O_CREAT | os.O_RDWR)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)  # 关闭即释放 flock
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def _read_pointer(self):
+        try:
+            with open(self.pointer, 'r', encoding='utf-8') as f:
+                name = f.read().strip()
+            return name or None
+        except OSError:
+            return None
+
+    def _write_pointer(self, name):
+        tmp_path = f'{self.pointer}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(name)
+        os.replace(tmp_path, self.pointer)
+
+    def _new_name(self):
+        return f"v{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+
+    def current(self):
+        """当前版本目录名；首次使用时把旧的平铺缓存文件（stock_data/*.json）迁入第一个版本"""
+        name = self._read_pointer()
+        if name is not None:
+            return name
+        with self._exclusive():
+            name = self._read_pointer()
+            if name is None:
+                name = self._new_name()
+                os.makedirs(self.path(name), exist_ok=True)
+                moved = 0
+                for fp in glob.glob(os.path.join(self.root, '*.json')):
+                    os.replace(fp, os.path.join(self.path(name), os.path.basename(fp)))
+                    moved += 1
+                self._write_pointer(name)
+                if moved:
+                    print(f'[INFO] 日线缓存已迁入版本目录 {name}（{moved} 个文件）')
+        return name
+
+    def current_path(self):
+        return self.path(self.current())
+
+    # ---------- 读取租约 ----------
+
+    def _lease(self, name):
+        lease = os.path.join(self.lease_dir, f'{name}@{os.getpid()}.{next(self._lease_seq)}')
+        open(lease, 'w').close()
+        return lease
+
+    def acquire(self):
+        """固定当前版本并登记租约，返回 (name, lease)；与回收互斥，拿到的版本在 release 前不会被删除"""
+        self.current()
+        with self._exclusive():
+            name = self._read_pointer()
+            return name, self._lease(name)
+
+    def release(self, lease):
+        try:
+            os.remove(lease)
+        except OSError:
+            pass
+        if not os.path.basename(lease).startswith(f'{self._read_pointer()}@'):
+            self.gc()  # 旧版本的最后一个读取方退出后回收
+
+    @contextmanager
+    def reading(self):
+        """with versions.reading() as name: 期间 name 版本不会被回收"""
+        name, lease = self.acquire()
+        try:
+            yield name
+        finally:
+            self.release(lease)
+
+    def _live_leases(self):
+        """存活租约对应的版本集合；进程已退出的租约顺带删除"""
+        live = set()
+        for entry in os.listdir(self.lease_dir):
+            name, _, owner = entry.partition('@')
+            try:
+                pid = int(owner.split('.')[0])
+            except ValueError:
+                continue
+            if _pid_alive(pid):
+                live.add(name)
+            else:
+                try:
+                    os.remove(os.path.join(self.lease_dir, entry))
+                except OSError:
+                    pass
+        return live
+
+    # ---------- 写入 ----------
+
+    def begin(self):
+        """建立下一个版本（发布前对读取方不可见），返回 (name, lease, dropped)
+
+        新目录中每只股票只链接当前版本最新的一份缓存，dropped 为因此淘汰的重复旧文件数
+        """
+        self.current()
+        with self._exclusive():  # 链接期间 base 不会被回收
+            base = self._read_pointer()
+            name = self._new_name()
+            lease = self._lease(name)  # 构建中的版本同样受租约保护
+            os.makedirs(self.path(name))
+            latest = latest_files(self.path(base))
+            for _, _, src in latest.values():
+                _link(src, os.path.join(self.path(name), os.path.basename(src)))
+            total = sum(1 for n in os.listdir(self.path(base)) if parse_cache_name(n) is not None)
+        return name, lease, total - len(latest)
+
+    def discard(self, name, lease):
+        """放弃未发布的版本（入库没有任何改动时）"""
+        shutil.rmtree(self.path(name), ignore_errors=True)
+        self.release(lease)
+
+    def publish(self, name, lease, written=()):
+        """发布新版本：原子替换 CURRENT，随后回收旧版本
+
+        构建期间其他进程写入当前版本、而本次没有写过的股票（written 之外），其最新文件补链接进新版本
+        """
+        with self._exclusive():
+            current = self._read_pointer()
+            if current and current != name:
+                ours = latest_files(self.path(name))
+                for code, (_, _, src) in latest_files(self.path(current)).items():
+                    if code in written:
+                        continue
+                    mine = ours.get(code)
+                    if mine is not None and os.path.basename(mine[2]) == os.path.basename(src):
+                        continue
+                    _link(src, os.path.join(self.path(name), os.path.basename(src) + '.tmp'))
+                    os.replace(os.path.join(self.path(name), os.path.basename(src) + '.tmp'),
+                               os.path.join(self.path(name), os.path.basename(src)))
+                    if mine is not None:
+                        os.remove(mine[2])
+            self._write_pointer(name)
+        self.release(lease)
+        self.gc()
+
+    def gc(self):
+        """删除不是当前版本、且没有存活租约的版本目录，返回删除的版本名"""
+        removed = []
+        with self._exclusive():
+            current = self._read_pointer()
+            live = self._live_leases()
+            for entry in os.listdir(self.root):
+                if not entry.startswith('v') or entry == current or entry in live:
+                    continue
+                if os.path.isdir(self.path(entry)):
+                    shutil.rmtree(self.path(entry), ignore_errors=True)
+                    removed.append(entry)
+        return removed
+
+    def versions(self):
+        """{'current', 'versions': [...], 'leases': {version: 租约数}}（/api/health 用）"""
+        self.current()
+        leases = {}
+        for entry in os.listdir(self.lease_dir):
+            name = entry.partition('@')[0]
+            leases[name] = leases.get(name, 0) + 1
+        return {'current': self._read_pointer(),
+                'versions': sorted(d for d in os.listdir(self.root) if d.startswith('v')),
+                'leases': leases}
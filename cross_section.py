@@ -0,0 +1,130 @@
+"""
+截面（全市场排名）条件
+
+排名/分位数按交易日在全市场计算一次（宽表 日期×股票 上整表 rank），
+单只股票判断时只做一次查表，可与逐股条件混用。
+
+条件示例：
+    {'type': 'cs_rank', 'field': 'pct_change', 'date1': -1, 'max_rank': 50}
+        T-1 涨幅全市场排名前 50（ascending=True 时为从小到大排名）
+    {'type': 'cs_percentile', 'field': 'volume_ratio', 'date1': 0, 'min_pct': 95}
+        T 日量比处于全市场前 5%（分位数 0~100，越大越靠前；可选 max_pct）
+
+date1 按全市场交易日历偏移：T-1 是市场的上一个交易日，而不是该股票自己的上一根K线；
+股票在那天停牌（没有该行）时取值为 NaN，条件不成立。
+"""
+import numpy as np
+import pandas as pd
+
+CROSS_SECTIONAL_TYPES = ('cs_rank', 'cs_percentile')
+
+# 可排名字段 -> 日线列名；volume_ratio 为当日成交量 / 前一交易日成交量
+CS_FIELDS = {
+    'pct_change': '涨跌幅',
+    'volume': '成交量',
+    'amount': '成交额',
+    'turnover': '换手率',
+    'amplitude': '振幅',
+    'volume_ratio': None,
+}
+
+
+def is_cross_sectional(condition):
+    return condition.get('type') in CROSS_SECTIONAL_TYPES
+
+
+def has_cross_sectional(conditions):
+    return any(is_cross_sectional(c) for c in conditions)
+
+
+def _field_series(df, field):
+    if field not in CS_FIELDS:
+        raise ValueError(f"不支持的截面字段: {field}")
+    if field == 'volume_ratio':
+        vol = df['成交量'].astype(float)
+        return vol / vol.shift(1).replace(0, np.nan)
+    return df[CS_FIELDS[field]].astype(float)
+
+
+def offset_trading_day(calendar, base_date, offset):
+    """交易日历（升序 DatetimeIndex）上 base_date 偏移 offset 个交易日的日期（Timestamp）；
+    base_date 不是交易日或超出日历返回 None，offset 为 'YYYY-MM-DD' 字符串时为绝对日期"""
+    if isinstance(offset, str):
+        return pd.Timestamp(offset)
+    base = pd.Timestamp(base_date)
+    i = int(calendar.searchsorted(base, side='left'))
+    if i >= len(calendar) or calendar[i] != base:
+        return None
+    j = i + int(offset)
+    return calendar[j] if 0 <= j < len(calendar) else None
+
+
+class CrossSection:
+    """全市场截面排名表：{字段: 宽表}，按需计算每个交易日的排名与分位数"""
+
+    def __init__(self, panels, calendar=None):
+        self.panels = panels  # field -> DataFrame(index=日期, columns=code)
+        if calendar is None:
+            # 未给出交易日历时取各股票日期的并集（全市场时即为市场交易日）
+            calendar = pd.DatetimeIndex([])
+            for panel in panels.values():
+                calendar = calendar.union(panel.index)
+        self.calendar = pd.DatetimeIndex(calendar).sort_values()
+        self._ranks = {}
+
+    @classmethod
+    def build(cls, stock_frames, conditions, calendar=None):
+        """由 {code: 日线df} 构建截面排名（只构建条件里用到的字段）
+
+        calendar: 市场交易日（YYYY-MM-DD 列表，DataFetcher.get_trading_days），date1 按它偏移
+        """
+        fields = {c.get('field', 'pct_change') for c in conditions if is_cross_sectional(c)}
+        panels = {}
+        for field in fields:
+            columns = {}
+            for code, df in stock_frames.items():
+                if df is None or df.empty:
+                    continue
+                df = df.sort_values('日期')
+                columns[code] = pd.Series(_field_series(df, field).values,
+                                          index=pd.to_datetime(df['日期']).values)
+            panels[field] = pd.DataFrame(columns).sort_index()
+        cs = cls(panels, pd.to_datetime(calendar) if calendar is not None else None)
+        for c in conditions:
+            if is_cross_sectional(c):
+                cs._get_ranks(c.get('field', 'pct_change'), c.get('type') == 'cs_percentile',
+                              bool(c.get('ascending', False)))
+        return cs
+
+    def _get_ranks(self, field, pct, ascending=False):
+        """整表按行（每个交易日）排名；分位数统一为升序百分比，越大越靠前"""
+        key = (field, pct, ascending)
+        if key not in self._ranks:
+            panel = self.panels[field]
+            if pct:
+                self._ranks[key] = panel.rank(axis=1, ascending=True, pct=True) * 100
+            else:
+                self._ranks[key] = panel.rank(axis=1, ascending=ascending, method='min')
+        return self._ranks[key]
+
+    def offset_date(self, base_date, offset):
+        """T（base_date）按市场交易日历偏移 offset 个交易日的日期，超出日历返回 None"""
+        return offset_trading_day(self.calendar, base_date, offset)
+
+    def lookup(self, condition, date, code):
+        """某只股票在某交易日的排名（cs_rank）或分位数（cs_percentile），缺失返回 NaN"""
+        field = condition.get('field', 'pct_change')
+        pct = condition.get('type') == 'cs_percentile'
+        ranks = self._get_ranks(field, pct, bool(condition.get('ascending', False)))
+        try:
+            return float(ranks.at[pd.Timestamp(date), code])
+        except KeyError:
+            return float('nan')
+
+    def evaluate(self, condition, date, code):
+        value = self.lookup(condition, date, code)
+        if np.isnan(value):
+            return False
+        if condition.get('type') == 'cs_rank':
+            return value <= condition.get('max_rank', 50)
+        return condition.get('min_pct', 0) <= value <= condition.get('max_pct', 100)
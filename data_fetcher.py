@@ -1,42 +1,105 @@
 """
-A股数据获取器 - 使用 Baostock（免费、稳定）
-注意：Baostock 非线程安全，并发请求会混淆数据，需加锁
+A股数据获取器 - 默认使用 Baostock（免费、稳定），数据源可替换（见 data_sources.py）
 """
+import numpy as np
 import pandas as pd
 from threading import Lock
 from datetime import datetime, timedelta
 import time
 import os
 import json
+from contextlib import contextmanager
 import glob
 
-import baostock as bs
+from cache_versions import CacheVersions, latest_files, parse_cache_name
+from data_sources import BaostockSource, DAILY_COLUMNS
+from resample import TIMEFRAMES, merge_bars, resample_bars
+from market_breadth import MarketBreadth
+from market_snapshot import MarketSnapshot, frame_bars
+from trade_calendar import TradeCalendar, missing_spans
+from universe import StockUniverse
+from scheduler import SingleFlight
+from write_behind import WriteBehind
+
+# 数据源当日日线在收盘后数小时才发布：此前查询当日无数据不代表停牌，发布时点之后再查一次
+DATA_PUBLISH_HOUR = 18
 
 
 class DataFetcher:
-    """A股数据获取器 - 使用 Baostock"""
+    """A股数据获取器：本地缓存 + 可替换的数据源（默认 Baostock）"""
 
-    def __init__(self):
+    def __init__(self, cache_dir=None, source=None):
+        """
+        Args:
+            cache_dir: 缓存目录，默认为项目下的 cache/
+            source: 数据源（data_sources.DataSource），默认 BaostockSource；
+                    离线运行可传 FileSource（本地全市场日线文件）或 MemorySource
+        """
+        self.source = source or BaostockSource()
         self.stock_list_cache = None
         self.stock_list_cache_time = None
         self.cache_duration = 3600
 
-        self.cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(__file__), 'cache')
         os.makedirs(self.cache_dir, exist_ok=True)
         self.stock_list_cache_file = os.path.join(self.cache_dir, 'stock_list.json')
         self.stock_data_cache_dir = os.path.join(self.cache_dir, 'stock_data')
         os.makedirs(self.stock_data_cache_dir, exist_ok=True)
-        self._bs_logged_in = False
-        self._bs_lock = Lock()  # Baostock 非线程安全
+        # 日线缓存按版本目录存放：入库在新版本中写入后原子发布，回测固定读一个版本（见 cache_versions.py）
+        self.cache_versions = CacheVersions(self.stock_data_cache_dir)
+        self._batch = None  # 进行中的入库批次 {'name', 'lease', 'written', 'depth'}
+        self._batch_lock = Lock()
+        self.resampled_cache_dir = os.path.join(self.cache_dir, 'resampled')
+        os.makedirs(self.resampled_cache_dir, exist_ok=True)
+        self._resampled_memo = {}  # (code, timeframe) -> (source, bars)
+        self.adjust_factor_cache_dir = os.path.join(self.cache_dir, 'adjust_factor')
+        os.makedirs(self.adjust_factor_cache_dir, exist_ok=True)
+        self._adjust_factor_memo = {}  # code -> DataFrame
+        self.market_breadth = MarketBreadth(self.cache_dir)
+        self.snapshot_dir = os.path.join(self.cache_dir, 'snapshot')
+        self.snapshot = None  # MarketSnapshot，加载后 get_stock_data 优先从快照切片
+        self._snapshot_checked_at = 0.0
+        self.trade_calendar = TradeCalendar(self.cache_dir)
+        self.universe = StockUniverse(self.cache_dir)  # 历史时点股票池（未建立时回测用当前股票列表）
+        self._calendar_offline = False  # 交易日历拉取失败后本进程内改用周一至周五
+        self._calendar_lock = Lock()  # 补拉日历串行执行，避免并发线程重复拉取、同时写文件
+        self._data_version = 0  # 本进程写入缓存的次数，与共享文件的修改时间一起构成数据版本
+        self._data_changed_at = 0.0
+        self._version_lock = Lock()
+        self._loads = SingleFlight()  # 合并同一只股票、同一范围的并发读取
+        self._code_locks = {}  # code -> Lock，同一只股票的缓存补齐串行执行
+        self._code_locks_lock = Lock()
+        # 日线缓存、聚合K线、复权因子和回测结果由后台线程批量落盘，拉取/回测线程不等待磁盘；
+        # 尚未落盘的日线缓存 {(版本目录, code): (start, end, path, df, suspended)}，本进程的读取直接取内存中的数据
+        self.writer = WriteBehind()
+        self._unflushed = {}
+        self._unflushed_lock = Lock()
 
-    def _ensure_login(self):
-        if not self._bs_logged_in:
-            lg = bs.login()
-            self._bs_logged_in = (lg.error_code == '0')
+    def login(self):
+        """预先登录数据源（服务启动时在后台调用，避免首个请求在加锁的拉取路径里登录）"""
+        return self.source.login()
 
-    def _to_bs_code(self, code):
-        """6位代码转 Baostock 格式：sh.600000 或 sz.000001"""
-        return f"sh.{code}" if code.startswith('6') else f"sz.{code}"
+    def _bump_data_version(self):
+        with self._version_lock:
+            self._data_version += 1
+            self._data_changed_at = time.time()
+
+    def get_data_version(self):
+        """当前数据版本 (version, last_modified)
+
+        本进程写入日线缓存、加载快照，或其他进程（每日任务）更新快照/市场宽度/股票列表/股票池后都会改变；
+        last_modified 为最近一次变化的时间戳。用于 HTTP 缓存校验和服务端响应缓存失效。
+        """
+        parts, stamps = [str(self._data_version)], [self._data_changed_at]
+        for path in (os.path.join(self.snapshot_dir, 'CURRENT'), self.market_breadth.path, self.stock_list_cache_file,
+                     self.universe.path, self.cache_versions.pointer):
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                mtime = 0.0
+            parts.append(f'{mtime:.6f}')
+            stamps.append(mtime)
+        return '-'.join(parts), max(stamps)
 
     def _should_exclude(self, code, name):
         """只保留主板股票：00开头（深市主板）、60开头（沪市主板）"""
@@ -66,15 +129,8 @@ class DataFetcher:
             pass
 
         try:
-            with self._bs_lock:
-                self._ensure_login()
-                rs = bs.query_all_stock(day=datetime.now().strftime('%Y-%m-%d'))
             stock_list = []
-            while rs.error_code == '0' and rs.next():
-                row = rs.get_row_data()
-                # code: sh.600000, code_name: 浦发银行
-                bs_code, trade_status, name = row[0], row[1], row[2]
-                code = bs_code.split('.')[-1] if '.' in bs_code else bs_code
+            for code, name in self.source.stock_list():
                 if len(code) != 6 or self._should_exclude(code, name):
                     continue
                 stock_list.append({'code': code, 'name': name})
@@ -91,11 +147,107 @@ class DataFetcher:
             print(f"[ERROR] 获取股票列表失败: {e}")
         return []
 
-    def _get_cache_path(self, code, start_date, end_date):
-        return os.path.join(self.stock_data_cache_dir, f"{code}_{start_date}_{end_date}.json")
+    def update_universe(self):
+        """把最近交易日的全市场列表记入历史时点股票池（股票池未建立时不做任何事）"""
+        if not self.universe.available():
+            return False
+        try:
+            return self.universe.record_day(self._get_last_trading_day(), self.source.stock_list())
+        except Exception as e:
+            print(f"[WARNING] 更新股票池失败: {e}")
+            return False
+
+    def _cache_dir(self, version=None):
+        """读取日线缓存的版本目录：指定版本 > 本进程进行中的入库批次 > 当前版本"""
+        if version is not None:
+            return self.cache_versions.path(version)
+        batch = self._batch
+        if batch is not None:
+            return self.cache_versions.path(batch['name'])
+        return self.cache_versions.current_path()
+
+    def _get_cache_path(self, code, start_date, end_date, version=None):
+        """写入路径：指定版本时为该版本目录，入库批次中为新版本目录，否则为当前版本目录"""
+        return os.path.join(self._cache_dir(version), f"{code}_{start_date}_{end_date}.json")
+
+    @contextmanager
+    def cache_batch(self):
+        """入库批次：期间本进程的日线缓存读写都在新版本目录中进行，最外层结束时原子发布（可嵌套）
+
+        发布前其他进程的回测继续读旧版本；中途出错也发布已写入的部分（每个文件都是完整写入的）；
+        没有任何改动（没有写入、也没有淘汰重复文件）时丢弃新版本，不产生空版本
+        """
+        with self._batch_lock:
+            if self._batch is None:
+                self.writer.flush()  # 新版本链接当前版本的文件，先让已登记的写入落盘
+                name, lease, dropped = self.cache_versions.begin()
+                self._batch = {'name': name, 'lease': lease, 'written': set(), 'changed': dropped > 0, 'depth': 0}
+            self._batch['depth'] += 1
+            batch = self._batch
+        try:
+            yield self.cache_versions.path(batch['name'])
+        finally:
+            with self._batch_lock:
+                batch['depth'] -= 1
+                done = batch['depth'] == 0
+                if done:
+                    self._batch = None
+            if done:
+                self.writer.flush()  # 批次中登记的写入全部落盘后再发布
+            if done and not (batch['written'] or batch['changed']):
+                self.cache_versions.discard(batch['name'], batch['lease'])
+            elif done:
+                self.cache_versions.publish(batch['name'], batch['lease'], batch['written'])
+                self._bump_data_version()
+
+    @contextmanager
+    def pin_cache_version(self):
+        """固定日线缓存版本（with 期间该版本不会被回收），回测开始时调用，整个回测读同一版本
+
+        本进程有进行中的入库批次时直接读批次目录（能读到刚写入的数据）
+        """
+        batch = self._batch
+        if batch is not None:
+            yield batch['name']
+            return
+        with self.cache_versions.reading() as name:
+            yield name
+
+    def get_trading_days(self, start_date, end_date):
+        """[start, end] 内的交易日（YYYY-MM-DD 升序，含节假日判断）
+
+        日历按需从数据源补拉并持久化；拉取失败时退化为周一至周五。
+        """
+        start_str = str(start_date).replace('-', '')
+        end_str = str(end_date).replace('-', '')
+        if not self._calendar_offline and self.trade_calendar.uncovered(start_str, end_str):
+            with self._calendar_lock:
+                self._extend_calendar(start_str, end_str)
+        if self._calendar_offline:
+            return [d.strftime('%Y-%m-%d') for d in pd.bdate_range(pd.Timestamp(start_str), pd.Timestamp(end_str))]
+        return self.trade_calendar.days(start_str, end_str)
+
+    def _extend_calendar(self, start_str, end_str):
+        """补拉 [start, end] 中尚未覆盖的日历（调用方持有 _calendar_lock，拿到锁后重新检查覆盖范围）"""
+        if not self._calendar_offline:
+            for range_start, range_end in self.trade_calendar.uncovered(start_str, end_str):
+                try:
+                    days = self.source.trade_dates(range_start, range_end)
+                    self.trade_calendar.extend(range_start, range_end, days)
+                except Exception as e:
+                    print(f"[WARNING] 拉取交易日历失败，按周一至周五计算: {e}")
+                    self._calendar_offline = True
+                    break
 
     def _get_last_trading_day(self):
-        """获取最近的 A 股交易日（周一至周五，不考虑节假日）"""
+        """获取最近的 A 股交易日（按交易日历；日历不可用时按周一至周五）"""
+        try:
+            now = datetime.now()
+            days = self.get_trading_days((now - timedelta(days=30)).strftime('%Y%m%d'), now.strftime('%Y%m%d'))
+            if days:
+                return days[-1]
+        except Exception:
+            pass
         d = datetime.now().date()
         # weekday: 0=周一, 6=周日
         if d.weekday() == 5:  # 周六
@@ -108,25 +260,11 @@ class DataFetcher:
         """获取本地缓存中最新一条数据的日期，无缓存返回 None"""
         try:
             # 以 000001 为代表检查
-            pattern = os.path.join(self.stock_data_cache_dir, '000001_*.json')
-            files = glob.glob(pattern)
-            if not files:
+            cached = self.get_cached_file('000001')
+            if cached is None:
                 return None
-            latest_dt = None
-            for fp in files:
-                try:
-                    with open(fp, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    rows = data.get('data') or []
-                    for r in rows:
-                        ds = r.get('日期')
-                        if ds:
-                            dt = pd.to_datetime(ds)
-                            if latest_dt is None or dt > latest_dt:
-                                latest_dt = dt
-                except Exception:
-                    continue
-            return latest_dt.strftime('%Y-%m-%d') if latest_dt is not None else None
+            df, _ = self._read_cache_file(cached[2])
+            return df['日期'].max().strftime('%Y-%m-%d') if df is not None else None
         except Exception:
             return None
 
@@ -138,95 +276,328 @@ class DataFetcher:
             return True
         return cache_latest < last_trade
 
+    def _scan_cache_files(self, version=None):
+        """遍历缓存版本目录，返回每只股票最新的一份 [(code, start_str, end_str, path), ...]
+
+        按需补拉的写入不删除被替换的旧文件，同一只股票可能有多份，取 start 最早、end 最晚的一份；
+        遍历目录前先让后台写入落盘
+        """
+        self.writer.flush()
+        return [(code, start_str, end_str, fp)
+                for code, (start_str, end_str, fp) in latest_files(self._cache_dir(version)).items()]
+
+    def get_cached_file(self, code, version=None):
+        """返回某只股票的缓存文件 (start_str, end_str, path)，无缓存返回 None（有多份时取 start 最早的）
+
+        本进程刚写入、尚未落盘的缓存优先（它就是该股票最新的一份）
+        """
+        directory = self._cache_dir(version)
+        pending = self._unflushed.get((directory, code))
+        if pending is not None:
+            return pending[:3]
+        items = []
+        for fp in glob.glob(os.path.join(directory, f'{code}_*.json')):
+            parts = os.path.basename(fp)[:-5].split('_')
+            if len(parts) == 3 and len(parts[1]) == 8 and len(parts[2]) == 8:
+                items.append((parts[1], parts[2], fp))
+        if not items:
+            return None
+        items.sort(key=lambda x: (x[0], -int(x[1])))  # start 升序，end 降序
+        return items[0]
+
     def remove_duplicate_cache(self):
-        """删除重复缓存：每只股票只保留一份（保留 start_date 最早的那份，覆盖范围最大）"""
+        """删除重复缓存：每只股票只保留一份（保留 start_date 最早的那份，覆盖范围最大）
+
+        在入库批次的新版本中删除（不在批次中时单独建立一个版本），正在读取旧版本的回测不受影响
+        """
         try:
-            pattern = os.path.join(self.stock_data_cache_dir, '*.json')
-            files = glob.glob(pattern)
-            # 按 code 分组: code -> [(start, end, path), ...]
-            by_code = {}
-            for fp in files:
-                name = os.path.basename(fp)
-                if '_' not in name or not name.endswith('.json'):
-                    continue
-                parts = name[:-5].split('_')  # 去掉 .json
-                if len(parts) != 3:
-                    continue
-                code, start_str, end_str = parts
-                if len(code) != 6 or len(start_str) != 8 or len(end_str) != 8:
-                    continue
-                by_code.setdefault(code, []).append((start_str, end_str, fp))
+            with self.cache_batch() as directory:
+                self.writer.flush()
+                # 按 code 分组: code -> [(start, end, path), ...]
+                by_code = {}
+                for name in os.listdir(directory):
+                    parsed = parse_cache_name(name)
+                    if parsed is not None:
+                        by_code.setdefault(parsed[0], []).append((parsed[1], parsed[2], os.path.join(directory, name)))
 
-            deleted = 0
-            for code, items in by_code.items():
-                if len(items) <= 1:
-                    continue
-                # 保留 start_date 最早、end_date 最晚（若 start 相同）的那份
-                items.sort(key=lambda x: (x[0], -int(x[1])))  # start 升序，end 降序
-                keep_path = items[0][2]
-                for _, _, path in items[1:]:
-                    try:
-                        os.remove(path)
-                        deleted += 1
-                    except Exception:
-                        pass
+                deleted = 0
+                for code, items in by_code.items():
+                    if len(items) <= 1:
+                        continue
+                    # 保留 start_date 最早、end_date 最晚（若 start 相同）的那份
+                    items.sort(key=lambda x: (x[0], -int(x[1])))  # start 升序，end 降序
+                    for _, _, path in items[1:]:
+                        try:
+                            os.remove(path)
+                            deleted += 1
+                        except Exception:
+                            pass
+                if deleted > 0:
+                    self._batch['changed'] = True
             if deleted > 0:
                 print(f"[INFO] 删除重复缓存 {deleted} 个文件")
         except Exception as e:
             print(f"[WARNING] 清理重复缓存失败: {e}")
 
-    def _fetch_from_api(self, code, start_date, end_date):
-        """从 API 拉取数据并返回 DataFrame，不写缓存"""
-        start_fmt = f"{start_date[:4]}-{start_date[4:6]}-{start_date[6:]}"
-        end_fmt = f"{end_date[:4]}-{end_date[4:6]}-{end_date[6:]}"
+    def _fetch_from_source(self, code, start_date, end_date):
+        """从数据源拉取日线（yyyymmdd，含两端）并返回 DataFrame，不写缓存
+
+        请求失败返回 None；请求成功但区间内无数据（停牌、未上市）返回空 DataFrame
+        """
         try:
-            with self._bs_lock:
-                self._ensure_login()
-                bs_code = self._to_bs_code(code)
-                rs = bs.query_history_k_data_plus(
-                    bs_code,
-                    "date,open,high,low,close,volume,amount,pctChg,turn",
-                    start_date=start_fmt, end_date=end_fmt, frequency="d", adjustflag="3"
-                )
-                data_list = []
-                while rs.error_code == '0' and rs.next():
-                    data_list.append(rs.get_row_data())
-            if not data_list:
-                return None
-            df = pd.DataFrame(data_list, columns=['日期','开盘','最高','最低','收盘','成交量','成交额','涨跌幅','换手率'])
-            df = df.drop_duplicates(subset=['日期'], keep='first')
-            df['日期'] = pd.to_datetime(df['日期'])
-            for col in ['开盘','收盘','最高','最低','成交量','成交额','涨跌幅','换手率']:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-            df['成交量'] = df['成交量'].astype(float)
-            df['涨跌额'] = df['收盘'].diff()
-            df['涨跌额'] = df['涨跌额'].fillna(0)
-            df['振幅'] = ((df['最高'] - df['最低']) / df['最低'].replace(0, float('nan')) * 100).fillna(0)
-            df = df[['日期','开盘','收盘','最高','最低','成交量','成交额','振幅','涨跌幅','涨跌额','换手率']]
-            return df.sort_values('日期').reset_index(drop=True)
+            return self.source.daily(code, start_date, end_date)
         except Exception:
             return None
 
+    def _pending_cache(self, fp):
+        """fp 为尚未落盘的日线缓存时返回其登记项，否则返回 None"""
+        parsed = parse_cache_name(os.path.basename(fp))
+        if parsed is None:
+            return None
+        pending = self._unflushed.get((os.path.dirname(fp), parsed[0]))
+        return pending if pending is not None and pending[2] == fp else None
+
+    def _cache_file_exists(self, fp):
+        return self._pending_cache(fp) is not None or os.path.exists(fp)
+
+    def _read_cache_file(self, fp):
+        """读取日线缓存文件，返回 (df, suspended)：suspended 为已确认无数据的交易日集合"""
+        df, suspended, _ = self._read_cache_entry(fp)
+        return df, suspended
+
+    def _read_cache_entry(self, fp):
+        """读取日线缓存文件，返回 (df, suspended, checked)：checked 为查询过但尚未确认无数据的交易日 -> 查询时间"""
+        pending = self._pending_cache(fp)
+        if pending is not None:
+            df = pending[3]
+            return (df.copy() if df is not None and not df.empty else None), set(pending[4]), dict(pending[5])
+        with open(fp, 'r', encoding='utf-8') as f:
+            cache_data = json.load(f)
+        suspended = set(cache_data.get('suspended') or [])
+        checked = dict(cache_data.get('checked') or {})
+        rows = cache_data.get('data') or []
+        if not rows:
+            return None, suspended, checked
+        df = pd.DataFrame(rows)
+        df['日期'] = pd.to_datetime(df['日期'])
+        return df.sort_values('日期').reset_index(drop=True), suspended, checked
+
+    @staticmethod
+    def _fresh_checks(checked, now=None):
+        """保留仍然有效的空结果记录：当天查询过的不再重查，发布时点前查询的过了发布时点再查，次日全部重查"""
+        now = now or datetime.now()
+        cutoff = now.replace(hour=DATA_PUBLISH_HOUR, minute=0, second=0, microsecond=0)
+        fresh = {}
+        for day, at in checked.items():
+            try:
+                at = datetime.fromisoformat(at)
+            except (TypeError, ValueError):
+                continue
+            if at.date() == now.date() and (at >= cutoff or now < cutoff):
+                fresh[day] = at.isoformat()
+        return fresh
+
+    def _code_lock(self, code):
+        with self._code_locks_lock:
+            lock = self._code_locks.get(code)
+            if lock is None:
+                lock = self._code_locks[code] = Lock()
+            return lock
+
+    def sync_stock_cache(self, code, start_str, end_str, last_trade_str=None, cached=None, force=False, version=None,
+                         recheck=False):
+        """按交易日历补齐单只股票缓存中 [start, end] 缺失的交易日，只拉取缺失区间并合并写回
+
+        缺失包括缓存范围之外的日期和以前拉取失败留下的空洞；请求过但无数据的交易日（停牌、未上市）
+        记入缓存文件的 suspended 字段，之后不再请求。最新数据日之后的缺失无法确认（当日数据未发布、停牌至今），
+        记入 checked 字段：当天不再重复请求，发布时点（DATA_PUBLISH_HOUR）前查询的过了发布时点再查一次，
+        次日重新请求；已退市的股票（universe.delisted_on）只请求到退市日，请求过的交易日都可确认。
+
+        Args:
+            cached: get_cached_file 的返回值，不传则自动查找
+            force: 为 True 时重新拉取整个区间（覆盖已有数据）
+            version: 从该缓存版本读取（pin_cache_version），补拉的数据也写回该版本：固定版本的回测
+                     读到的始终是同一版本目录中的数据，不与当前版本混读。补拉只追加读取时缺失的交易日，
+                     已有的行不变，版本的内容只会变得更完整（预览结果按版本复用的前提）；该版本已不是
+                     当前版本时，补拉的数据随它一起回收，之后的读取在当前版本中重新补拉
+            recheck: 为 True 时忽略 checked 记录，重新请求尚未确认的交易日（每日入库）
+        Returns:
+            (df, updated): df 为合并后的完整日线（无数据为 None），updated 表示是否写入了新数据
+        """
+        if last_trade_str is None:
+            last_trade_str = self._get_last_trading_day().replace('-', '')
+        # 同一只股票同时只有一个线程补齐；后到的线程拿到锁时缓存通常已补齐，不再请求 API
+        with self._code_lock(code):
+            if cached is not None and not self._cache_file_exists(cached[2]):
+                cached = None  # 等锁期间缓存文件已被改名
+            return self._sync_stock_cache(code, start_str, end_str, last_trade_str, cached, force, version, recheck)
+
+    def _sync_stock_cache(self, code, start_str, end_str, last_trade_str, cached, force, version=None, recheck=False):
+        if cached is None:
+            cached = self.get_cached_file(code, version)
+        df_old, suspended, checked = None, set(), {}
+        if cached is not None:
+            try:
+                df_old, suspended, checked = self._read_cache_entry(cached[2])
+            except OSError:
+                # 未固定版本的读取恰好遇到旧版本被回收：重新定位一次，不当作无缓存整段重拉
+                cached = self.get_cached_file(code, version)
+                try:
+                    if cached is not None:
+                        df_old, suspended, checked = self._read_cache_entry(cached[2])
+                except Exception:
+                    df_old, suspended, checked = None, set(), {}
+            except Exception:
+                df_old, suspended, checked = None, set(), {}
+        now = datetime.now()
+        checked = self._fresh_checks(checked, now)
+
+        fetch_end = min(end_str, last_trade_str)
+        # 已退市的股票（历史时点股票池中上市区间已结束）不再请求退市之后的日期，
+        # 退市前请求过但无数据的交易日都可确认为停牌
+        delisted_on = self.universe.delisted_on(code)
+        if delisted_on is not None:
+            fetch_end = min(fetch_end, delisted_on)
+        if start_str > fetch_end:
+            return df_old, False
+        known = set()
+        if not force:
+            # 近期查询过仍无数据的交易日（当日数据未发布、停牌至今）在有效期内不再重复请求
+            known = set(suspended) if recheck else set(suspended) | set(checked)
+            if df_old is not None:
+                known.update(df_old['日期'].dt.strftime('%Y-%m-%d'))
+        spans = missing_spans(self.get_trading_days(start_str, fetch_end), known)
+        if not spans:
+            return df_old, False
+
+        parts, requested = [], set()
+        for span in spans:
+            df_new = self._fetch_from_source(code, span[0].replace('-', ''), span[-1].replace('-', ''))
+            if df_new is None:
+                continue  # 拉取失败，留作空洞下次再补
+            requested.update(span)
+            if not df_new.empty:
+                parts.append(df_new)
+        if not parts:
+            if requested and df_old is not None:
+                # 整段无数据：早于最新数据日的部分可确认为停牌，其余记下查询时间，有效期内不再重查
+                last_day = df_old['日期'].max().strftime('%Y-%m-%d')
+                confirmed = {d for d in requested if d < last_day or delisted_on is not None} - suspended
+                unconfirmed = requested - confirmed - suspended
+                checked.update((d, now.isoformat()) for d in unconfirmed)
+                for d in confirmed:
+                    checked.pop(d, None)
+                if confirmed or unconfirmed:
+                    self._write_stock_cache(code, cached[0], cached[1], df_old, suspended | confirmed, cached[2],
+                                            version=version, checked=checked)
+            return df_old, False
+        df_new = pd.concat(parts, ignore_index=True)
+
+        # 出现新的除权除息时只重拉复权因子（仅对已有因子缓存的股票）
+        if df_old is not None and (code in self._adjust_factor_memo
+                                   or os.path.exists(self._get_adjust_factor_path(code))):
+            appended = df_new[df_new['日期'] > df_old['日期'].max()]
+            if not appended.empty and self._has_corporate_action(df_old, appended):
+                self.refresh_adjust_factors(code)
+
+        frames = [df_new] if df_old is None else [df_old, df_new]
+        df_merged = pd.concat(frames, ignore_index=True)
+        df_merged = df_merged.drop_duplicates(subset=['日期'], keep='last')
+        df_merged = df_merged.sort_values('日期').reset_index(drop=True)
+        df_merged['涨跌额'] = df_merged['收盘'].diff().fillna(0)  # 分段拉取时首行涨跌额需用合并后的前收盘重算
+
+        dates = set(df_merged['日期'].dt.strftime('%Y-%m-%d'))
+        last_day = df_merged['日期'].max().strftime('%Y-%m-%d')
+        suspended = (suspended | {d for d in requested if d < last_day or delisted_on is not None}) - dates
+        checked.update((d, now.isoformat()) for d in requested - dates - suspended)
+        checked = {d: at for d, at in checked.items() if d not in dates and d not in suspended}
+
+        new_start = min(start_str, cached[0]) if cached is not None else start_str
+        new_end = last_day.replace('-', '')
+        if cached is not None:
+            new_end = max(new_end, cached[1])
+        self._write_stock_cache(code, new_start, new_end, df_merged, suspended,
+                                cached[2] if cached is not None else None, version=version,
+                                since=df_new['日期'].min(), checked=checked)
+        return df_merged, True
+
+    def _write_stock_cache(self, code, start_str, end_str, df, suspended, old_fp=None, version=None, since=None,
+                           checked=None):
+        """登记写入单只股票的日线缓存，由后台线程批量落盘（tmp + os.replace），调用方不等待磁盘
+
+        落盘前本进程对该股票的读取（get_cached_file / _read_cache_file）直接取登记的数据；
+        version 为写入的缓存版本（不传为入库批次或当前版本）；since 为日线最早的变化日，周线/月线从这里重算；
+        checked 为查询过但尚未确认无数据的交易日 -> 查询时间（见 _fresh_checks）
+        """
+        new_path = self._get_cache_path(code, start_str, end_str, version)
+        directory = os.path.dirname(new_path)
+        cache_time = datetime.now().isoformat()
+        suspended = sorted(suspended)
+        checked = dict(sorted((checked or {}).items()))
+        entry = (start_str, end_str, new_path, df, suspended, checked)
+        with self._unflushed_lock:
+            self._unflushed[(directory, code)] = entry
+        # 只在入库批次的新版本（尚未发布，无人读取）中删除被替换的文件；
+        # 当前版本中保留，读取方可能刚列出它，随旧版本一起回收
+        batch = self._batch
+        in_batch = batch is not None and directory == self.cache_versions.path(batch['name'])
+        remove_old = in_batch and old_fp is not None and old_fp != new_path and os.path.dirname(old_fp) == directory
+        if in_batch:
+            batch['written'].add(code)
+
+        def render():
+            return json.dumps({
+                'cache_time': cache_time,
+                'code': code, 'start_date': start_str, 'end_date': end_str,
+                'suspended': suspended,
+                'checked': checked,
+                'data': df.to_dict('records')
+            }, ensure_ascii=False, default=str)  # dumps 走 C 编码器，dump 逐块写要慢数倍
+
+        def done(path, error):
+            # 写入失败时也撤销登记：之后的读取回到磁盘上的旧文件，缺失的交易日下次重新补齐
+            if error is None and remove_old and os.path.exists(old_fp):
+                os.remove(old_fp)
+            with self._unflushed_lock:
+                if self._unflushed.get((directory, code)) is entry:
+                    del self._unflushed[(directory, code)]
+
+        self.writer.put(new_path, render, done)
+        if directory == self._cache_dir():  # 持久化的周线/月线跟随当前版本（或入库批次）
+            self.update_resampled_data(code, df, source=os.path.basename(new_path), since=since)
+        self._bump_data_version()
+        return new_path
+
+    def update_stock_cache(self, code, start_str, end_str, fp, last_trade_str=None, version=None):
+        """把缺失的交易日（最近交易日的新数据及历史空洞）合并进单只股票的缓存文件；version 同 sync_stock_cache
+
+        Returns:
+            (df, updated): df 为合并后的完整 DataFrame（读取失败为 None），updated 表示是否写入了新数据
+        """
+        if last_trade_str is None:
+            last_trade_str = self._get_last_trading_day().replace('-', '')
+        try:
+            return self.sync_stock_cache(code, start_str, last_trade_str, last_trade_str,
+                                         cached=(start_str, end_str, fp), version=version, recheck=True)
+        except Exception:
+            return None, False
+
     def update_caches_with_today_data(self, max_workers=10):
-        """拉取今天（最近交易日）的数据，合并到对应的 json 缓存文件中"""
+        """拉取今天（最近交易日）的数据，合并到对应的 json 缓存文件中
+
+        在入库批次中进行，全部写完后一次发布新版本，期间其他进程的回测读旧版本
+        """
+        with self.cache_batch():
+            self._update_caches_with_today_data(max_workers)
+
+    def _update_caches_with_today_data(self, max_workers=10):
         from concurrent.futures import ThreadPoolExecutor, as_completed
 
         last_trade = self._get_last_trading_day()
         last_trade_str = last_trade.replace('-', '')
 
-        pattern = os.path.join(self.stock_data_cache_dir, '*.json')
-        files = glob.glob(pattern)
         by_code = {}
-        for fp in files:
-            name = os.path.basename(fp)
-            if '_' not in name or not name.endswith('.json'):
-                continue
-            parts = name[:-5].split('_')
-            if len(parts) != 3:
-                continue
-            code, start_str, end_str = parts
-            if len(code) != 6 or len(start_str) != 8 or len(end_str) != 8:
-                continue
+        for code, start_str, end_str, fp in self._scan_cache_files():
             if end_str >= last_trade_str:
                 continue
             by_code[code] = (start_str, end_str, fp)
@@ -237,41 +608,8 @@ class DataFetcher:
 
         def update_one(code_start_end_path):
             code, start_str, end_str, fp = code_start_end_path
-            try:
-                with open(fp, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                rows = cache_data.get('data') or []
-                if not rows:
-                    return code, False
-                max_dt = max(pd.to_datetime(r['日期']) for r in rows)
-                fetch_start = (max_dt + timedelta(days=1)).strftime('%Y%m%d')
-                if fetch_start > last_trade_str:
-                    return code, False
-
-                df_new = self._fetch_from_api(code, fetch_start, last_trade_str)
-                if df_new is None or df_new.empty:
-                    return code, False
-
-                df_old = pd.DataFrame(rows)
-                df_old['日期'] = pd.to_datetime(df_old['日期'])
-                df_merged = pd.concat([df_old, df_new], ignore_index=True)
-                df_merged = df_merged.drop_duplicates(subset=['日期'], keep='last')
-                df_merged = df_merged.sort_values('日期').reset_index(drop=True)
-
-                new_end = last_trade_str
-                new_path = self._get_cache_path(code, start_str, new_end)
-                out = {
-                    'cache_time': datetime.now().isoformat(),
-                    'code': code, 'start_date': start_str, 'end_date': new_end,
-                    'data': df_merged.to_dict('records')
-                }
-                with open(new_path, 'w', encoding='utf-8') as f:
-                    json.dump(out, f, ensure_ascii=False, default=str)
-                if new_path != fp:
-                    os.remove(fp)
-                return code, True
-            except Exception:
-                return code, False
+            _, ok = self.update_stock_cache(code, start_str, end_str, fp, last_trade_str)
+            return code, ok
 
         tasks = [(code, s, e, p) for code, (s, e, p) in by_code.items()]
         total = len(tasks)
@@ -287,13 +625,133 @@ class DataFetcher:
                 if ((i + 1) % step == 0) or (i == total - 1):
                     print(f'进度: {i+1}/{total} | 已更新: {success}', flush=True)
         print(f'[INFO] 今日数据已落盘: 更新 {success}/{total} 个缓存')
+        if success > 0:
+            self.update_market_breadth()
+
+    def import_bulk(self, data, start_date=None, end_date=None, full_market=True):
+        """把全市场日线批量写入日线缓存（在入库批次中，导入完成后一次发布），不请求数据源
 
-    def get_stock_data(self, code, start_date=None, end_date=None, force_refresh=False):
+        Args:
+            data: 含 代码 列的缓存格式 DataFrame（data_sources.read_bulk 的结果），或文件路径（CSV/Parquet，可用通配符）
+            start_date, end_date: 只导入该范围内的数据（yyyymmdd）
+            full_market: 数据是否为全市场。为 True 时用全部日期的并集补充交易日历、重算这些日期的市场宽度，
+                         并把每只股票首末日期之间缺失的交易日记为停牌（之后不再请求）
+        Returns:
+            {'stocks', 'rows', 'written', 'seconds'}
+        """
+        with self.cache_batch():
+            return self._import_bulk(data, start_date, end_date, full_market)
+
+    def _import_bulk(self, data, start_date=None, end_date=None, full_market=True):
+        from data_sources import read_bulk
+
+        started = time.time()
+        df = data if isinstance(data, pd.DataFrame) else read_bulk(data)
+        if '代码' not in df.columns:
+            raise ValueError('批量导入的数据需要 代码 列')
+        if start_date:
+            df = df[df['日期'] >= pd.Timestamp(str(start_date))]
+        if end_date:
+            df = df[df['日期'] <= pd.Timestamp(str(end_date))]
+        df = df.sort_values(['代码', '日期'], kind='stable').reset_index(drop=True)
+        stats = {'stocks': 0, 'rows': int(len(df)), 'written': 0, 'seconds': 0.0}
+        if df.empty:
+            return stats
+
+        day_strs = df['日期'].dt.strftime('%Y-%m-%d').to_numpy()
+        if full_market:
+            days = np.unique(day_strs)
+            self.trade_calendar.extend(days[0], days[-1], list(days))
+
+        # 一次扫描缓存目录（逐只 glob 在股票多时很慢），有多份缓存时取 start 最早的
+        cached_files = {}
+        for code, start_str, end_str, fp in sorted(self._scan_cache_files(), key=lambda x: (x[1], -int(x[2]))):
+            cached_files.setdefault(code, (start_str, end_str, fp))
+
+        codes = df['代码'].to_numpy()
+        bounds = np.concatenate([[0], np.flatnonzero(codes[1:] != codes[:-1]) + 1, [len(df)]])
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            code = str(codes[lo])
+            part = df.iloc[lo:hi][DAILY_COLUMNS].reset_index(drop=True)
+            dates = set(day_strs[lo:hi])
+            first, last = day_strs[lo], day_strs[hi - 1]
+            suspended = set()
+            if full_market:
+                suspended = set(self.trade_calendar.days(first, last)) - dates
+            try:
+                with self._code_lock(code):
+                    cached = cached_files.get(code)
+                    if cached is not None and self._cache_file_exists(cached[2]):
+                        df_old, old_suspended = self._read_cache_file(cached[2])
+                        if df_old is not None:
+                            part = pd.concat([df_old, part], ignore_index=True)
+                            part = part.drop_duplicates(subset=['日期'], keep='last').sort_values('日期')
+                            part = part.reset_index(drop=True)
+                            part['涨跌额'] = part['收盘'].diff().fillna(0)
+                        suspended |= old_suspended - dates
+                        new_start = min(first.replace('-', ''), cached[0])
+                        new_end = max(last.replace('-', ''), cached[1])
+                        self._write_stock_cache(code, new_start, new_end, part, suspended, cached[2],
+                                                since=pd.Timestamp(first))
+                    else:
+                        self._write_stock_cache(code, first.replace('-', ''), last.replace('-', ''), part, suspended)
+                stats['written'] += 1
+            except Exception as e:
+                print(f"[WARNING] 导入 {code} 失败: {e}")
+            stats['stocks'] += 1
+
+        if full_market:
+            try:
+                self.market_breadth.update([df], since=day_strs.min())
+            except Exception as e:
+                print(f'[WARNING] 更新市场宽度失败: {e}')
+        stats['seconds'] = round(time.time() - started, 2)
+        return stats
+
+    def update_market_breadth(self, frames=None):
+        """更新市场宽度表（只重算已存最新日期及之后的交易日）
+
+        Args:
+            frames: 全市场股票的日线 DataFrame 列表；不传则从本地缓存读取
+        """
+        since = self.market_breadth.latest_date()
+        if frames is None:
+            frames = []
+            for code, _, end_str, fp in self._scan_cache_files():
+                if since is not None and end_str < since.replace('-', ''):
+                    continue
+                try:
+                    with open(fp, 'r', encoding='utf-8') as f:
+                        rows = json.load(f).get('data') or []
+                    if since is not None:
+                        rows = [r for r in rows if str(r.get('日期', ''))[:10] >= since]
+                    if rows:
+                        frames.append(pd.DataFrame(rows))
+                except Exception:
+                    continue
+        try:
+            days = self.market_breadth.update(frames, since=since)
+            print(f'[INFO] 市场宽度已更新: {days} 个交易日')
+        except Exception as e:
+            print(f'[WARNING] 更新市场宽度失败: {e}')
+
+    def get_stock_data(self, code, start_date=None, end_date=None, force_refresh=False, adjust=None, version=None):
         """获取单只股票的历史K线数据
-        
+
+        优先从快照切片；否则读本地缓存，只按交易日历拉取缺失的交易日并合并回缓存。
+
         Args:
-            force_refresh: 为 True 时跳过缓存，强制从网络拉取新数据
+            force_refresh: 为 True 时跳过缓存，重新拉取整个区间
+            adjust: None 不复权（缓存中的原始数据），'qfq' 前复权，'hfq' 后复权；
+                    复权价格由原始K线乘以本地复权因子即时计算，无需按复权方式重新拉取
+            version: 日线缓存版本（pin_cache_version 的返回值），回测期间固定读同一版本
         """
+        if adjust:
+            df = self.get_stock_data(code, start_date, end_date, force_refresh=force_refresh, version=version)
+            if df is None or df.empty:
+                return df
+            return self.adjust_prices(code, df, adjust)
+
         if end_date is None:
             end_date = datetime.now().strftime('%Y%m%d')
         if start_date is None:
@@ -304,58 +762,269 @@ class DataFetcher:
         start_fmt = f"{start_date[:4]}-{start_date[4:6]}-{start_date[6:]}"
         end_fmt = f"{end_date[:4]}-{end_date[4:6]}-{end_date[6:]}"
 
-        cache_path = self._get_cache_path(code, start_date, end_date)
-        try:
-            if not force_refresh and os.path.exists(cache_path) and os.path.getsize(cache_path) > 100:
-                with open(cache_path, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                if cache_data.get('data'):
-                    cache_time = datetime.fromisoformat(cache_data['cache_time'])
-                    if (datetime.now() - cache_time).total_seconds() < 604800:
-                        df = pd.DataFrame(cache_data['data'])
-                        df['日期'] = pd.to_datetime(df['日期'])
+        # 快照已覆盖该范围时直接从内存映射切片（已加载快照时顺带检查是否有新版本）；
+        # 固定了缓存版本的读取只用由该版本生成的快照，回测中途切换到的其他版本的快照不混入
+        snapshot = self.refresh_snapshot() if self.snapshot is not None else None
+        if snapshot is not None and version is not None and snapshot.cache_version != version:
+            snapshot = None
+        if not force_refresh and snapshot is not None:
+            try:
+                last_trade_str = self._get_last_trading_day().replace('-', '')
+                if snapshot.covers(code, start_date, end_date, last_trade_str):
+                    df = snapshot.get_frame(code, start_date, end_date)
+                    if df is not None and not df.empty:
                         return df
-        except Exception:
-            pass
+            except Exception:
+                pass
 
         try:
-            with self._bs_lock:
-                self._ensure_login()
-                bs_code = self._to_bs_code(code)
-                rs = bs.query_history_k_data_plus(
-                    bs_code,
-                    "date,open,high,low,close,volume,amount,pctChg,turn",
-                    start_date=start_fmt, end_date=end_fmt, frequency="d", adjustflag="3"
-                )
-                data_list = []
-                while rs.error_code == '0' and rs.next():
-                    data_list.append(rs.get_row_data())
-            if not data_list:
+            # 同一范围的并发请求只读取/拉取一次
+            df = self._loads.do(('daily', code, start_date, end_date, force_refresh, version),
+                                lambda: self.sync_stock_cache(code, start_date, end_date, force=force_refresh,
+                                                              version=version)[0])
+            if df is None or df.empty:
                 return None
+            df = df[(df['日期'] >= pd.Timestamp(start_fmt)) & (df['日期'] <= pd.Timestamp(end_fmt))]
+            return df.reset_index(drop=True) if not df.empty else None
+        except Exception as e:
+            print(f"[ERROR] 获取 {code} 数据失败: {e}")
+        return None
+
+    def _get_resampled_path(self, code, timeframe):
+        return os.path.join(self.resampled_cache_dir, f"{code}_{timeframe}.json")
+
+    def _load_cached_daily(self, code, version=None):
+        """读取某只股票的日线缓存，返回 (df, source)，无缓存返回 (None, None)"""
+        cached = self.get_cached_file(code, version)
+        if cached is None:
+            return None, None
+        try:
+            df, _ = self._read_cache_file(cached[2])
+            if df is None:
+                return None, None
+            return df, os.path.basename(cached[2])
+        except Exception:
+            return None, None
+
+    def get_resampled_data(self, code, timeframe, df_daily=None, source=None, since=None, version=None):
+        """获取周线/月线K线（由日线缓存聚合并持久化，日线有新数据时增量更新）
+
+        Args:
+            timeframe: 'W' 周线 / 'M' 月线
+            df_daily: 刚写入的日线（可选，写入时增量更新；不传则读取日线缓存）
+            source: df_daily 对应的日线缓存文件名，用于判断聚合结果是否过期
+            since: df_daily 从这一天起有变化（补齐的历史空洞、重新拉取），从它所在周期起重算
+            version: 日线缓存版本（pin_cache_version）；不是当前版本时由该版本的日线现算，
+                     不读写持久化的聚合（它跟随当前版本）
+        """
+        if timeframe not in TIMEFRAMES:
+            raise ValueError(f"不支持的周期: {timeframe}")
+        if version is not None and self._cache_dir(version) != self._cache_dir():
+            df_daily, _ = self._load_cached_daily(code, version)
+            return resample_bars(df_daily, timeframe) if df_daily is not None else None
+        key = (code, timeframe)
+        reading = df_daily is None
+        memo = self._resampled_memo.get(key)
+        if reading:
+            cached = self.get_cached_file(code)
+            source = os.path.basename(cached[2]) if cached else None
+            if memo is not None and source is not None and memo[0] == source:
+                return memo[1]
+
+        path = self._get_resampled_path(code, timeframe)
+        old_bars = memo[1] if memo is not None else None  # 本进程最新的聚合（可能尚未落盘）
+        if old_bars is None:
+            try:
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        saved = json.load(f)
+                    old_bars = pd.DataFrame(saved.get('data') or [])
+                    if not old_bars.empty:
+                        old_bars['日期'] = pd.to_datetime(old_bars['日期'])
+                        old_bars['起始日期'] = pd.to_datetime(old_bars['起始日期'])
+                        # 写入时文件名可能不变（补齐空洞不改变覆盖范围），只有读取才按文件名判断是否过期
+                        if reading and source is not None and saved.get('source') == source:
+                            self._resampled_memo[key] = (source, old_bars)
+                            return old_bars
+            except Exception:
+                old_bars = None
+
+        if reading:
+            df_daily, source = self._load_cached_daily(code)
+            if df_daily is None:
+                return old_bars
+        bars = merge_bars(old_bars, df_daily, timeframe, since=since)
+        cache_time = datetime.now().isoformat()
+        self._resampled_memo[key] = (source, bars)  # 落盘前的读取走内存
+        self.writer.put(path, lambda: json.dumps({
+            'cache_time': cache_time,
+            'code': code, 'timeframe': timeframe, 'source': source,
+            'data': bars.to_dict('records')
+        }, ensure_ascii=False, default=str))
+        return bars
 
-            df = pd.DataFrame(data_list, columns=['日期','开盘','最高','最低','收盘','成交量','成交额','涨跌幅','换手率'])
-            df = df.drop_duplicates(subset=['日期'], keep='first')  # 去重，防止异常返回
+    def update_resampled_data(self, code, df_daily, source=None, since=None):
+        """日线写入新数据后，从变化处增量更新该股票已有的周线/月线聚合"""
+        for timeframe in TIMEFRAMES:
+            if (code, timeframe) in self._resampled_memo or os.path.exists(self._get_resampled_path(code, timeframe)):
+                try:
+                    self.get_resampled_data(code, timeframe, df_daily=df_daily, source=source, since=since)
+                except Exception:
+                    pass
+
+    def _get_adjust_factor_path(self, code):
+        return os.path.join(self.adjust_factor_cache_dir, f"{code}.json")
+
+    def refresh_adjust_factors(self, code):
+        """从数据源重新拉取复权因子（出现新的除权除息后调用，只需重拉因子，K线不动）"""
+        try:
+            factors = self.source.adjust_factors(code)
+            if factors is None:
+                raise RuntimeError('数据源未返回复权因子')
+            cache_time = datetime.now().isoformat()
+            self.writer.put(self._get_adjust_factor_path(code), lambda: json.dumps(
+                {'cache_time': cache_time, 'code': code, 'data': factors}, ensure_ascii=False))
+            df = pd.DataFrame(factors, columns=['日期', '前复权因子', '后复权因子'])
             df['日期'] = pd.to_datetime(df['日期'])
-            for col in ['开盘','收盘','最高','最低','成交量','成交额','涨跌幅','换手率']:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-            df['成交量'] = df['成交量'].astype(float)
-            df['涨跌额'] = df['收盘'].diff()
-            df['涨跌额'] = df['涨跌额'].fillna(0)
-            df['振幅'] = ((df['最高'] - df['最低']) / df['最低'].replace(0, float('nan')) * 100).fillna(0)
-            df = df[['日期','开盘','收盘','最高','最低','成交量','成交额','振幅','涨跌幅','涨跌额','换手率']]
-            df = df.sort_values('日期')
-
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump({
-                    'cache_time': datetime.now().isoformat(),
-                    'code': code, 'start_date': start_date, 'end_date': end_date,
-                    'data': df.to_dict('records')
-                }, f, ensure_ascii=False, default=str)
+            df = df.sort_values('日期').reset_index(drop=True)
+            self._adjust_factor_memo[code] = df
             return df
         except Exception as e:
-            print(f"[ERROR] 获取 {code} 数据失败: {e}")
+            print(f"[ERROR] 获取 {code} 复权因子失败: {e}")
         return None
 
+    def get_adjust_factors(self, code):
+        """获取复权因子（每个除权除息日一行），优先内存 -> 本地缓存 -> 数据源"""
+        if code in self._adjust_factor_memo:
+            return self._adjust_factor_memo[code]
+        path = self._get_adjust_factor_path(code)
+        try:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    rows = json.load(f).get('data') or []
+                df = pd.DataFrame(rows, columns=['日期', '前复权因子', '后复权因子'])
+                df['日期'] = pd.to_datetime(df['日期'])
+                df = df.sort_values('日期').reset_index(drop=True)
+                self._adjust_factor_memo[code] = df
+                return df
+        except Exception:
+            pass
+        return self.refresh_adjust_factors(code)
+
+    def adjust_prices(self, code, df, adjust='qfq'):
+        """对原始K线做前复权/后复权（向量化：按日期查找所属除权区间的因子后整列相乘）
+
+        后复权因子在首个除权日之前为 1；前复权因子 = 后复权因子 / 最新后复权因子，
+        保证最新价格与原始价格一致
+        """
+        if adjust not in ('qfq', 'hfq'):
+            raise ValueError(f"不支持的复权方式: {adjust}")
+        factors = self.get_adjust_factors(code)
+        df = df.copy()
+        if factors is None or factors.empty:
+            return df
+        back = factors['后复权因子'].to_numpy(dtype=float)
+        idx = np.searchsorted(factors['日期'].values, pd.to_datetime(df['日期']).values, side='right') - 1
+        factor = np.where(idx >= 0, back[np.clip(idx, 0, None)], 1.0)
+        if adjust == 'qfq':
+            factor = factor / back[-1]
+        for col in ['开盘', '收盘', '最高', '最低']:
+            df[col] = df[col].astype(float) * factor
+        df['涨跌额'] = df['收盘'].diff().fillna(0)
+        return df
+
+    def _has_corporate_action(self, df_old, df_new):
+        """新数据是否出现除权除息：用 涨跌幅 反推的昨收与实际昨收不一致"""
+        closes = pd.concat([df_old['收盘'].tail(1), df_new['收盘']], ignore_index=True).astype(float)
+        prev_close = closes.shift(1).iloc[1:].to_numpy()
+        implied = df_new['收盘'].astype(float).to_numpy() / (1 + df_new['涨跌幅'].astype(float).to_numpy() / 100)
+        mask = prev_close > 0
+        return bool((np.abs(implied[mask] / prev_close[mask] - 1) > 0.005).any())
+
+    def load_snapshot(self, prefault=False):
+        """加载（内存映射）最新的全市场快照，同时恢复股票列表缓存；无快照返回 None"""
+        try:
+            snapshot = MarketSnapshot.load(self.snapshot_dir)
+        except Exception as e:
+            print(f"[WARNING] 加载快照失败: {e}")
+            return None
+        if snapshot is None:
+            return None
+        if prefault:
+            snapshot.prefault()
+        self.snapshot = snapshot
+        self._bump_data_version()
+        if snapshot.stocks and self.stock_list_cache is None:
+            self.stock_list_cache = snapshot.stocks
+            self.stock_list_cache_time = datetime.fromisoformat(snapshot.meta['created_at'])
+        return snapshot
+
+    def refresh_snapshot(self, max_age=5.0):
+        """检查快照指针（最多每 max_age 秒一次），入库生成新版本后原子切换到新版本
+
+        多个 Web 进程各自映射同一组快照文件，数据页由操作系统页缓存共享，不随进程数增加；
+        切换只是替换 self.snapshot 引用，进行中的读取继续使用旧版本（文件删除后映射仍有效）。
+        """
+        now = time.time()
+        if now - self._snapshot_checked_at < max_age:
+            return self.snapshot
+        self._snapshot_checked_at = now
+        try:
+            with open(os.path.join(self.snapshot_dir, 'CURRENT'), 'r', encoding='utf-8') as f:
+                name = f.read().strip()
+        except OSError:
+            return self.snapshot
+        current = self.snapshot
+        if current is not None and current.path and os.path.basename(current.path) == name:
+            return current
+        snapshot = self.load_snapshot()
+        if snapshot is None:
+            return current
+        if snapshot.stocks:
+            self.stock_list_cache = snapshot.stocks
+            self.stock_list_cache_time = datetime.fromisoformat(snapshot.meta['created_at'])
+        print(f"[INFO] 已切换到新快照: {snapshot.version}")
+        return snapshot
+
+    def save_snapshot(self):
+        """把本地全部日线缓存与股票列表写成新的快照版本（每日入库完成后调用）"""
+        frames = {}
+        with self.pin_cache_version() as version:  # 读同一个缓存版本（每只股票最新的一份）
+            for code, start_str, end_str, fp in self._scan_cache_files(version):
+                try:
+                    with open(fp, 'r', encoding='utf-8') as f:
+                        rows = json.load(f).get('data') or []
+                    if not rows:
+                        continue
+                    df = pd.DataFrame(rows)
+                    df['日期'] = pd.to_datetime(df['日期'])
+                    frames[code] = (df, start_str)
+                except Exception:
+                    continue
+        stocks = self.get_stock_list()
+        snapshot = MarketSnapshot.build(frames, stocks, cache_version=version)
+        path = snapshot.save(self.snapshot_dir)
+        self.snapshot = MarketSnapshot.load(self.snapshot_dir)
+        print(f"[INFO] 快照已保存: {path}（{len(snapshot.codes)} 只股票，{snapshot.meta['rows']} 行）")
+        return self.snapshot
+
+    def ensure_snapshot(self, version):
+        """返回由日线缓存版本 version 生成的快照，没有时先生成（同一版本的并发调用只生成一次）
+
+        分块回测的每一块都按日期范围从快照切片（内存映射，只读本块的行），不必每块重新解析各股票的 JSON 缓存；
+        version 已不是当前版本（回测中途发布了新版本）时生成的快照对不上，返回 None，各块回到读缓存文件
+        """
+        snapshot = self.refresh_snapshot() if self.snapshot is not None else self.load_snapshot()
+        if snapshot is not None and snapshot.cache_version == version:
+            return snapshot
+        print("[INFO] 没有与当前缓存版本一致的快照，先生成快照供分块读取")
+        try:
+            snapshot = self._loads.do(('snapshot', version), self.save_snapshot)
+        except Exception as e:
+            print(f"[WARNING] 生成快照失败: {e}")
+            return None
+        return snapshot if snapshot is not None and snapshot.cache_version == version else None
+
     def get_recent_days_data(self, code, days=10, max_retries=3):
         """获取近N天的股票数据"""
         for attempt in range(max_retries):
@@ -401,6 +1070,32 @@ class DataFetcher:
             time.sleep(1)
         return None
 
+    def get_bars(self, code, start_date=None, end_date=None, adjust=None):
+        """单只股票 [start, end] 的K线（按列，字段见 market_snapshot.BAR_FIELDS），无数据返回 None
+
+        快照覆盖该范围且不复权时直接由映射数组切片（不构建 DataFrame、不读文件、不重试）；
+        否则退回 get_stock_data（本地缓存，缺失的交易日按需补拉）
+        """
+        if end_date is None:
+            end_date = datetime.now().strftime('%Y%m%d')
+        if start_date is None:
+            start_date = (datetime.now() - timedelta(days=90)).strftime('%Y%m%d')
+        start_date = str(start_date).replace('-', '')
+        end_date = str(end_date).replace('-', '')
+        snapshot = self.refresh_snapshot() if self.snapshot is not None else None
+        if not adjust and snapshot is not None:
+            try:
+                if snapshot.covers(code, start_date, end_date, self._get_last_trading_day().replace('-', '')):
+                    bars = snapshot.bars(code, start_date, end_date)
+                    if bars is not None and bars['date']:
+                        return bars
+            except Exception:
+                pass
+        df = self.get_stock_data(code, start_date, end_date, adjust=adjust)
+        if df is None or df.empty:
+            return None
+        return frame_bars(df)
+
     def get_stock_data_by_date(self, code, date):
         """获取指定日期的股票数据"""
         try:
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据源（可替换的后端）
+
+DataFetcher 只通过 DataSource 的四个方法取数，缓存、缺口计算、快照等逻辑与数据源无关：
+    stock_list()                  全市场股票 [(code, name)]（未过滤，由 DataFetcher 过滤为主板）
+    trade_dates(start, end)       [start, end] 内的交易日（YYYY-MM-DD），失败抛异常
+    daily(code, start, end)       日线 DataFrame（DAILY_COLUMNS），请求失败返回 None，区间内无数据返回空表
+    adjust_factors(code)          复权因子 [{日期, 前复权因子, 后复权因子}]，失败返回 None
+历史时点股票池（universe.py）另外用到：
+    stock_basics()                含已退市股票的 [(code, name, 上市日, 退市日或 '')]
+    st_flags(code, start, end)    每个交易日是否为 ST [(日期, bool)]，失败返回 None
+
+实现：
+    BaostockSource   在线拉取（默认），Baostock 非线程安全，调用串行执行
+    MemorySource     内存中的日线表（测试、离线回放）
+    FileSource       本地 CSV/Parquet 全市场日线文件（离线运行）
+
+批量导入：read_bulk() 一次读入全市场日线文件（百万行级），normalize_daily() 向量化完成字段解析与
+涨跌额/振幅计算，DataFetcher.import_bulk() 按股票切分后直接写入日线缓存，不逐只请求 API。
+
+用法:
+    python data_sources.py import history.parquet                # 导入到 cache/stock_data/
+    python data_sources.py import 'dumps/*.csv' --start 20250101
+"""
+import os
+os.environ['NO_PROXY'] = '*'
+os.environ['no_proxy'] = '*'
+
+from datetime import datetime
+from threading import Lock
+import argparse
+import glob
+
+import numpy as np
+import pandas as pd
+
+try:
+    import baostock as bs
+except ImportError:
+    bs = None  # 只用离线数据源时不需要安装
+
+DAILY_COLUMNS = ['日期', '开盘', '收盘', '最高', '最低', '成交量', '成交额', '振幅', '涨跌幅', '涨跌额', '换手率']
+
+# 导入文件的列名 -> 缓存列名（同时支持 Baostock 导出的英文列名和中文列名）
+COLUMN_ALIASES = {
+    'date': '日期', 'code': '代码', 'open': '开盘', 'high': '最高', 'low': '最低', 'close': '收盘',
+    'volume': '成交量', 'amount': '成交额', 'pctChg': '涨跌幅', 'pct_chg': '涨跌幅', 'turn': '换手率',
+    'turnover': '换手率', 'amplitude': '振幅', 'change': '涨跌额', '股票代码': '代码',
+}
+
+
+def normalize_code(codes):
+    """sh.600000 / 600000.SH / 整数 600000 -> '600000'（向量化）"""
+    s = pd.Series(codes).astype(str).str.strip()
+    s = s.str.replace(r'^(sh|sz|bj)\.', '', regex=True, case=False)
+    s = s.str.replace(r'\.(sh|sz|bj)$', '', regex=True, case=False)
+    return s.str.zfill(6)
+
+
+def normalize_daily(df):
+    """原始日线（一只或多只股票）-> 缓存格式，向量化处理
+
+    数值列转为浮点（无法解析的记 0），成交量为整数股数；缺少涨跌幅时按前收盘计算，
+    涨跌额、振幅按股票分组由收盘价/最高最低价计算。含 代码 列时按 代码、日期 排序，否则按日期排序。
+    """
+    df = df.rename(columns=COLUMN_ALIASES)
+    has_code = '代码' in df.columns
+    has_pct = '涨跌幅' in df.columns
+    keep = ['日期'] + [c for c in DAILY_COLUMNS[1:] if c in df.columns] + (['代码'] if has_code else [])
+    df = df[keep].copy()
+    if has_code:
+        df['代码'] = normalize_code(df['代码']).to_numpy()
+    df['日期'] = pd.to_datetime(df['日期'])
+    for col in ['开盘', '收盘', '最高', '最低', '成交量', '成交额', '涨跌幅', '换手率']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+        else:
+            df[col] = 0.0
+    df['成交量'] = df['成交量'].round().astype('int64')  # 成交量为股数，用整数存储
+    keys = ['代码', '日期'] if has_code else ['日期']
+    df = df.drop_duplicates(subset=keys, keep='first').sort_values(keys).reset_index(drop=True)
+    prev_close = df.groupby('代码')['收盘'].shift(1) if has_code else df['收盘'].shift(1)
+    if not has_pct:
+        df['涨跌幅'] = ((df['收盘'] / prev_close.replace(0, np.nan) - 1) * 100).fillna(0)
+    df['涨跌额'] = (df['收盘'] - prev_close).fillna(0)
+    df['振幅'] = ((df['最高'] - df['最低']) / df['最低'].replace(0, np.nan) * 100).fillna(0)
+    return df[DAILY_COLUMNS + (['代码'] if has_code else [])]
+
+
+def _empty_daily():
+    return pd.DataFrame(columns=DAILY_COLUMNS)
+
+
+def read_bulk(paths):
+    """读取一个或多个全市场日线文件（CSV/Parquet，可用通配符），返回含 代码 列的缓存格式 DataFrame"""
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for p in paths:
+        files.extend(sorted(glob.glob(p)) or [p])
+    parts = []
+    for path in files:
+        if path.endswith(('.parquet', '.pq')):
+            parts.append(pd.read_parquet(path))  # 需要 pyarrow 或 fastparquet
+        else:
+            parts.append(pd.read_csv(path, dtype={'code': str, '代码': str, '股票代码': str}))
+    if not parts:
+        raise FileNotFoundError(f'没有找到数据文件: {paths}')
+    df = normalize_daily(pd.concat(parts, ignore_index=True))
+    if '代码' not in df.columns:
+        raise ValueError('全市场日线文件需要 code/代码 列')
+    return df
+
+
+class DataSource:
+    """数据源接口"""
+
+    name = 'base'
+
+    def login(self):
+        return True
+
+    def stock_list(self):
+        raise NotImplementedError
+
+    def trade_dates(self, start_date, end_date):
+        raise NotImplementedError
+
+    def daily(self, code, start_date, end_date):
+        raise NotImplementedError
+
+    def adjust_factors(self, code):
+        return []
+
+    def stock_basics(self):
+        raise NotImplementedError
+
+    def st_flags(self, code, start_date, end_date):
+        return None
+
+
+class BaostockSource(DataSource):
+    """Baostock 在线数据源；Baostock 非线程安全，并发请求会混淆数据，所有调用加锁串行"""
+
+    name = 'baostock'
+
+    def __init__(self):
+        self._lock = Lock()
+        self._logged_in = False
+
+    def _ensure_login(self):
+        if bs is None:
+            raise RuntimeError('未安装 baostock（pip install baostock），或改用离线数据源')
+        if not self._logged_in:
+            lg = bs.login()
+            self._logged_in = (lg.error_code == '0')
+
+    def login(self):
+        with self._lock:
+            self._ensure_login()
+        return self._logged_in
+
+    @staticmethod
+    def _to_bs_code(code):
+        return f"sh.{code}" if code.startswith('6') else f"sz.{code}"
+
+    def _query(self, method, **kwargs):
+        """执行一次 Baostock 查询并取回全部行，返回 (error_code, error_msg, rows)"""
+        with self._lock:
+            self._ensure_login()
+            rs = getattr(bs, method)(**kwargs)
+            rows = []
+            while rs.error_code == '0' and rs.next():
+                rows.append(rs.get_row_data())
+        return rs.error_code, getattr(rs, 'error_msg', ''), rows
+
+    def stock_list(self):
+        error_code, error_msg, rows = self._query('query_all_stock', day=datetime.now().strftime('%Y-%m-%d'))
+        if error_code != '0':
+            raise RuntimeError(error_msg or error_code)
+        # 字段: code(sh.600000), tradeStatus, code_name
+        return [(r[0].split('.')[-1] if '.' in r[0] else r[0], r[2]) for r in rows]
+
+    def stock_basics(self):
+        error_code, error_msg, rows = self._query('query_stock_basic')
+        if error_code != '0':
+            raise RuntimeError(error_msg or error_code)
+        # 字段: code, code_name, ipoDate, outDate, type（1 股票）, status
+        return [(r[0].split('.')[-1], r[1], r[2], r[3] or '') for r in rows if r[4] == '1']
+
+    def st_flags(self, code, start_date, end_date):
+        try:
+            error_code, _, rows = self._query(
+                'query_history_k_data_plus', code=self._to_bs_code(code), fields='date,isST',
+                start_date=_dash(start_date), end_date=_dash(end_date), frequency='d', adjustflag='3')
+            if error_code != '0':
+                return None
+            return [(r[0], r[1] == '1') for r in rows]
+        except Exception:
+            return None
+
+    def trade_dates(self, start_date, end_date):
+        error_code, error_msg, rows = self._query('query_trade_dates', start_date=_dash(start_date),
+                                                  end_date=_dash(end_date))
+        if error_code != '0' or not rows:
+            raise RuntimeError(error_msg or '无数据')
+        return [r[0] for r in rows if r[1] == '1']
+
+    def daily(self, code, start_date, end_date):
+        try:
+            error_code, _, rows = self._query(
+                'query_history_k_data_plus', code=self._to_bs_code(code),
+                fields="date,open,high,low,close,volume,amount,pctChg,turn",
+                start_date=_dash(start_date), end_date=_dash(end_date), frequency="d", adjustflag="3")
+            if error_code != '0':
+                return None
+            if not rows:
+                return _empty_daily()
+            return normalize_daily(pd.DataFrame(rows, columns=['date', 'open', 'high', 'low', 'close', 'volume',
+                                                               'amount', 'pctChg', 'turn']))
+        except Exception:
+            return None
+
+    def adjust_factors(self, code):
+        error_code, error_msg, rows = self._query('query_adjust_factor', code=self._to_bs_code(code),
+                                                  start_date='1990-01-01',
+                                                  end_date=datetime.now().strftime('%Y-%m-%d'))
+        if error_code != '0':
+            raise RuntimeError(error_msg or error_code)
+        # 字段: code, dividOperateDate, foreAdjustFactor, backAdjustFactor, adjustFactor
+        return [{'日期': r[1], '前复权因子': float(r[2]), '后复权因子': float(r[3])} for r in rows if r[1]]
+
+
+class MemorySource(DataSource):
+    """内存中的全市场日线（含 代码 列的 DataFrame 或 {code: DataFrame}），交易日历为全部日期的并集"""
+
+    name = 'memory'
+
+    def __init__(self, data, names=None, factors=None):
+        """
+        Args:
+            data: 含 代码/code 列的日线表，或 {code: 日线表}（列名可为中文或 Baostock 英文列名）
+            names: {code: 名称}
+            factors: {code: [{日期, 前复权因子, 后复权因子}]}
+        """
+        if isinstance(data, dict):
+            data = pd.concat([df.assign(代码=code) for code, df in data.items()], ignore_index=True) \
+                if data else pd.DataFrame(columns=DAILY_COLUMNS + ['代码'])
+        self._set(normalize_daily(data) if len(data) else data, names, factors)
+
+    def _set(self, df, names=None, factors=None):
+        self.df = df
+        codes = df['代码'].to_numpy().astype(str)
+        codes, starts = np.unique(codes, return_index=True)  # df 按 代码 排序
+        self.codes = codes.tolist()
+        self._bounds = dict(zip(self.codes, zip(starts, list(starts[1:]) + [len(df)])))
+        self.calendar = np.unique(df['日期'].to_numpy().astype('datetime64[D]'))
+        self.names = names or {}
+        self.factors = factors or {}
+
+    def stock_list(self):
+        return [(code, self.names.get(code, code)) for code in self.codes]
+
+    def trade_dates(self, start_date, end_date):
+        lo = np.searchsorted(self.calendar, np.datetime64(_dash(start_date)), side='left')
+        hi = np.searchsorted(self.calendar, np.datetime64(_dash(end_date)), side='right')
+        return [str(d) for d in self.calendar[lo:hi]]
+
+    def daily(self, code, start_date, end_date):
+        bounds = self._bounds.get(code)
+        if bounds is None:
+            return _empty_daily()
+        part = self.df.iloc[bounds[0]:bounds[1]]
+        dates = part['日期']
+        part = part[(dates >= pd.Timestamp(_dash(start_date))) & (dates <= pd.Timestamp(_dash(end_date)))]
+        return part[DAILY_COLUMNS].reset_index(drop=True)
+
+    def adjust_factors(self, code):
+        return list(self.factors.get(code, []))
+
+    def stock_basics(self):
+        """上市日取首个数据日；末个数据日早于日历最后一天的视为已退市"""
+        last_day = str(self.calendar[-1]) if len(self.calendar) else ''
+        dates = self.df['日期'].dt.strftime('%Y-%m-%d').to_numpy()
+        basics = []
+        for code in self.codes:
+            lo, hi = self._bounds[code]
+            out = dates[hi - 1] if dates[hi - 1] < last_day else ''
+            basics.append((code, self.names.get(code, code), dates[lo], out))
+        return basics
+
+
+class FileSource(MemorySource):
+    """本地 CSV/Parquet 全市场日线文件（首次使用时一次性读入）"""
+
+    name = 'file'
+
+    def __init__(self, paths, names=None):
+        self.paths = paths
+        self._pending_names = names
+        self._loaded = False
+        self._load_lock = Lock()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._load_lock:
+                if not self._loaded:
+                    self._set(read_bulk(self.paths), self._pending_names)
+                    self._loaded = True
+
+    def stock_list(self):
+        self._ensure_loaded()
+        return super().stock_list()
+
+    def trade_dates(self, start_date, end_date):
+        self._ensure_loaded()
+        return super().trade_dates(start_date, end_date)
+
+    def daily(self, code, start_date, end_date):
+        self._ensure_loaded()
+        return super().daily(code, start_date, end_date)
+
+    def stock_basics(self):
+        self._ensure_loaded()
+        return super().stock_basics()
+
+
+def _dash(date_str):
+    """yyyymmdd / YYYY-MM-DD -> YYYY-MM-DD"""
+    s = str(date_str).replace('-', '')[:8]
+    return f"{s[:4]}-{s[4:6]}-{s[6:]}"
+
+
+def main():
+    from data_fetcher import DataFetcher
+
+    parser = argparse.ArgumentParser(description='数据源工具')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('import', help='把全市场日线文件（CSV/Parquet）批量导入日线缓存')
+    p.add_argument('paths', nargs='+', help='文件路径（可用通配符）')
+    p.add_argument('--start', default=None, help='只导入该日期之后的数据 yyyymmdd')
+    p.add_argument('--end', default=None, help='只导入该日期之前的数据 yyyymmdd')
+    p.add_argument('--no-calendar', action='store_true', help='文件不是全市场时使用：不补充交易日历、不记停牌、不重算市场宽度')
+    p.add_argument('--snapshot', action='store_true', help='导入后生成快照')
+    args = parser.parse_args()
+
+    fetcher = DataFetcher()
+    start = datetime.now()
+    df = read_bulk(args.paths)
+    print(f"[INFO] 已读取 {len(df)} 行，{df['代码'].nunique()} 只股票，耗时 {(datetime.now() - start).total_seconds():.1f}s")
+    stats = fetcher.import_bulk(df, start_date=args.start, end_date=args.end, full_market=not args.no_calendar)
+    print(f"[INFO] 导入完成: {stats}")
+    if args.snapshot:
+        fetcher.save_snapshot()
+
+
+if __name__ == '__main__':
+    main()
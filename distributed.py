@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分片回测：协调者 / 工作节点
+
+每个工作节点负责一部分股票（按代码取模分片），使用各自的本地数据缓存；
+协调者把策略广播给所有节点，汇总各分片结果并按 backtest 相同的顺序（符合日期、代码）合并。
+
+通信为普通 TCP：每条消息 = 4 字节大端长度 + UTF-8 JSON。
+
+截面排名条件依赖全市场数据，不支持分片；市场宽度条件读取各节点本地的
+cache/market_breadth.json，需保证其为全市场数据（例如从入库节点复制）。
+
+启动工作节点（同一台机器上可起多个）:
+    python distributed.py worker --port 9001 --shard 0/3
+    python distributed.py worker --port 9002 --shard 1/3 --cache-dir /data/cache_1
+    python distributed.py worker --port 9003 --shard 2/3
+
+协调者执行回测:
+    python distributed.py coordinator --workers 127.0.0.1:9001,127.0.0.1:9002,127.0.0.1:9003 --strategy strategy.json
+"""
+import os
+os.environ['NO_PROXY'] = '*'
+os.environ['no_proxy'] = '*'
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+import argparse
+import json
+import socket
+import socketserver
+import struct
+import time
+
+from cross_section import has_cross_sectional
+
+_HEADER = struct.Struct('>I')
+
+
+def send_msg(sock, obj):
+    data = json.dumps(obj, ensure_ascii=False, default=str).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError('连接已关闭')
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def recv_msg(sock):
+    (length,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, length).decode('utf-8'))
+
+
+def in_shard(code, shard_index, shard_count):
+    """股票是否属于该分片（按6位代码取模，协调者与各节点无需交换股票列表）"""
+    return int(code) % shard_count == shard_index
+
+
+class BacktestWorker:
+    """工作节点：只回测自己分片内的股票"""
+
+    def __init__(self, shard_index, shard_count, host='127.0.0.1', port=9001, cache_dir=None, max_workers=30):
+        from data_fetcher import DataFetcher
+        from strategy_engine import StrategyEngine
+
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.host = host
+        self.port = port
+        self.data_fetcher = DataFetcher(cache_dir=cache_dir)
+        self.strategy_engine = StrategyEngine(self.data_fetcher, max_workers=max_workers)
+        self._run_lock = Lock()  # 同一节点同时只跑一个回测，避免线程池叠加
+        self.server = None
+
+    def shard_stocks(self, strategy=None):
+        """本分片的股票；已建立历史时点股票池时按回测窗口取（含已退市的股票）"""
+        stocks = None
+        if strategy is not None:
+            engine = self.strategy_engine
+            start_date, end_date = engine.get_backtest_window(strategy.get('timeRange', 30),
+                                                              conditions=strategy.get('conditions', []))
+            stocks, _ = engine.resolve_universe(strategy, start_date, end_date)
+        return [s for s in (stocks if stocks is not None else self.data_fetcher.get_stock_list())
+                if in_shard(s['code'], self.shard_index, self.shard_count)]
+
+    def handle(self, msg):
+        cmd = msg.get('cmd')
+        if cmd == 'ping':
+            return {'success': True, 'shard': [self.shard_index, self.shard_count]}
+        if cmd == 'backtest':
+            strategy = msg.get('strategy', {})
+            name = msg.get('strategy_name') or f"策略_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            with self._run_lock:
+                stocks = self.shard_stocks(strategy)
+                results = self.strategy_engine.backtest(
+                    strategy, strategy_name=f"{name}_分片{self.shard_index}of{self.shard_count}", stocks=stocks)
+            return {'success': True, 'shard': [self.shard_index, self.shard_count],
+                    'checked': len(stocks), 'data': results}
+        return {'success': False, 'error': f'未知命令: {cmd}'}
+
+    def serve_forever(self):
+        worker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    while True:
+                        msg = recv_msg(self.request)
+                        try:
+                            reply = worker.handle(msg)
+                        except Exception as e:
+                            reply = {'success': False, 'error': str(e)}
+                        send_msg(self.request, reply)
+                except ConnectionError:
+                    pass
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        print(f'[INFO] 工作节点已启动 {self.host}:{self.port}，分片 {self.shard_index}/{self.shard_count}')
+        self.server.serve_forever()
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class BacktestCoordinator:
+    """协调者：广播策略并按 backtest 的顺序合并各分片结果"""
+
+    def __init__(self, workers, timeout=None, results_dir=None):
+        self.workers = workers  # [(host, port), ...]
+        self.timeout = timeout
+        self.results_dir = results_dir or os.path.join(os.path.dirname(__file__), 'results')
+        os.makedirs(self.results_dir, exist_ok=True)
+
+    def _call(self, worker, msg):
+        host, port = worker
+        with socket.create_connection((host, port), timeout=self.timeout) as sock:
+            sock.settimeout(self.timeout)
+            send_msg(sock, msg)
+            return recv_msg(sock)
+
+    def _broadcast(self, msg):
+        with ThreadPoolExecutor(max_workers=len(self.workers)) as executor:
+            return list(executor.map(lambda w: self._call(w, msg), self.workers))
+
+    def ping(self):
+        return self._broadcast({'cmd': 'ping'})
+
+    def backtest(self, strategy, strategy_name=None):
+        """分片回测，返回与单机 backtest 相同顺序的结果；任一分片失败则报错（不返回不完整结果）"""
+        from strategy_engine import sort_results, write_results_file
+
+        if has_cross_sectional(strategy.get('conditions', [])):
+            raise ValueError('截面排名条件依赖全市场数据，不支持分片回测')
+        if strategy_name is None:
+            strategy_name = f"策略_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+        start_time = time.time()
+        replies = self._broadcast({'cmd': 'backtest', 'strategy': strategy, 'strategy_name': strategy_name})
+        shards = set()
+        results, checked = [], 0
+        for worker, reply in zip(self.workers, replies):
+            if not reply.get('success'):
+                raise RuntimeError(f"节点 {worker[0]}:{worker[1]} 回测失败: {reply.get('error')}")
+            shards.add(tuple(reply['shard']))
+            checked += reply.get('checked', 0)
+            results.extend(reply.get('data') or [])
+        counts = {count for _, count in shards}
+        if len(counts) != 1 or len(shards) != counts.pop():
+            raise RuntimeError(f'分片不完整或重复: {sorted(shards)}')
+
+        sort_results(results)
+        print(f'分片回测完成: {len(self.workers)} 个节点，共检查 {checked} 只股票，'
+              f'找到 {len(results)} 只符合条件的股票，耗时 {time.time() - start_time:.1f} 秒')
+        if results:
+            filepath = os.path.join(self.results_dir, f"{strategy_name}_结果.jsonl")
+            write_results_file(filepath, strategy_name, results)
+            print(f'结果已保存（按符合日期排序）: {filepath}')
+        return results
+
+
+def _parse_workers(text):
+    workers = []
+    for item in text.split(','):
+        host, port = item.strip().rsplit(':', 1)
+        workers.append((host, int(port)))
+    return workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分片回测：协调者 / 工作节点')
+    sub = parser.add_subparsers(dest='role', required=True)
+
+    w = sub.add_parser('worker', help='启动工作节点')
+    w.add_argument('--host', default='127.0.0.1')
+    w.add_argument('--port', type=int, required=True)
+    w.add_argument('--shard', required=True, help='分片，如 0/3')
+    w.add_argument('--cache-dir', default=None, help='本节点的数据缓存目录')
+    w.add_argument('--max-workers', type=int, default=30)
+
+    c = sub.add_parser('coordinator', help='广播策略并合并结果')
+    c.add_argument('--workers', required=True, help='host:port,host:port,...')
+    c.add_argument('--strategy', required=True, help='策略 JSON 文件')
+    c.add_argument('--name', default=None, help='策略名称')
+
+    args = parser.parse_args()
+    if args.role == 'worker':
+        index, count = (int(x) for x in args.shard.split('/'))
+        BacktestWorker(index, count, host=args.host, port=args.port,
+                       cache_dir=args.cache_dir, max_workers=args.max_workers).serve_forever()
+    else:
+        with open(args.strategy, 'r', encoding='utf-8') as f:
+            strategy = json.load(f)
+        BacktestCoordinator(_parse_workers(args.workers)).backtest(strategy, strategy_name=args.name)
+
+
+if __name__ == '__main__':
+    main()
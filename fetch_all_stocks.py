@@ -40,7 +40,7 @@ def main():
     success_count = 0
     start_time = time.time()
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    with fetcher.cache_batch(), ThreadPoolExecutor(max_workers=10) as executor:
         futures = {
             executor.submit(fetch_one, s, start_str, end_str, fetcher): s
             for s in stocks
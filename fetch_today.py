@@ -13,6 +13,8 @@ from data_fetcher import DataFetcher
 if __name__ == '__main__':
     print(f'[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] 拉取今日数据并入缓存\n')
     fetcher = DataFetcher()
-    fetcher.remove_duplicate_cache()
-    fetcher.update_caches_with_today_data(max_workers=10)
+    with fetcher.cache_batch():  # 全部写完后一次发布新缓存版本，期间 Web 服务的回测读旧版本
+        fetcher.remove_duplicate_cache()
+        fetcher.update_caches_with_today_data(max_workers=10)
+    fetcher.save_snapshot()
     print(f'\n[{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}] 完成')
@@ -0,0 +1,105 @@
+"""
+HTTP 响应缓存与压缩
+
+序列化后的响应体按 (接口, 参数) 缓存在服务端，绑定数据版本（DataFetcher.get_data_version），
+下一次入库后自动失效。缓存项带强 ETag（响应体哈希）与 Last-Modified（数据版本时间），
+浏览器带 If-None-Match / If-Modified-Since 复查时直接返回 304；压缩结果按编码缓存，只压缩一次。
+
+压缩支持 gzip（标准库）和 br（需安装 brotli，未安装时只用 gzip）。
+"""
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from threading import Lock
+import gzip
+import hashlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # 未安装 brotli 时只提供 gzip
+
+MIN_COMPRESS_SIZE = 1024  # 小于 1KB 的响应不压缩
+
+
+def choose_encoding(accept_encoding):
+    """按客户端 Accept-Encoding 选择压缩方式：br 优先，其次 gzip，不支持返回 None"""
+    accepted = {part.split(';')[0].strip().lower() for part in (accept_encoding or '').split(',')}
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+class CachedBody:
+    """一个序列化好的响应体及其压缩版本"""
+
+    def __init__(self, body, last_modified):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.last_modified = int(last_modified)  # 秒级，与 HTTP 日期精度一致
+        self._encoded = {}
+        self._lock = Lock()
+
+    @property
+    def last_modified_http(self):
+        return formatdate(self.last_modified, usegmt=True)
+
+    def encoded(self, encoding):
+        """返回 (响应体, 实际使用的编码)；小响应不压缩"""
+        if encoding is None or len(self.body) < MIN_COMPRESS_SIZE:
+            return self.body, None
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = compress(self.body, encoding)
+            return self._encoded[encoding], encoding
+
+    def not_modified(self, if_none_match, if_modified_since):
+        """条件请求是否命中（If-None-Match 优先）"""
+        if if_none_match:
+            tags = {t.strip() for t in if_none_match.split(',')}
+            return '*' in tags or self.etag in tags or f'W/{self.etag}' in tags
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.last_modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class ResponseCache:
+    """按 key 缓存响应体，每个 key 只保留最新数据版本的一份；超出容量时淘汰最久未用的"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (version, CachedBody)
+        self._lock = Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key, version, body, last_modified):
+        entry = CachedBody(body, last_modified)
+        with self._lock:
+            self._entries[key] = (version, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,138 @@
+"""
+市场宽度（每个交易日的全市场统计）
+
+在数据入库时计算并持久化到 cache/market_breadth.json，每日只重算最新日期及之后的数据；
+查询和策略条件判断只是一次字典查找。
+
+指标：
+    stock_count             当日有数据的股票数
+    limit_up_count          涨停家数（涨幅 ≥ 9.8%）
+    limit_down_count        跌停家数（涨幅 ≤ -9.8%）
+    limit_up_failed         炸板家数（最高价触及涨停但收盘未封住）
+    limit_up_failure_rate   炸板率 %（炸板 / (涨停 + 炸板)）
+    advancers / decliners / flat   上涨 / 下跌 / 平盘家数
+    advance_decline_ratio   涨跌比（上涨 / 下跌）
+    total_amount            全市场成交额
+"""
+from datetime import datetime
+from threading import Lock
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+LIMIT_PCT = 9.8  # 与策略引擎的涨停判断一致
+
+METRICS = ['stock_count', 'limit_up_count', 'limit_down_count', 'limit_up_failed', 'limit_up_failure_rate',
+           'advancers', 'decliners', 'flat', 'advance_decline_ratio', 'total_amount']
+
+
+def compute_breadth(frames):
+    """由多只股票的日线计算每日宽度指标（向量化 groupby），返回按日期排序的 DataFrame"""
+    parts = [df[['日期', '收盘', '最高', '涨跌幅', '成交额']] for df in frames if df is not None and not df.empty]
+    if not parts:
+        return pd.DataFrame(columns=['日期'] + METRICS)
+    rows = pd.concat(parts, ignore_index=True)
+    rows['日期'] = pd.to_datetime(rows['日期'])
+    pct = rows['涨跌幅'].astype(float)
+    pre_close = rows['收盘'].astype(float) / (1 + pct / 100)
+    touched = (rows['最高'].astype(float) / pre_close.replace(0, np.nan) - 1) * 100 >= LIMIT_PCT
+    limit_up = pct >= LIMIT_PCT
+    stats = pd.DataFrame({
+        '日期': rows['日期'],
+        'stock_count': 1,
+        'limit_up_count': limit_up.astype(int),
+        'limit_down_count': (pct <= -LIMIT_PCT).astype(int),
+        'limit_up_failed': (touched & ~limit_up).astype(int),
+        'advancers': (pct > 0).astype(int),
+        'decliners': (pct < 0).astype(int),
+        'flat': (pct == 0).astype(int),
+        'total_amount': rows['成交额'].astype(float),
+    }).groupby('日期').sum().reset_index()
+    attempts = stats['limit_up_count'] + stats['limit_up_failed']
+    stats['limit_up_failure_rate'] = (stats['limit_up_failed'] / attempts.replace(0, np.nan) * 100).fillna(0)
+    stats['advance_decline_ratio'] = (stats['advancers'] / stats['decliners'].replace(0, np.nan)).fillna(0)
+    return stats[['日期'] + METRICS].sort_values('日期').reset_index(drop=True)
+
+
+class MarketBreadth:
+    """按交易日存储的市场宽度表"""
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'market_breadth.json')
+        self._lock = Lock()
+        self._table = None  # {'YYYY-MM-DD': {metric: value}}
+        self._mtime = None
+
+    def _load(self):
+        """读取宽度表（文件被其他进程更新后重新读取，如每日任务写入后 Web 服务读到新数据）"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if self._table is not None and mtime == self._mtime:
+            return self._table
+        with self._lock:
+            if self._table is None or mtime != self._mtime:
+                table = {}
+                try:
+                    if mtime is not None:
+                        with open(self.path, 'r', encoding='utf-8') as f:
+                            for r in json.load(f).get('data') or []:
+                                table[r['日期']] = {k: r[k] for k in METRICS if k in r}
+                except Exception as e:
+                    print(f"[WARNING] 读取市场宽度失败: {e}")
+                    if self._table is not None:
+                        return self._table
+                self._table = table
+                self._mtime = mtime
+        return self._table
+
+    def latest_date(self):
+        table = self._load()
+        return max(table) if table else None
+
+    def update(self, frames, since=None):
+        """用入库数据更新宽度表：只重算 since（默认为已存最新日期）及之后的交易日
+
+        frames 需包含全市场股票在这些日期的日线，否则当日统计不完整
+        """
+        table = dict(self._load())
+        if since is None:
+            since = self.latest_date()
+        if since is not None:
+            since_ts = pd.Timestamp(since)
+            frames = [df[pd.to_datetime(df['日期']) >= since_ts] for df in frames if df is not None and not df.empty]
+        stats = compute_breadth(frames)
+        for r in stats.to_dict('records'):
+            date_str = pd.Timestamp(r.pop('日期')).strftime('%Y-%m-%d')
+            table[date_str] = {k: (int(v) if isinstance(v, (np.integer, int)) else float(v)) for k, v in r.items()}
+        self._save(table)
+        return len(stats)
+
+    def _save(self, table):
+        data = [{'日期': d, **table[d]} for d in sorted(table)]
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'  # 每日任务与 Web 服务可能同时更新
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'cache_time': datetime.now().isoformat(), 'data': data}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        with self._lock:
+            self._table = table
+            self._mtime = os.path.getmtime(self.path)
+
+    def get(self, date):
+        """某个交易日的全部指标，无数据返回 None"""
+        if not isinstance(date, str):
+            date = pd.Timestamp(date).strftime('%Y-%m-%d')
+        return self._load().get(date)
+
+    def value(self, date, metric):
+        row = self.get(date)
+        return None if row is None else row.get(metric)
+
+    def query(self, start_date=None, end_date=None):
+        """按日期范围查询（YYYY-MM-DD，含两端），返回按日期排序的列表"""
+        table = self._load()
+        return [{'日期': d, **table[d]} for d in sorted(table)
+                if (start_date is None or d >= start_date) and (end_date is None or d <= end_date)]
@@ -0,0 +1,322 @@
+"""
+全市场数据快照（二进制、紧凑、可内存映射）
+
+每日入库完成后把所有股票的日线缓存合并为列式数组写入 cache/snapshot/<版本>/：
+    calendar.npy         交易日历（datetime64[D]，全部股票日期的并集，升序）
+    day_idx.npy          每行的交易日序号（int32，指向 calendar），代替逐行存时间戳
+    offsets.npy          第 i 只股票的行范围为 [offsets[i], offsets[i+1])，行按 股票、日期 排序；
+                         代码只在 meta.json 的 codes 字典中存一份（相当于分类编码），不逐行重复
+    starts.npy           每只股票日线缓存覆盖的起始日期（yyyymmdd），用于判断请求范围是否被覆盖
+    col<i>.npy           各数据列，类型见 COLUMN_DTYPES
+    meta.json            格式版本、快照版本、代码字典、股票列表、生成快照时读取的日线缓存版本
+cache/snapshot/CURRENT 记录当前版本目录名，原子替换。
+
+精度说明：
+    开盘/收盘/最高/最低/涨跌额 用 float32（24 位有效位，相对误差 ≤ 6e-8）。1024 元以下相邻两个 float32
+    的间隔 ≤ 1.2e-4，误差 ≤ 6.1e-5，读取时按 4 位小数取整即还原交易所报价（2~4 位小数，3~4 位的只有基金等
+    低价品种）；1024 元以上间隔超过 1.2e-4，4 位小数不再可靠，改按 2 位小数（股票的最小报价单位 0.01）取整，
+    131072 元以下误差 < 0.004，小于 0.005，还原同样无损（见 _restore_prices）。
+    涨跌幅/振幅/换手率 用 float32，数值 < 16 时绝对误差 ≤ 1e-6，< 512 时 ≤ 3e-5，不影响 9.8% 等阈值判断。
+    成交量 用 int64（股数，精确）；成交额 保留 float64（数值可达 1e10，float32 误差过大）。
+每行 52 字节，原 DataFrame（11 列 float64/时间戳）为 88 字节，另省去逐行的代码字符串。
+
+服务启动时用 np.load(mmap_mode='r') 映射，几乎不耗时，首次回测即可直接从快照切片。
+多个 Web 进程映射同一版本时共享操作系统页缓存中的同一份数据页，内存不随进程数增加；
+新版本写入独立目录后原子替换 CURRENT，各进程检查到指针变化后切换（DataFetcher.refresh_snapshot）。
+"""
+from datetime import datetime
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_COLUMNS = ['开盘', '收盘', '最高', '最低', '成交量', '成交额', '振幅', '涨跌幅', '涨跌额', '换手率']
+COLUMN_DTYPES = {
+    '开盘': np.float32, '收盘': np.float32, '最高': np.float32, '最低': np.float32, '涨跌额': np.float32,
+    '振幅': np.float32, '涨跌幅': np.float32, '换手率': np.float32,
+    '成交量': np.int64, '成交额': np.float64,
+}
+PRICE_COLUMNS = ['开盘', '收盘', '最高', '最低', '涨跌额']
+# K线接口（/api/stock/<code>/bars）的字段名，与 get_today_data 一致
+BAR_FIELDS = {'开盘': 'open', '收盘': 'close', '最高': 'high', '最低': 'low', '成交量': 'volume', '成交额': 'amount',
+              '振幅': 'amplitude', '涨跌幅': 'pct_change', '涨跌额': 'change', '换手率': 'turnover'}
+_COLUMN_FILES = {col: f'col{i}.npy' for i, col in enumerate(SNAPSHOT_COLUMNS)}  # 文件名避免中文
+KEEP_VERSIONS = 2  # 保留最近几个版本（旧版本可能仍被读取）
+FOUR_DECIMAL_LIMIT = 1024  # float32 在此以下的间隔 ≤ 1.2e-4，按 4 位小数还原无损
+
+
+def _restore_prices(values):
+    """float32 价格还原为 float64：1024 元以下按 4 位小数取整，以上按 2 位小数取整（见模块说明）"""
+    values = values.astype(np.float64)
+    return np.where(np.abs(values) < FOUR_DECIMAL_LIMIT, values.round(4), values.round(2))
+
+
+class MarketSnapshot:
+    """全市场日线的列式快照"""
+
+    def __init__(self, meta, arrays, path=None):
+        self.meta = meta
+        self.arrays = arrays
+        self.path = path
+        self.version = meta['version']
+        self.codes = meta['codes']
+        self.stocks = meta.get('stocks') or []
+        self._index = {code: i for i, code in enumerate(self.codes)}
+        self.last_date = meta.get('last_date')
+        self.cache_version = meta.get('cache_version')  # 由哪个日线缓存版本生成（旧快照为 None）
+
+    @classmethod
+    def build(cls, frames, stocks=None, cache_version=None):
+        """由 {code: (df, cache_start_str)} 构建快照（内存中）；cache_version 为读取的日线缓存版本"""
+        codes = sorted(code for code, (df, _) in frames.items() if df is not None and not df.empty)
+        lengths = [len(frames[c][0]) for c in codes]
+        offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        parts = [frames[c][0].sort_values('日期') for c in codes]
+        arrays = {
+            'offsets': offsets,
+            'starts': np.array([int(frames[c][1]) for c in codes], dtype=np.int32),
+        }
+        if parts:
+            merged = pd.concat(parts, ignore_index=True)
+            dates = pd.to_datetime(merged['日期']).values.astype('datetime64[D]')
+            calendar = np.unique(dates)
+            arrays['calendar'] = calendar
+            arrays['day_idx'] = np.searchsorted(calendar, dates).astype(np.int32)
+            for col in SNAPSHOT_COLUMNS:
+                values = pd.to_numeric(merged[col], errors='coerce').fillna(0)
+                if np.issubdtype(COLUMN_DTYPES[col], np.integer):
+                    values = values.round()
+                arrays[col] = values.to_numpy().astype(COLUMN_DTYPES[col])
+        else:
+            arrays['calendar'] = np.array([], dtype='datetime64[D]')
+            arrays['day_idx'] = np.array([], dtype=np.int32)
+            for col in SNAPSHOT_COLUMNS:
+                arrays[col] = np.array([], dtype=COLUMN_DTYPES[col])
+        last_date = str(arrays['calendar'][-1]) if len(arrays['calendar']) else None
+        meta = {
+            'format': SNAPSHOT_FORMAT,
+            'version': datetime.now().strftime('%Y%m%d_%H%M%S_%f'),
+            'created_at': datetime.now().isoformat(),
+            'last_date': last_date,
+            'rows': int(offsets[-1]),
+            'codes': codes,
+            'stocks': stocks or [],
+            'cache_version': cache_version,
+        }
+        return cls(meta, arrays)
+
+    def save(self, root):
+        """写入新版本目录并原子切换 CURRENT，清理更早的版本"""
+        os.makedirs(root, exist_ok=True)
+        name = f"v{self.version}"
+        tmp_dir = os.path.join(root, f".{name}.tmp")
+        final_dir = os.path.join(root, name)
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, 'calendar.npy'), self.arrays['calendar'])
+        np.save(os.path.join(tmp_dir, 'day_idx.npy'), self.arrays['day_idx'])
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), self.arrays['offsets'])
+        np.save(os.path.join(tmp_dir, 'starts.npy'), self.arrays['starts'])
+        for col, filename in _COLUMN_FILES.items():
+            np.save(os.path.join(tmp_dir, filename), self.arrays[col])
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(tmp_dir, final_dir)
+
+        pointer_tmp = os.path.join(root, f'CURRENT.{os.getpid()}.tmp')  # 多个进程同时保存时各写各的临时文件
+        with open(pointer_tmp, 'w', encoding='utf-8') as f:
+            f.write(name)
+        os.replace(pointer_tmp, os.path.join(root, 'CURRENT'))
+        self.path = final_dir
+
+        versions = sorted(d for d in os.listdir(root) if d.startswith('v') and os.path.isdir(os.path.join(root, d)))
+        for old in versions[:-KEEP_VERSIONS]:
+            shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+        return final_dir
+
+    @classmethod
+    def load(cls, root, mmap=True):
+        """加载 CURRENT 指向的版本（默认内存映射），无快照返回 None"""
+        pointer = os.path.join(root, 'CURRENT')
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer, 'r', encoding='utf-8') as f:
+            path = os.path.join(root, f.read().strip())
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('format') != SNAPSHOT_FORMAT:
+            print(f"[WARNING] 快照格式不兼容（{meta.get('format')}），请重新生成")
+            return None
+        mode = 'r' if mmap else None
+        arrays = {
+            'calendar': np.load(os.path.join(path, 'calendar.npy')),
+            'day_idx': np.load(os.path.join(path, 'day_idx.npy'), mmap_mode=mode),
+            'offsets': np.load(os.path.join(path, 'offsets.npy')),
+            'starts': np.load(os.path.join(path, 'starts.npy')),
+        }
+        for col, filename in _COLUMN_FILES.items():
+            arrays[col] = np.load(os.path.join(path, filename), mmap_mode=mode)
+        return cls(meta, arrays, path=path)
+
+    def prefault(self):
+        """顺序读一遍映射的数组，把数据页读入内存，之后的随机切片不再触发磁盘读"""
+        total = float(np.asarray(self.arrays['day_idx']).sum())
+        for col in SNAPSHOT_COLUMNS:
+            total += float(np.asarray(self.arrays[col]).sum())
+        return total
+
+    def memory_report(self):
+        """各数组占用的字节数，并与等价的 float64 DataFrame（含时间戳与逐行代码）对比"""
+        arrays = {name: {'dtype': str(arr.dtype), 'bytes': int(arr.nbytes)} for name, arr in self.arrays.items()}
+        total = sum(a['bytes'] for a in arrays.values())
+        rows = int(self.meta['rows'])
+        # 原表示：日期(8) + 10 列 float64(80) + 逐行 code 字符串对象(约 55 字节/行)
+        baseline = rows * (8 + len(SNAPSHOT_COLUMNS) * 8 + 55)
+        return {
+            'rows': rows,
+            'codes': len(self.codes),
+            'trading_days': int(len(self.arrays['calendar'])),
+            'bytes': total,
+            'bytes_per_row': round(total / rows, 2) if rows else 0,
+            'float64_baseline_bytes': baseline,
+            'ratio': round(total / baseline, 3) if baseline else 0,
+            'arrays': arrays,
+        }
+
+    def has(self, code):
+        return code in self._index
+
+    def covers(self, code, start_str, end_str, last_trade_str):
+        """快照能否完整提供 [start, end] 的数据：起点被该股票的缓存覆盖，且数据已更新到 min(end, 最近交易日)"""
+        i = self._index.get(code)
+        if i is None or self.last_date is None:
+            return False
+        if int(self.arrays['starts'][i]) > int(start_str):
+            return False
+        return self.last_date.replace('-', '') >= min(end_str, last_trade_str)
+
+    def _day_index(self, date_str, side):
+        return int(np.searchsorted(self.arrays['calendar'], np.datetime64(pd.Timestamp(date_str).date()), side=side))
+
+    def tail_panel(self, columns, k, end_day=None):
+        """全市场每只股票截至 end_day（calendar 序号，默认最新）的最近 k 行，用于按股票向量化判断
+
+        Returns:
+            (day, values): day 为 [股票数, k] 的交易日序号，values 为 {列: [股票数, k] float64}；
+            行按 self.codes 顺序，第 k-1 列为截至 end_day 的最后一行，不足 k 行的位置 day 为 -1、数值为 NaN
+        """
+        offsets = self.arrays['offsets']
+        starts, ends = offsets[:-1], offsets[1:].copy()
+        day_idx = self.arrays['day_idx']
+        n = len(starts)
+        if n == 0 or len(day_idx) == 0:
+            return np.full((n, k), -1, dtype=np.int64), {col: np.full((n, k), np.nan) for col in columns}
+        if end_day is not None:
+            # 每只股票从末尾回退到 end_day 之前，只需回退 end_day 之后的几行
+            while True:
+                has = ends > starts
+                last = np.full(n, -1, dtype=np.int64)
+                last[has] = day_idx[ends[has] - 1]
+                move = has & (last > end_day)
+                if not move.any():
+                    break
+                ends[move] -= 1
+        idx = ends[:, None] - k + np.arange(k)[None, :]
+        valid = idx >= starts[:, None]
+        safe = np.where(valid, idx, 0)
+        day = np.where(valid, np.asarray(day_idx[safe.ravel()]).reshape(n, k), -1).astype(np.int64)
+        values = {}
+        for col in columns:
+            arr = np.asarray(self.arrays[col][safe.ravel()], dtype=np.float64).reshape(n, k)
+            values[col] = np.where(valid, arr, np.nan)
+        return day, values
+
+    def _rows(self, code, start_str=None, end_str=None):
+        """代码与日期范围（yyyymmdd，含两端）对应的行范围 (lo, hi)，没有该股票返回 None"""
+        i = self._index.get(code)
+        if i is None:
+            return None
+        lo, hi = int(self.arrays['offsets'][i]), int(self.arrays['offsets'][i + 1])
+        day_idx = self.arrays['day_idx']
+        if start_str is not None:
+            lo += int(np.searchsorted(day_idx[lo:hi], self._day_index(start_str, 'left'), side='left'))
+        if end_str is not None:
+            hi = lo + int(np.searchsorted(day_idx[lo:hi], self._day_index(end_str, 'right'), side='left'))
+        return lo, hi
+
+    def get_frame(self, code, start_str=None, end_str=None, compact=False):
+        """按代码与日期范围（yyyymmdd，含两端）切片，返回与 get_stock_data 相同列的 DataFrame
+
+        compact=False（默认）时价格还原为 float64（_restore_prices），与 JSON 缓存读出的数据一致；
+        compact=True 时保持快照中的紧凑类型（float32/int64），适合大批量扫描
+        """
+        rows = self._rows(code, start_str, end_str)
+        if rows is None:
+            return None
+        lo, hi = rows
+        df = pd.DataFrame({'日期': pd.to_datetime(self.arrays['calendar'][np.asarray(self.arrays['day_idx'][lo:hi])])})
+        for col in SNAPSHOT_COLUMNS:
+            values = np.asarray(self.arrays[col][lo:hi])
+            if not compact and values.dtype == np.float32:
+                values = _restore_prices(values) if col in PRICE_COLUMNS else values.astype(np.float64)
+            df[col] = values
+        return df
+
+    def bars(self, code, start_str=None, end_str=None):
+        """按列返回 K 线 {'date': [...], 'open': [...], ...}（字段见 BAR_FIELDS），没有该股票返回 None
+
+        直接由映射的数组切片转为列表，不构建 DataFrame，单只股票数年的数据也在 1 毫秒内；
+        数值还原规则与 get_frame 相同
+        """
+        rows = self._rows(code, start_str, end_str)
+        if rows is None:
+            return None
+        lo, hi = rows
+        days = self.arrays['calendar'][np.asarray(self.arrays['day_idx'][lo:hi])]
+        bars = {'date': np.datetime_as_string(days, unit='D').tolist()}
+        for col, field in BAR_FIELDS.items():
+            values = np.asarray(self.arrays[col][lo:hi])
+            if values.dtype == np.float32:
+                values = _restore_prices(values) if col in PRICE_COLUMNS else values.astype(np.float64).round(6)
+            bars[field] = values.tolist()
+        return bars
+
+
+def frame_bars(df):
+    """get_stock_data 返回的 DataFrame 转为与 MarketSnapshot.bars 相同的按列格式"""
+    bars = {'date': pd.to_datetime(df['日期']).dt.strftime('%Y-%m-%d').tolist()}
+    for col, field in BAR_FIELDS.items():
+        bars[field] = df[col].astype(float).round(6).tolist() if col in df.columns else [None] * len(df)
+    return bars
+
+def process_memory():
+    """当前进程的内存占用（字节，读取 /proc/self/smaps_rollup，仅 Linux）
+
+    shared 为与其他进程共享的页（如映射的快照文件），private 为本进程独占；
+    pss 按共享进程数均摊共享页，多个进程的 pss 之和即实际占用。不支持时返回 None。
+    """
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared', 'Shared_Dirty': 'shared',
+              'Private_Clean': 'private', 'Private_Dirty': 'private'}
+    try:
+        memory = {'rss': 0, 'pss': 0, 'shared': 0, 'private': 0}
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].rstrip(':') in fields:
+                    memory[fields[parts[0].rstrip(':')]] += int(parts[1]) * 1024
+        return memory
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == '__main__':
+    # 打印当前快照的内存占用报告
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'snapshot')
+    snapshot = MarketSnapshot.load(root)
+    if snapshot is None:
+        print('没有可用的快照，请先运行 daily_run.py 或 fetch_today.py')
+    else:
+        print(json.dumps(snapshot.memory_report(), ensure_ascii=False, indent=2))
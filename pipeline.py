@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+每日流水线：拉取与回测并行
+
+拉取阶段每拿到一只股票的最新数据，立刻通过有界队列交给回测阶段在内存中判断，
+不必等全市场拉取完成、也不必再从磁盘重新读取，总耗时约为 max(拉取, 回测)。
+
+    股票列表 -> [fetch_q] -> 拉取线程 -> [eval_q] -> 回测线程 -> 结果
+
+策略含截面（全市场排名）条件时，排名依赖全市场当日数据，回测阶段只缓存数据，
+待全部拉取完成后计算一次截面排名再统一判断。
+"""
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import Thread, Lock
+import time
+
+import pandas as pd
+
+from cross_section import CrossSection, has_cross_sectional
+from strategy_engine import sort_results
+
+_STOP = object()  # 队列结束标记
+
+
+class DailyPipeline:
+    """拉取 -> 回测 的生产者/消费者流水线"""
+
+    def __init__(self, data_fetcher, strategy_engine, fetch_workers=10, eval_workers=4,
+                 queue_size=200, fetch_days=50):
+        self.data_fetcher = data_fetcher
+        self.strategy_engine = strategy_engine
+        self.fetch_workers = fetch_workers
+        self.eval_workers = eval_workers
+        self.queue_size = queue_size  # 阶段间队列上限，防止拉取过快占满内存
+        self.fetch_days = fetch_days  # 无缓存的股票拉取近 N 个日历日
+
+    def _fetch_stock(self, stock, last_trade_str, start_str, end_str, cache_version=None):
+        """拉取单只股票的最新数据：有缓存则只补缺失的交易日，无缓存则整段拉取（读写 cache_version 版本）"""
+        code = stock['code']
+        try:
+            cached = self.data_fetcher.get_cached_file(code, cache_version)
+            if cached is not None:
+                start_cached, end_cached, fp = cached
+                df, _ = self.data_fetcher.update_stock_cache(code, start_cached, end_cached, fp, last_trade_str,
+                                                             version=cache_version)
+                if df is not None and not df.empty:
+                    return df
+            return self.data_fetcher.get_stock_data(code, start_str, end_str, version=cache_version)
+        except Exception:
+            return None
+
+    def run(self, strategy, strategy_name=None, stocks=None):
+        """执行流水线，返回按符合日期排序的结果列表
+
+        与 backtest 一致：全程固定一个日线缓存版本（周线/月线读同一版本），历史时点股票池可用时
+        股票取窗口内曾在池内的股票，每个 T 只判断当天在池内的股票
+        """
+        with self.data_fetcher.pin_cache_version() as cache_version:
+            return self._run(strategy, strategy_name, stocks, cache_version)
+
+    def _run(self, strategy, strategy_name, stocks, cache_version):
+        conditions = strategy.get('conditions', [])
+        time_range = strategy.get('timeRange', 30)
+        if strategy_name is None:
+            strategy_name = f"策略_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        results_filepath = self.strategy_engine.get_results_path(strategy_name)
+
+        window_start, window_end = self.strategy_engine.get_backtest_window(time_range, conditions=conditions)
+        universe_stocks, universe = self.strategy_engine.resolve_universe(strategy, window_start, window_end)
+        if stocks is None:
+            stocks = universe_stocks if universe is not None else self.data_fetcher.get_stock_list()
+        total = len(stocks)
+        last_trade_str = self.data_fetcher._get_last_trading_day().replace('-', '')
+        today = datetime.now()
+        start_str = (today - timedelta(days=self.fetch_days)).strftime('%Y%m%d')
+        end_str = today.strftime('%Y%m%d')
+
+        fetch_q = Queue(maxsize=self.queue_size)
+        eval_q = Queue(maxsize=self.queue_size)
+        results = []
+        deferred = []  # 含截面条件时暂存 (stock, df)，拉取完成后统一判断
+        breadth_since = self.data_fetcher.market_breadth.latest_date()
+        breadth_frames = []  # 入库的新数据，拉取完成后增量更新市场宽度
+        cross_sectional = has_cross_sectional(conditions)
+        stats = {'fetched': 0, 'fetch_ok': 0, 'evaluated': 0, 'errors': 0}
+        lock = Lock()
+        start_time = time.time()
+
+        print(f'流水线开始: {total} 只股票 | 拉取线程 {self.fetch_workers} | 回测线程 {self.eval_workers} | 队列上限 {self.queue_size}')
+
+        def producer():
+            for s in stocks:
+                fetch_q.put(s)
+            for _ in range(self.fetch_workers):
+                fetch_q.put(_STOP)
+
+        def fetch_worker():
+            while True:
+                stock = fetch_q.get()
+                if stock is _STOP:
+                    break
+                df = self._fetch_stock(stock, last_trade_str, start_str, end_str, cache_version)
+                with lock:
+                    stats['fetched'] += 1
+                    if df is not None and not df.empty:
+                        stats['fetch_ok'] += 1
+                        recent = df if breadth_since is None else df[pd.to_datetime(df['日期']) >= pd.Timestamp(breadth_since)]
+                        breadth_frames.append(recent[['日期', '收盘', '最高', '涨跌幅', '成交额']])
+                if df is not None and not df.empty:
+                    eval_q.put((stock, df))
+
+        def eval_worker():
+            while True:
+                item = eval_q.get()
+                if item is _STOP:
+                    break
+                stock, df = item
+                if cross_sectional:
+                    try:
+                        df = self.strategy_engine.trim_to_window(df, conditions, time_range)
+                    except Exception:
+                        record(None, error=True)
+                        continue
+                    with lock:
+                        deferred.append((stock, df))
+                    continue
+                record(*evaluate(stock, df))
+
+        def evaluate(stock, df, cross_section=None):
+            """判断单只股票，返回 (结果, 是否出错)；出错的股票计数后跳过，不影响回测线程"""
+            try:
+                return self.strategy_engine.evaluate_stock_df(stock, df, conditions, time_range, cross_section,
+                                                              universe, cache_version), False
+            except Exception:
+                return None, True
+
+        def record(result, error=False):
+            with lock:
+                stats['evaluated'] += 1
+                if error:
+                    stats['errors'] += 1
+                if result:
+                    results.append(result)
+                    self.strategy_engine._append_result(results_filepath, strategy_name, result, len(results))
+                    print(f"✓ 找到符合条件的股票: {result['code']} {result['name']}", flush=True)
+                if stats['evaluated'] % 100 == 0:
+                    elapsed = time.time() - start_time
+                    print(f'进度: 拉取 {stats["fetched"]}/{total} | 已回测 {stats["evaluated"]} | 已找到: {len(results)} | {elapsed:.1f}秒', flush=True)
+
+        producer_thread = Thread(target=producer, daemon=True)
+        fetch_threads = [Thread(target=fetch_worker, daemon=True) for _ in range(self.fetch_workers)]
+        eval_threads = [Thread(target=eval_worker, daemon=True) for _ in range(self.eval_workers)]
+        for t in [producer_thread] + fetch_threads + eval_threads:
+            t.start()
+
+        producer_thread.join()
+        for t in fetch_threads:
+            t.join()
+        for _ in range(self.eval_workers):
+            eval_q.put(_STOP)
+        for t in eval_threads:
+            t.join()
+
+        if deferred:
+            try:
+                frames = self.strategy_engine._universe_frames({stock['code']: df for stock, df in deferred}, universe)
+                calendar = self.data_fetcher.get_trading_days(window_start.strftime('%Y%m%d'), window_end.strftime('%Y%m%d'))
+                cross_section = CrossSection.build(frames, conditions, calendar)
+            except Exception as e:
+                print(f'[WARNING] 截面排名计算失败: {e}')
+                cross_section = None
+            for stock, df in deferred:
+                if cross_section is None:
+                    record(None, error=True)
+                else:
+                    record(*evaluate(stock, df, cross_section))
+
+        if breadth_frames:
+            self.data_fetcher.update_market_breadth(breadth_frames)
+
+        elapsed = time.time() - start_time
+        errors = f'，判断出错 {stats["errors"]} 只' if stats['errors'] else ''
+        print(f'流水线完成: 拉取成功 {stats["fetch_ok"]}/{total}，找到 {len(results)} 只符合条件的股票{errors}，耗时 {elapsed:.1f} 秒')
+        if results:
+            sort_results(results)
+            self.strategy_engine._write_sorted_results(results_filepath, strategy_name, results)
+            print(f"结果已保存（按符合日期排序）: {results_filepath}")
+        return results
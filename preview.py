@@ -0,0 +1,71 @@
+"""
+策略预览：按板块分层抽样估计全市场的匹配数
+
+完整回测要扫描全市场，调策略时往往跑完才发现 0 只或几千只匹配。预览在按板块分层的随机样本
+（默认每个板块 5%，每板块至少 MIN_PER_BOARD 只）上执行同样的判断，按分层抽样估计总匹配数：
+
+    N̂ = Σ N_h · x_h / n_h
+    Var(N̂) = Σ N_h² · (1 - n_h/N_h) · p̃_h(1 - p̃_h) / n_h，p̃_h = (x_h + 2) / (n_h + 4)
+
+N_h/n_h/x_h 为第 h 层的股票数、样本数、样本中的匹配数。方差用 Agresti-Coull 修正的比例，
+样本中没有匹配时区间上限也不会退化为 0。95% 区间为 N̂ ± 1.96·sqrt(Var)，截断到 [样本匹配数, 总股票数]。
+
+预览判断过的股票结果按 (策略, 日线缓存版本) 保留在引擎中，随后的完整回测若仍是同一版本直接复用，
+只判断剩余的股票（继续完整回测不重复样本部分的工作）。
+"""
+import math
+import random
+
+DEFAULT_FRACTION = 0.05
+MIN_PER_BOARD = 20
+Z_95 = 1.96
+
+
+def board_of(code):
+    """股票所属板块"""
+    if code.startswith('688'):
+        return '科创板'
+    if code.startswith('30'):
+        return '创业板'
+    if code.startswith('60'):
+        return '沪市主板'
+    if code.startswith('00'):
+        return '深市主板'
+    return '北交所及其他'
+
+
+def stratified_sample(stocks, fraction=DEFAULT_FRACTION, seed=None, min_per_board=MIN_PER_BOARD):
+    """按板块分层随机抽样
+
+    Returns:
+        (sample, strata): sample 为抽中的股票列表；strata 为 {板块: {'population', 'sampled'}}
+    """
+    groups = {}
+    for stock in stocks:
+        groups.setdefault(board_of(stock['code']), []).append(stock)
+    rng = random.Random(seed)
+    sample, strata = [], {}
+    for board in sorted(groups):
+        members = sorted(groups[board], key=lambda s: s['code'])  # 同一 seed 结果可复现
+        size = min(len(members), max(min_per_board, math.ceil(len(members) * fraction)))
+        sample.extend(rng.sample(members, size))
+        strata[board] = {'population': len(members), 'sampled': size}
+    return sample, strata
+
+
+def estimate_matches(strata):
+    """由 {板块: {'population', 'sampled', 'matches'}} 估计总匹配数，返回 (估计值, (下限, 上限))"""
+    estimate, variance, observed, population = 0.0, 0.0, 0, 0
+    for s in strata.values():
+        N, n, x = s['population'], s['sampled'], s['matches']
+        population += N
+        observed += x
+        if n == 0:
+            continue
+        estimate += N * x / n
+        p = (x + 2) / (n + 4)
+        variance += N * N * (1 - n / N) * p * (1 - p) / n
+    half = Z_95 * math.sqrt(variance)
+    low = max(float(observed), estimate - half)
+    high = min(float(population), estimate + half)
+    return estimate, (low, high)
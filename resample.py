@@ -0,0 +1,121 @@
+"""
+日线 -> 周线/月线 聚合
+
+聚合全部用 groupby 向量化完成，输出列名与日线一致，可直接用于策略条件判断。
+'周期' 为 pandas Period 序号（同一周/月的交易日相同），'起始日期' 为该周期第一个交易日。
+"""
+import numpy as np
+import pandas as pd
+
+# 支持的周期：W=周线，M=月线
+TIMEFRAMES = {'W': 'W', 'M': 'M'}
+
+BAR_COLUMNS = ['日期', '起始日期', '周期', '交易日数', '开盘', '收盘', '最高', '最低',
+               '成交量', '成交额', '振幅', '涨跌幅', '涨跌额', '换手率']
+
+
+def period_ordinal(dates, timeframe):
+    """日期 -> 周期序号（int64 数组）"""
+    return pd.DatetimeIndex(pd.to_datetime(dates)).to_period(TIMEFRAMES[timeframe]).asi8
+
+
+def resample_bars(df, timeframe, prev_close=None):
+    """把日线聚合为周线/月线
+
+    Args:
+        df: 日线 DataFrame（含 日期/开盘/收盘/最高/最低/成交量/成交额/涨跌幅/换手率）
+        timeframe: 'W' 或 'M'
+        prev_close: 第一根聚合K线之前一根的收盘价（增量更新时用于计算涨跌额），None 表示无
+    """
+    if df is None or df.empty:
+        return pd.DataFrame(columns=BAR_COLUMNS)
+    df = df.sort_values('日期')
+    dates = pd.to_datetime(df['日期'])
+    key = period_ordinal(dates, timeframe)
+    g = pd.DataFrame({
+        '日期': dates.values,
+        '周期': key,
+        '开盘': df['开盘'].values,
+        '收盘': df['收盘'].values,
+        '最高': df['最高'].values,
+        '最低': df['最低'].values,
+        '成交量': df['成交量'].values,
+        '成交额': df['成交额'].values,
+        # 涨跌幅按日涨跌幅复利累计，不受除权缺口影响
+        '_log_ret': np.log1p(pd.to_numeric(df['涨跌幅'], errors='coerce').fillna(0).values / 100),
+        '换手率': df['换手率'].values,
+    }).groupby('周期', sort=True)
+
+    bars = g.agg(
+        日期=('日期', 'last'),
+        起始日期=('日期', 'first'),
+        交易日数=('日期', 'size'),
+        开盘=('开盘', 'first'),
+        收盘=('收盘', 'last'),
+        最高=('最高', 'max'),
+        最低=('最低', 'min'),
+        成交量=('成交量', 'sum'),
+        成交额=('成交额', 'sum'),
+        _log_ret=('_log_ret', 'sum'),
+        换手率=('换手率', 'sum'),
+    ).reset_index()
+    bars['涨跌幅'] = np.expm1(bars.pop('_log_ret')) * 100
+    prev = bars['收盘'].shift(1)
+    if prev_close is not None and len(prev):
+        prev.iloc[0] = prev_close
+    bars['涨跌额'] = (bars['收盘'] - prev).fillna(0)
+    bars['振幅'] = ((bars['最高'] - bars['最低']) / bars['最低'].replace(0, np.nan) * 100).fillna(0)
+    return bars[BAR_COLUMNS]
+
+
+def merge_bars(old_bars, df_daily, timeframe, since=None):
+    """增量更新：从日线有变化的最早周期起重算，拼接到已有聚合结果上
+
+    最早的变化为 since（调用方已知的最早变化日，如补齐的历史空洞、重新拉取的区间）所在周期、
+    按周期比对交易日数第一次不同的周期（补齐的空洞、多出或少了的周期）和最后一根已有K线所在周期
+    （可能尚未走完）三者中最早的一个。old_bars 为空或日线起点早于已有聚合时（历史被向前补齐），退化为全量聚合。
+    """
+    if old_bars is None or old_bars.empty:
+        return resample_bars(df_daily, timeframe)
+    dates = pd.to_datetime(df_daily['日期'])
+    if dates.min() < pd.to_datetime(old_bars['起始日期']).min():
+        return resample_bars(df_daily, timeframe)
+    keys = period_ordinal(dates, timeframe)
+    periods, counts = np.unique(keys, return_counts=True)
+    old = pd.Series(old_bars['交易日数'].to_numpy(), index=old_bars['周期'].to_numpy(dtype=np.int64))
+    old = old[old.index >= periods[0]]  # 日线起点之前的已有K线保留
+    joined = pd.concat([pd.Series(counts, index=periods), old], axis=1)
+    changed = joined.index[joined[0] != joined[1]]  # 任一侧缺该周期（NaN）也算变化
+    first = int(old_bars['周期'].iloc[-1])
+    if len(changed):
+        first = min(first, int(changed[0]))
+    if since is not None:
+        first = min(first, int(period_ordinal([since], timeframe)[0]))
+    keep = old_bars[old_bars['周期'] < first]
+    tail = df_daily[keys >= first]
+    prev_close = float(keep['收盘'].iloc[-1]) if not keep.empty else None
+    new_bars = resample_bars(tail, timeframe, prev_close=prev_close)
+    return pd.concat([keep, new_bars], ignore_index=True)[BAR_COLUMNS]
+
+
+def period_to_date(df, timeframe):
+    """截至每个交易日的当期K线（只用当天及之前的数据，回测时避免未来函数）
+
+    返回与 df 行对齐的 DataFrame，第 i 行为 df 第 i 个交易日所在周期、截至该日的聚合值。
+    """
+    df = df.sort_values('日期').reset_index(drop=True)
+    key = pd.Series(period_ordinal(df['日期'], timeframe))
+    g_log = pd.Series(np.log1p(pd.to_numeric(df['涨跌幅'], errors='coerce').fillna(0).values / 100))
+    out = pd.DataFrame({
+        '日期': pd.to_datetime(df['日期']),
+        '周期': key,
+        '开盘': df['开盘'].groupby(key).transform('first'),
+        '收盘': df['收盘'],
+        '最高': df['最高'].groupby(key).cummax(),
+        '最低': df['最低'].groupby(key).cummin(),
+        '成交量': df['成交量'].groupby(key).cumsum(),
+        '成交额': df['成交额'].groupby(key).cumsum(),
+        '涨跌幅': np.expm1(g_log.groupby(key).cumsum()) * 100,
+        '换手率': df['换手率'].groupby(key).cumsum(),
+    })
+    return out
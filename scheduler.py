@@ -0,0 +1,147 @@
+"""
+共享工作线程池与请求合并
+
+FairScheduler: 一个进程内所有回测共用的有界线程池。每次回测是一个 Job，工作线程在有待办任务的
+Job 之间轮转取任务（公平排队），两个回测同时运行时各得约一半线程，而不是线程数翻倍。
+
+SingleFlight: 相同 key 的调用同时进行时只执行一次，其余调用等待并共享结果
+（用于合并同一只股票的并发读取/拉取）。
+"""
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Lock, Thread
+import itertools
+
+
+class Job:
+    """调度器中的一个作业（一次回测），submit 返回 concurrent.futures.Future"""
+
+    def __init__(self, scheduler, name):
+        self.scheduler = scheduler
+        self.name = name
+        self._pending = deque()  # (fn, args, kwargs, future)
+        self._queued = False     # 是否在调度器的轮转队列中
+        self.submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.submitted += 1
+        self.scheduler._enqueue(self, (fn, args, kwargs, future))
+        return future
+
+    def cancel(self):
+        """取消尚未开始的任务"""
+        for _, _, _, future in self.scheduler._drain(self):
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cancel()
+        return False
+
+
+class FairScheduler:
+    """有界线程池，按 Job 轮转公平调度"""
+
+    def __init__(self, max_workers=10):
+        self.max_workers = max_workers
+        self._cond = Condition()
+        self._ring = deque()  # 有待办任务的 Job，轮转
+        self._threads = []
+        self._running = 0
+        self._ids = itertools.count(1)
+
+    def job(self, name=None):
+        return Job(self, name or f'job-{next(self._ids)}')
+
+    def _start_workers(self):
+        # 首次提交任务时才启动线程，只导入引擎的脚本不占线程
+        while len(self._threads) < self.max_workers:
+            t = Thread(target=self._worker, name=f'scheduler-{len(self._threads)}', daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def _enqueue(self, job, task):
+        with self._cond:
+            if not self._threads:
+                self._start_workers()
+            job._pending.append(task)
+            if not job._queued:
+                job._queued = True
+                self._ring.append(job)
+            self._cond.notify()
+
+    def _drain(self, job):
+        with self._cond:
+            tasks = list(job._pending)
+            job._pending.clear()
+            if job._queued:
+                job._queued = False
+                self._ring.remove(job)
+            return tasks
+
+    def _next_task(self):
+        with self._cond:
+            while not self._ring:
+                self._cond.wait()
+            job = self._ring.popleft()
+            task = job._pending.popleft()
+            if job._pending:
+                self._ring.append(job)  # 还有任务则排到队尾，轮到下一个 Job
+            else:
+                job._queued = False
+            self._running += 1
+            return task
+
+    def _worker(self):
+        while True:
+            fn, args, kwargs, future = self._next_task()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.max_workers,
+                'running': self._running,
+                'jobs': len(self._ring),
+                'pending': sum(len(job._pending) for job in self._ring),
+            }
+
+
+class SingleFlight:
+    """合并同 key 的并发调用：第一个调用执行，其余等待同一结果"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}  # key -> Future
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            result = call.result()
+            # DataFrame 等可变结果给每个等待者一份副本，避免调用方互相修改
+            return result.copy() if hasattr(result, 'copy') else result
+        try:
+            result = fn(*args, **kwargs)
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
@@ -13,6 +13,7 @@
   SMTP_SUBJECT  主题(可选)
   SMTP_BODY     正文(可选)
   SMTP_BODY_FILE 正文文件路径(可选，优先于 SMTP_BODY)
+                 均未设置时使用常驻策略的最新变化报告 results/常驻策略_变化_latest.txt（若存在）
   SMTP_ATTACH   附件路径(可选)
   SMTP_USE_TLS  使用 STARTTLS(可选，true/false)
 """
@@ -22,6 +23,8 @@ import mimetypes
 import smtplib
 from email.message import EmailMessage
 
+DELTA_REPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "常驻策略_变化_latest.txt")
+
 
 def getenv_required(name: str) -> str:
     value = os.getenv(name)
@@ -42,6 +45,8 @@ def build_message() -> EmailMessage:
     msg["Subject"] = os.getenv("SMTP_SUBJECT", "执行结果")
 
     body_file = os.getenv("SMTP_BODY_FILE")
+    if not body_file and not os.getenv("SMTP_BODY") and os.path.exists(DELTA_REPORT):
+        body_file = DELTA_REPORT
     if body_file and os.path.exists(body_file):
         with open(body_file, "r", encoding="utf-8") as f:
             body = f.read()
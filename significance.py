@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+策略结果的显著性检验（蒙特卡洛）
+
+回测结果只是一组 (股票, 匹配日 T)，本模块判断其后 N 个交易日的收益是否好于随机：
+    随机抽样    从同一股票池、同一时间窗口内均匀抽取同样数量的 (股票, T)，重复 resamples 次，
+               得到随机组合平均收益的分布；p 值为随机组合平均收益不低于策略的比例（单侧）
+    置换检验    保持每个匹配的日期不变，只把股票置换为同一天的随机股票，剔除 "选中了大盘上涨的日子" 的影响
+    自助法     对策略自身的收益有放回重抽样，给出平均收益、胜率、相对同日全市场平均的超额收益的置信区间
+
+收益 = T 之后第 N 个交易日（该股票自身的交易日，停牌日不计）的收盘价 / T 日收盘价 - 1（%）；
+T 之后不足 N 个交易日的匹配不参与该周期的检验（计入 skipped）。
+
+全部基于快照的列式数组计算：前瞻收益一次算出所有行，重抽样按 [次数 × 样本数] 的矩阵分块向量化，
+每块使用由 seed 派生的独立随机数，workers > 1 时分块在多个进程中并行，结果与单进程一致。
+
+用法:
+    python significance.py results/策略_20260203_201006_结果.jsonl
+    python significance.py results/策略_20260203_201006_结果.jsonl --horizons 1,5,10 --resamples 10000 --workers 4
+"""
+import os
+os.environ['NO_PROXY'] = '*'
+os.environ['no_proxy'] = '*'
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_HORIZONS = (1, 3, 5, 10, 20)
+DEFAULT_RESAMPLES = 10000
+CHUNK_ELEMENTS = 2_000_000  # 每块重抽样矩阵的元素数上限，控制内存
+
+_ARRAYS = None  # 子进程中的共享数组（由 _init_worker 设置一次）
+
+
+def load_matches(path):
+    """读取回测结果文件（*_结果.jsonl），返回 [{code, name, match_date, ...}]"""
+    matches = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if '_meta' in record:
+                continue
+            matches.append(record)
+    return matches
+
+
+def forward_returns(snapshot, horizon):
+    """快照每一行 -> horizon 个交易日后的收益率（%），末尾不足 horizon 行或价格无效为 NaN"""
+    close = np.asarray(snapshot.arrays['收盘'], dtype=np.float64)
+    offsets = np.asarray(snapshot.arrays['offsets'])
+    out = np.full(len(close), np.nan)
+    if len(close) > horizon:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[:-horizon] = (close[horizon:] / close[:-horizon] - 1) * 100
+    # 每只股票最后 horizon 行的 "后 N 行" 属于下一只股票
+    tail = offsets[1:, None] - np.arange(1, horizon + 1)[None, :]
+    tail = tail[tail >= offsets[:-1, None]]
+    out[tail] = np.nan
+    out[close <= 0] = np.nan
+    return out
+
+
+def _resample_chunk(seed, size, arrays=None):
+    """一块重抽样：返回 size 次的随机组合/同日置换/自助法统计量"""
+    a = arrays if arrays is not None else _ARRAYS
+    rng = np.random.default_rng(seed)
+    x, excess, pool = a['x'], a['excess'], a['pool']
+    n = len(x)
+
+    rand = pool[rng.integers(0, len(pool), size=(size, n))]
+
+    # 同日置换：第 j 个匹配替换为其匹配日全部股票中的随机一只
+    start, count = a['day_start'][a['slot']], a['day_count'][a['slot']]
+    pos = start + (rng.random((size, n)) * count).astype(np.int64)
+    perm = pool[pos]
+
+    boot = rng.integers(0, n, size=(size, n))
+    boot_x = x[boot]
+    return {
+        'random_mean': rand.mean(axis=1),
+        'random_win': (rand > 0).mean(axis=1),
+        'perm_mean': perm.mean(axis=1),
+        'boot_mean': boot_x.mean(axis=1),
+        'boot_win': (boot_x > 0).mean(axis=1),
+        'boot_excess': excess[boot].mean(axis=1),
+    }
+
+
+def _init_worker(arrays):
+    global _ARRAYS
+    _ARRAYS = arrays
+
+
+def _p_value(null, observed):
+    """单侧 p 值（随机不低于观测值的比例），加 1 校正避免为 0"""
+    return float((np.count_nonzero(null >= observed) + 1) / (len(null) + 1))
+
+
+def _interval(values, confidence):
+    tail = (1 - confidence) / 2 * 100
+    lo, hi = np.percentile(values, [tail, 100 - tail])
+    return [round(float(lo), 4), round(float(hi), 4)]
+
+
+class SignificanceTester:
+    """基于快照对回测结果做随机抽样、同日置换与自助法检验"""
+
+    def __init__(self, snapshot, stocks=None):
+        """
+        Args:
+            snapshot: MarketSnapshot
+            stocks: 股票池（[{code, name}]），默认为快照中的股票列表；随机样本只从股票池中抽取
+        """
+        self.snapshot = snapshot
+        stocks = stocks if stocks is not None else snapshot.stocks
+        codes = {s['code'] for s in stocks} if stocks else set(snapshot.codes)
+        self.universe = np.array([code in codes for code in snapshot.codes], dtype=bool)
+        offsets = np.asarray(snapshot.arrays['offsets'])
+        self._row_stock = np.repeat(np.arange(len(snapshot.codes)), np.diff(offsets))
+        self._day_idx = np.asarray(snapshot.arrays['day_idx'])
+        self._returns = {}  # horizon -> forward_returns
+
+    def _forward(self, horizon):
+        if horizon not in self._returns:
+            self._returns[horizon] = forward_returns(self.snapshot, horizon)
+        return self._returns[horizon]
+
+    def _locate(self, matches):
+        """(code, match_date) -> 快照行号，找不到为 -1"""
+        calendar = self.snapshot.arrays['calendar']
+        offsets = self.snapshot.arrays['offsets']
+        rows = np.full(len(matches), -1, dtype=np.int64)
+        for j, m in enumerate(matches):
+            i = self.snapshot._index.get(m.get('code'))
+            if i is None or not m.get('match_date'):
+                continue
+            day = np.datetime64(pd.Timestamp(m['match_date']).date())
+            d = int(np.searchsorted(calendar, day))
+            if d >= len(calendar) or calendar[d] != day:
+                continue
+            lo, hi = int(offsets[i]), int(offsets[i + 1])
+            k = lo + int(np.searchsorted(self._day_idx[lo:hi], d))
+            if k < hi and self._day_idx[k] == d:
+                rows[j] = k
+        return rows
+
+    def test(self, matches, horizons=DEFAULT_HORIZONS, resamples=DEFAULT_RESAMPLES, start_date=None,
+             end_date=None, seed=None, workers=1, confidence=0.95):
+        """对回测结果做显著性检验
+
+        Args:
+            matches: 回测结果（至少含 code、match_date）
+            horizons: 持有的交易日数
+            resamples: 每种检验的重抽样次数
+            start_date, end_date: 随机抽样的时间窗口（YYYY-MM-DD），默认为匹配日的最早/最晚日期
+            seed: 随机种子（相同种子结果可复现，与 workers 无关）
+            workers: 并行进程数，1 为单进程
+            confidence: 置信区间的置信度
+        Returns:
+            {count, located, window, universe, resamples, seconds, horizons: [{horizon, n, skipped, ...}]}
+        """
+        started = time.time()
+        calendar = self.snapshot.arrays['calendar']
+        rows = self._locate(matches)
+        found = rows[rows >= 0]
+        if start_date is None or end_date is None:
+            match_days = self._day_idx[found] if len(found) else np.array([len(calendar) - 1])
+        lo = self.snapshot._day_index(start_date, 'left') if start_date else int(match_days.min())
+        hi = self.snapshot._day_index(end_date, 'right') - 1 if end_date else int(match_days.max())
+        in_window = (self._day_idx >= lo) & (self._day_idx <= hi) & self.universe[self._row_stock]
+
+        report = {
+            'count': len(matches),
+            'located': int(len(found)),
+            'window': [str(calendar[lo]) if lo < len(calendar) else None,
+                       str(calendar[hi]) if 0 <= hi < len(calendar) else None],
+            'universe': int(self.universe.sum()),
+            'resamples': resamples,
+            'confidence': confidence,
+            'horizons': [],
+        }
+        root = np.random.SeedSequence(seed)
+        for horizon, child in zip(horizons, root.spawn(len(horizons))):
+            result = self._test_horizon(int(horizon), found, in_window, resamples, child, workers, confidence)
+            result['skipped'] = len(matches) - result['n']
+            report['horizons'].append(result)
+        report['seconds'] = round(time.time() - started, 3)
+        return report
+
+    def _test_horizon(self, horizon, rows, in_window, resamples, seed_seq, workers, confidence):
+        fwd = self._forward(horizon)
+        eligible = in_window & np.isfinite(fwd)
+        rows = rows[np.isfinite(fwd[rows])]
+        result = {'horizon': horizon, 'n': 0, 'pool': int(eligible.sum())}
+
+        # 按交易日分组的全市场收益，供同日置换与超额收益使用
+        pool_days = self._day_idx[eligible]
+        order = np.argsort(pool_days, kind='stable')
+        pool_by_day = fwd[eligible][order]
+        n_days = len(self.snapshot.arrays['calendar'])
+        day_count = np.bincount(pool_days, minlength=n_days).astype(np.int64)
+        day_start = np.concatenate([[0], np.cumsum(day_count)[:-1]])
+        day_sum = np.bincount(pool_days, weights=fwd[eligible], minlength=n_days)
+
+        slot = self._day_idx[rows].astype(np.int64)
+        rows = rows[day_count[slot] > 0]  # 匹配日不在窗口内或当日无可比股票
+        slot = self._day_idx[rows].astype(np.int64)
+        result['n'] = int(len(rows))
+        if len(rows) == 0:
+            result['error'] = '没有可检验的匹配（T 之后交易日不足，或不在股票池/窗口内）'
+            return result
+
+        x = fwd[rows]
+        excess = x - day_sum[slot] / day_count[slot]
+        arrays = {'x': x, 'excess': excess, 'pool': pool_by_day,
+                  'day_start': day_start, 'day_count': day_count, 'slot': slot}
+
+        size = max(1, CHUNK_ELEMENTS // len(x))
+        sizes = [min(size, resamples - i) for i in range(0, resamples, size)]
+        seeds = seed_seq.spawn(len(sizes))
+        if workers and workers > 1 and len(sizes) > 1:
+            # 每个进程只接收一次数组，之后各块只传种子与块大小
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(arrays,)) as ex:
+                chunks = list(ex.map(_resample_chunk, seeds, sizes))
+        else:
+            chunks = [_resample_chunk(s, n, arrays) for s, n in zip(seeds, sizes)]
+        stats = {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]}
+
+        mean, win = float(x.mean()), float((x > 0).mean())
+        result.update({
+            'mean': round(mean, 4),
+            'median': round(float(np.median(x)), 4),
+            'win_rate': round(win, 4),
+            'market_mean': round(float(pool_by_day.mean()), 4),
+            'excess_mean': round(float(excess.mean()), 4),
+            'random': {
+                'mean': round(float(stats['random_mean'].mean()), 4),
+                'interval': _interval(stats['random_mean'], confidence),
+                'p_value': _p_value(stats['random_mean'], mean),
+                'win_rate': round(float(stats['random_win'].mean()), 4),
+                'win_p_value': _p_value(stats['random_win'], win),
+            },
+            'permutation': {
+                'mean': round(float(stats['perm_mean'].mean()), 4),
+                'interval': _interval(stats['perm_mean'], confidence),
+                'p_value': _p_value(stats['perm_mean'], mean),
+            },
+            'bootstrap': {
+                'mean_interval': _interval(stats['boot_mean'], confidence),
+                'win_rate_interval': _interval(stats['boot_win'], confidence),
+                'excess_interval': _interval(stats['boot_excess'], confidence),
+            },
+        })
+        return result
+
+
+def format_report(report):
+    """文本报告（打印到控制台）"""
+    pct = round(report['confidence'] * 100)
+    lines = [
+        f"匹配 {report['count']} 个（快照中找到 {report['located']} 个），股票池 {report['universe']} 只，"
+        f"窗口 {report['window'][0]} ~ {report['window'][1]}，重抽样 {report['resamples']} 次，耗时 {report['seconds']}s",
+    ]
+    for h in report['horizons']:
+        lines.append(f"==== 持有 {h['horizon']} 个交易日 ====")
+        if h.get('error'):
+            lines.append(f"  {h['error']}")
+            continue
+        r, p, b = h['random'], h['permutation'], h['bootstrap']
+        lines.extend([
+            f"  策略: n={h['n']}（跳过 {h['skipped']}）平均 {h['mean']:+.2f}% 中位数 {h['median']:+.2f}% 胜率 {h['win_rate'] * 100:.1f}% "
+            f"| 同日全市场超额 {h['excess_mean']:+.2f}%",
+            f"  随机抽样: 平均 {r['mean']:+.2f}% {pct}%区间 [{r['interval'][0]:+.2f}, {r['interval'][1]:+.2f}] "
+            f"p={r['p_value']:.4f} | 胜率 {r['win_rate'] * 100:.1f}% p={r['win_p_value']:.4f}",
+            f"  同日置换: 平均 {p['mean']:+.2f}% {pct}%区间 [{p['interval'][0]:+.2f}, {p['interval'][1]:+.2f}] "
+            f"p={p['p_value']:.4f}",
+            f"  自助法 {pct}%区间: 平均 [{b['mean_interval'][0]:+.2f}, {b['mean_interval'][1]:+.2f}] "
+            f"胜率 [{b['win_rate_interval'][0] * 100:.1f}%, {b['win_rate_interval'][1] * 100:.1f}%] "
+            f"超额 [{b['excess_interval'][0]:+.2f}, {b['excess_interval'][1]:+.2f}]",
+        ])
+    return '\n'.join(lines)
+
+
+def main():
+    from data_fetcher import DataFetcher
+
+    parser = argparse.ArgumentParser(description='策略结果的显著性检验（随机抽样 / 同日置换 / 自助法）')
+    parser.add_argument('results', help='回测结果文件（*_结果.jsonl）')
+    parser.add_argument('--horizons', default=','.join(str(h) for h in DEFAULT_HORIZONS), help='持有交易日数，逗号分隔')
+    parser.add_argument('--resamples', type=int, default=DEFAULT_RESAMPLES, help='重抽样次数')
+    parser.add_argument('--start', default=None, help='随机抽样窗口起点 YYYY-MM-DD（默认为最早匹配日）')
+    parser.add_argument('--end', default=None, help='随机抽样窗口终点 YYYY-MM-DD（默认为最晚匹配日）')
+    parser.add_argument('--seed', type=int, default=None, help='随机种子')
+    parser.add_argument('--workers', type=int, default=1, help='并行进程数')
+    args = parser.parse_args()
+
+    fetcher = DataFetcher()
+    snapshot = fetcher.snapshot or fetcher.load_snapshot()
+    if snapshot is None:
+        print('[ERROR] 没有快照，请先运行每日任务（daily_run.py）生成快照')
+        return
+    tester = SignificanceTester(snapshot, fetcher.get_stock_list())
+    report = tester.test(load_matches(args.results), horizons=[int(h) for h in args.horizons.split(',') if h],
+                         resamples=args.resamples, start_date=args.start, end_date=args.end,
+                         seed=args.seed, workers=args.workers)
+    print(format_report(report))
+    path = args.results.replace('_结果.jsonl', '') + '_显著性.json'
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'results': os.path.basename(args.results), 'tested_at': datetime.now().isoformat(), **report},
+                  f, ensure_ascii=False, indent=2)
+    print(f'[INFO] 检验结果已保存: {path}')
+
+
+if __name__ == '__main__':
+    main()
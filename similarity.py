@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+K 线形态相似度搜索
+
+形态特征：以某日为终点的 window 个交易日（该股票自身的交易日，停牌日不计）
+    收益形状    每日对数收益率，去均值后 L2 归一化
+    成交量形状  对数成交量，去均值后 L2 归一化（即相对窗口内几何平均的放量/缩量）
+两段按 RETURN_WEIGHT / VOLUME_WEIGHT 加权拼接，两个形态的相似度 = 特征向量的点积，
+等于两段皮尔逊相关系数的加权平均（-1~1，越大越相似）。与价格高低、成交量大小无关，只看形状。
+
+索引（SimilarityIndex）：对快照中全部股票、全部历史的每个窗口计算特征（float16 保存），
+再用随机超平面 LSH（SimHash）建 tables 张签名表，每张按 bits 位签名排序；
+查询时在每张表中探测签名相同的桶，以及翻转最不确定的几位（查询离超平面最近的位）得到的邻近桶，
+候选去重后按精确相似度重排取 top-k，无需遍历全市场。索引与快照版本绑定，保存在 cache/similarity/<快照版本>_w<window>/，内存映射加载。
+
+策略条件 similar：T+date1 为终点的窗口与参照形态（某只股票某日为终点的窗口）的相似度 ≥ value
+    {'type': 'similar', 'code': '600330', 'date': '2025-12-23', 'window': 20, 'date1': -1, 'value': 0.8}
+
+用法:
+    python similarity.py build                     # 为当前快照建立索引（每日任务保存快照后自动执行）
+    python similarity.py search 600330 2025-12-23 --k 20
+"""
+import os
+os.environ['NO_PROXY'] = '*'
+os.environ['no_proxy'] = '*'
+
+from datetime import datetime
+import argparse
+import json
+import shutil
+import time
+
+import numpy as np
+
+DEFAULT_WINDOW = 20
+RETURN_WEIGHT = 1.0
+VOLUME_WEIGHT = 0.5
+LSH_TABLES = 12
+LSH_BITS = 18
+PROBE_BITS = 5         # 查询时全组合翻转的最不确定位数
+MAX_BUCKET = 4096       # 每个桶最多取的候选数（极度集中的签名不拖慢查询）
+BUILD_CHUNK = 200_000   # 建索引时每块计算的窗口数
+
+
+def _normalize(x):
+    """按最后一维去均值并 L2 归一化；常数序列（如连续一字板）为零向量"""
+    x = x - x.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(x, axis=-1, keepdims=True)
+    return np.divide(x, norm, out=np.zeros_like(x), where=norm > 1e-12)
+
+
+def pattern_features(closes, volumes):
+    """形态特征向量
+
+    Args:
+        closes: [..., window+1] 收盘价（最后一个为终点日）
+        volumes: [..., window] 成交量（与收益对应的 window 个交易日）
+    Returns:
+        [..., 2*window] 单位向量（float32）；价格无效的窗口为零向量
+    """
+    closes = np.asarray(closes, dtype=np.float64)
+    volumes = np.asarray(volumes, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.diff(np.log(closes), axis=-1)
+        log_volume = np.log(np.maximum(volumes, 1.0))
+    returns = np.where(np.isfinite(returns), returns, 0.0)
+    total = np.hypot(RETURN_WEIGHT, VOLUME_WEIGHT)
+    features = np.concatenate([_normalize(returns) * (RETURN_WEIGHT / total),
+                               _normalize(log_volume) * (VOLUME_WEIGHT / total)], axis=-1)
+    return features.astype(np.float32)
+
+
+def frame_features(df, end, window=DEFAULT_WINDOW):
+    """DataFrame（按日期升序）第 end 行为终点的形态特征，历史不足返回 None"""
+    if end < window or end >= len(df):
+        return None
+    closes = df['收盘'].to_numpy()[end - window:end + 1]
+    volumes = df['成交量'].to_numpy()[end - window + 1:end + 1]
+    return pattern_features(closes, volumes)
+
+
+def _signatures(features, planes, bits):
+    """[n, dim] 特征 -> [n, tables] 签名（uint32，每张表 bits 位）"""
+    signs = (features.astype(np.float32) @ planes.T) > 0
+    signs = signs.reshape(len(features), -1, bits)
+    weights = (1 << np.arange(bits, dtype=np.uint64)).astype(np.uint64)
+    return (signs.astype(np.uint64) * weights).sum(axis=-1).astype(np.uint32)
+
+
+class SimilarityIndex:
+    """全市场历史窗口的形态索引（LSH + 精确重排）"""
+
+    def __init__(self, snapshot, meta, arrays, path=None):
+        self.snapshot = snapshot
+        self.meta = meta
+        self.window = meta['window']
+        self.bits = meta['bits']
+        # rows, stock, features, planes, sig<i>, ids<i>；内存映射转为普通数组视图（不复制），避免每次切片的 memmap 开销
+        self.arrays = {name: np.asarray(arr) for name, arr in arrays.items()}
+        self.path = path
+        offsets = np.asarray(snapshot.arrays['offsets'])
+        self._offsets = offsets
+        self._names = {s['code']: s.get('name', '') for s in snapshot.stocks}
+
+    @staticmethod
+    def _dir(root, snapshot, window):
+        return os.path.join(root, f'{snapshot.version}_w{window}')
+
+    @classmethod
+    def build(cls, snapshot, window=DEFAULT_WINDOW, tables=LSH_TABLES, bits=LSH_BITS, seed=0):
+        """为快照中全部股票的全部窗口计算特征与签名（内存中）"""
+        close = np.asarray(snapshot.arrays['收盘'], dtype=np.float64)
+        volume = np.asarray(snapshot.arrays['成交量'], dtype=np.float64)
+        offsets = np.asarray(snapshot.arrays['offsets'])
+        # 终点行 r 需要同一只股票的 [r-window, r] 行
+        starts = np.repeat(offsets[:-1], np.diff(offsets))
+        rows = np.nonzero(np.arange(len(close)) - starts >= window)[0].astype(np.int64)
+
+        dim = 2 * window
+        planes = np.random.default_rng(seed).standard_normal((tables * bits, dim)).astype(np.float32)
+        features = np.empty((len(rows), dim), dtype=np.float16)
+        sigs = np.empty((len(rows), tables), dtype=np.uint32)
+        span = np.arange(-window, 1)
+        for lo in range(0, len(rows), BUILD_CHUNK):
+            chunk = rows[lo:lo + BUILD_CHUNK]
+            idx = chunk[:, None] + span[None, :]
+            f = pattern_features(close[idx], volume[idx[:, 1:]])
+            features[lo:lo + len(chunk)] = f
+            sigs[lo:lo + len(chunk)] = _signatures(f, planes, bits)
+
+        stock = (np.searchsorted(offsets, rows, side='right') - 1).astype(np.int32)
+        arrays = {'rows': rows, 'stock': stock, 'features': features, 'planes': planes}
+        for t in range(tables):
+            order = np.argsort(sigs[:, t], kind='stable').astype(np.int32)
+            arrays[f'sig{t}'] = sigs[order, t]
+            arrays[f'ids{t}'] = order
+        meta = {'snapshot_version': snapshot.version, 'window': window, 'tables': tables, 'bits': bits,
+                'seed': seed, 'windows': int(len(rows)), 'return_weight': RETURN_WEIGHT,
+                'volume_weight': VOLUME_WEIGHT, 'created_at': datetime.now().isoformat()}
+        return cls(snapshot, meta, arrays)
+
+    def save(self, root):
+        """写入 <快照版本>_w<window>/（先写临时目录再改名），清理同一窗口长度的旧索引"""
+        os.makedirs(root, exist_ok=True)
+        final_dir = self._dir(root, self.snapshot, self.window)
+        tmp_dir = f'{final_dir}.{os.getpid()}.tmp'
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, arr in self.arrays.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), arr)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+        self.path = final_dir
+        suffix = f'_w{self.window}'
+        for d in os.listdir(root):
+            if d.endswith(suffix) and os.path.join(root, d) != final_dir:
+                shutil.rmtree(os.path.join(root, d), ignore_errors=True)
+        return final_dir
+
+    @classmethod
+    def load(cls, root, snapshot, window=DEFAULT_WINDOW):
+        """加载与快照版本对应的索引（内存映射），不存在返回 None"""
+        path = cls._dir(root, snapshot, window)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {}
+        for name in ['rows', 'stock', 'features', 'planes'] + [f'{k}{t}' for t in range(meta['tables']) for k in ('sig', 'ids')]:
+            arrays[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        return cls(snapshot, meta, arrays, path=path)
+
+    @classmethod
+    def load_or_build(cls, root, snapshot, window=DEFAULT_WINDOW):
+        index = cls.load(root, snapshot, window)
+        if index is None:
+            start = time.time()
+            index = cls.build(snapshot, window)
+            index.save(root)
+            print(f"[INFO] 形态索引已建立: {index.meta['windows']} 个窗口，耗时 {time.time() - start:.1f}s")
+        return index
+
+    def _row_of(self, code, date_str):
+        """快照中 code 在 date_str（该日无数据时取之前最近一个交易日）的行号"""
+        i = self.snapshot._index.get(code)
+        if i is None:
+            return None
+        lo, hi = int(self._offsets[i]), int(self._offsets[i + 1])
+        day = self.snapshot._day_index(date_str, 'right') - 1
+        k = lo + int(np.searchsorted(self.snapshot.arrays['day_idx'][lo:hi], day, side='right')) - 1
+        return k if k >= lo else None
+
+    def query_vector(self, code, date_str):
+        """code 以 date_str 为终点的窗口的特征，历史不足返回 None"""
+        row = self._row_of(code, date_str)
+        i = self.snapshot._index.get(code)
+        if row is None or row - self.window < int(self._offsets[i]):
+            return None, row
+        closes = np.asarray(self.snapshot.arrays['收盘'][row - self.window:row + 1])
+        volumes = np.asarray(self.snapshot.arrays['成交量'][row - self.window + 1:row + 1])
+        return pattern_features(closes, volumes), row
+
+    def _probes(self, vector):
+        """每张表要探测的签名：原签名、最不确定的 PROBE_BITS 位的全部翻转组合、其余各位的单独翻转
+
+        查询向量离某个超平面越近（投影绝对值越小），相似窗口在该位上与查询签名不同的概率越大，优先翻转这些位
+        """
+        projections = (np.asarray(self.arrays['planes']) @ vector).reshape(-1, self.bits)
+        bit = (1 << np.arange(self.bits, dtype=np.int64))
+        sig = ((projections > 0) * bit).sum(axis=1)
+        probes = []
+        for t in range(len(sig)):
+            order = np.argsort(np.abs(projections[t]))
+            weak, rest = bit[order[:PROBE_BITS]], bit[order[PROBE_BITS:]]
+            combos = (((np.arange(1 << len(weak))[:, None] >> np.arange(len(weak))) & 1) * weak).sum(axis=1)
+            flips = np.concatenate([combos, rest])
+            probes.append((sig[t] ^ flips).astype(np.uint32))
+        return probes
+
+    def _candidates(self, vector):
+        found = []
+        for t, wanted in enumerate(self._probes(vector)):
+            keys = self.arrays[f'sig{t}']
+            left = np.searchsorted(keys, wanted, side='left')
+            right = np.minimum(np.searchsorted(keys, wanted, side='right'), left + MAX_BUCKET)
+            ids = self.arrays[f'ids{t}']
+            for a, b in zip(left, right):
+                if b > a:
+                    found.append(ids[a:b])
+        if not found:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(found)
+
+    def search(self, vector, k=20, exclude_row=None, distinct=True, forward=(5, 10), exact=False):
+        """相似度最高的 k 个窗口
+
+        Args:
+            vector: 查询特征（pattern_features 的结果）
+            exclude_row: 查询窗口自身在快照中的终点行，与其重叠的同一股票窗口不返回
+            distinct: 每只股票只返回相似度最高的一个窗口
+            forward: 附带窗口终点之后 N 个交易日的收益（%），用于观察形态之后的走势
+            exact: 为 True 时不用 LSH，对全部窗口计算相似度（结果精确，耗时与窗口数成正比）
+        Returns:
+            [{code, name, start_date, end_date, similarity, after: {N: 收益}}]，按相似度降序
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        if exact:
+            cand = np.arange(len(self.arrays['rows']))
+        else:
+            cand = self._candidates(vector)  # 可能有重复（同一窗口落在多张表的探测桶中）
+        if len(cand) == 0:
+            return []
+        scores = self.arrays['features'][cand].astype(np.float32) @ vector
+        rows, stock = self.arrays['rows'][cand], self.arrays['stock'][cand]
+        if exclude_row is not None:
+            q_stock = np.searchsorted(self._offsets, exclude_row, side='right') - 1
+            keep = ~((stock == q_stock) & (np.abs(rows - exclude_row) <= self.window))
+            rows, stock, scores = rows[keep], stock[keep], scores[keep]
+
+        # 只对得分最高的一部分排序；去重/每股一个后不足 k 个时再扩大
+        limit = k * (20 if distinct else 4)
+        while True:
+            if limit < len(scores):
+                top = np.argpartition(-scores, limit)[:limit]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind='stable')]
+            _, first = np.unique(stock[top] if distinct else rows[top], return_index=True)
+            top = top[np.sort(first)]
+            if len(top) >= k or limit >= len(scores):
+                break
+            limit *= 4
+        rows, stock, scores = rows[top], stock[top], scores[top]
+
+        calendar = self.snapshot.arrays['calendar']
+        day_idx = self.snapshot.arrays['day_idx']
+        close = self.snapshot.arrays['收盘']
+        results = []
+        for r, s, score in zip(rows[:k], stock[:k], scores[:k]):
+            r, s = int(r), int(s)
+            code = self.snapshot.codes[s]
+            after = {}
+            for n in forward:
+                if r + n < int(self._offsets[s + 1]) and close[r] > 0:
+                    after[n] = round(float(close[r + n] / close[r] - 1) * 100, 2)
+            results.append({
+                'code': code,
+                'name': self._names.get(code, ''),
+                'start_date': str(calendar[day_idx[r - self.window + 1]]),
+                'end_date': str(calendar[day_idx[r]]),
+                'similarity': round(float(score), 4),
+                'after': after,
+            })
+        return results
+
+    def search_like(self, code, date_str, k=20, distinct=True, exact=False):
+        """与 code 以 date_str 为终点的形态最相似的 k 个窗口（排除自身重叠窗口）"""
+        vector, row = self.query_vector(code, date_str)
+        if vector is None:
+            raise ValueError(f'{code} 在 {date_str} 之前不足 {self.window + 1} 个交易日或不在快照中')
+        return self.search(vector, k=k, exclude_row=row, distinct=distinct, exact=exact)
+
+
+def main():
+    from data_fetcher import DataFetcher
+
+    parser = argparse.ArgumentParser(description='K 线形态相似度搜索')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    b = sub.add_parser('build', help='为当前快照建立形态索引')
+    b.add_argument('--window', type=int, default=DEFAULT_WINDOW)
+    s = sub.add_parser('search', help='查找与某只股票某日之前形态最相似的窗口')
+    s.add_argument('code')
+    s.add_argument('date', help='终点日期 YYYY-MM-DD')
+    s.add_argument('--window', type=int, default=DEFAULT_WINDOW)
+    s.add_argument('--k', type=int, default=20)
+    s.add_argument('--exact', action='store_true', help='不用 LSH，精确计算全部窗口')
+    args = parser.parse_args()
+
+    fetcher = DataFetcher()
+    snapshot = fetcher.snapshot or fetcher.load_snapshot()
+    if snapshot is None:
+        print('[ERROR] 没有快照，请先运行每日任务（daily_run.py）生成快照')
+        return
+    root = os.path.join(fetcher.cache_dir, 'similarity')
+    index = SimilarityIndex.load_or_build(root, snapshot, args.window)
+    if args.cmd == 'search':
+        start = time.perf_counter()
+        results = index.search_like(args.code, args.date, k=args.k, exact=args.exact)
+        print(f'[INFO] 查询耗时 {(time.perf_counter() - start) * 1000:.1f}ms')
+        for r in results:
+            after = ' '.join(f'{n}日后 {v:+.2f}%' for n, v in r['after'].items())
+            print(f"{r['code']} {r['name']} | {r['start_date']} ~ {r['end_date']} | 相似度 {r['similarity']:.3f} | {after}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常驻策略：每日入库后只对新的交易日 T 增量判断，并输出与上一次相比的变化
+
+策略与状态保存在 cache/standing/<名称>.json：
+    strategy     策略定义（与 /api/backtest 相同）
+    last_date    已判断到的最新交易日
+    results      当前结果（与 backtest 相同：每只股票最近 timeRange 个交易日内最新的符合日）
+    last_delta   最近一次运行的变化（新增 / 移出）
+
+增量判断只看 last_date 之后的交易日：从快照取全市场每只股票截至 T 的最近几行，
+在 [股票数 × 偏移] 的数组上向量化判断全部条件；旧结果中超出 timeRange 窗口的移出，现价更新为最新收盘价。
+含周线/月线、截面排名、绝对日期或未来偏移的策略不支持增量，退化为完整回测。
+
+用法:
+    python standing.py add 每日策略 strategy.json
+    python standing.py list
+    python standing.py remove 每日策略
+    python standing.py run          # 每日任务保存快照后调用，变化写入 results/常驻策略_变化_latest.txt
+"""
+import os
+os.environ['NO_PROXY'] = '*'
+os.environ['no_proxy'] = '*'
+
+from datetime import datetime
+import argparse
+import json
+import shutil
+import time
+
+import numpy as np
+
+from strategy_engine import sort_results, write_results_file
+
+LIMIT_PCT = 9.8  # 与策略引擎的涨停判断一致
+INCREMENTAL_TYPES = ('limit_up', 'pct_change_gt', 'pct_change_lt', 'volume_ratio', 'breadth_gt', 'breadth_lt')
+DELTA_REPORT = '常驻策略_变化_latest.txt'
+
+
+def supports_incremental(conditions):
+    """策略能否只判断新的 T：仅日线的逐股条件/市场宽度条件，偏移为不大于 0 的交易日数"""
+    for c in conditions:
+        if c.get('type') not in INCREMENTAL_TYPES or c.get('timeframe', 'D') != 'D':
+            return False
+        for key in ('date1', 'date2'):
+            value = c.get(key, 0)
+            if not isinstance(value, (int, float)) or value > 0:
+                return False
+    return True
+
+
+def _offsets(conditions):
+    keys = ['date1', 'date2']
+    return [int(c.get(k, 0)) for c in conditions for k in keys
+            if k == 'date1' or c.get('type') == 'volume_ratio']
+
+
+class StandingStrategies:
+    """常驻策略的保存、增量判断与变化报告"""
+
+    def __init__(self, data_fetcher, strategy_engine, state_dir=None):
+        self.data_fetcher = data_fetcher
+        self.strategy_engine = strategy_engine
+        self.state_dir = state_dir or os.path.join(data_fetcher.cache_dir, 'standing')
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _path(self, name):
+        if not name or '/' in name or '\\' in name or name.startswith('.'):
+            raise ValueError(f'非法的策略名称: {name}')
+        return os.path.join(self.state_dir, f'{name}.json')
+
+    def _load(self, name):
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self, entry):
+        path = self._path(entry['name'])
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, path)
+
+    def add(self, name, strategy):
+        """保存（或替换）常驻策略；策略变化后状态清空，下次运行时完整回测一次"""
+        entry = self._load(name)
+        if entry is None or entry.get('strategy') != strategy:
+            entry = {'name': name, 'strategy': strategy, 'created_at': datetime.now().isoformat(),
+                     'last_date': None, 'results': [], 'last_delta': None}
+        self._save(entry)
+        return entry
+
+    def remove(self, name):
+        path = self._path(name)
+        if os.path.exists(path):
+            os.remove(path)
+            return True
+        return False
+
+    def get(self, name):
+        """常驻策略定义，不存在返回 None"""
+        entry = self._load(name)
+        return entry['strategy'] if entry is not None else None
+
+    def names(self):
+        return sorted(f[:-5] for f in os.listdir(self.state_dir) if f.endswith('.json'))
+
+    def list(self):
+        entries = []
+        for name in self.names():
+            entry = self._load(name)
+            if entry is not None:
+                entries.append({'name': name, 'strategy': entry['strategy'], 'last_date': entry.get('last_date'),
+                                'count': len(entry.get('results') or []), 'last_delta': entry.get('last_delta')})
+        return entries
+
+    def run_all(self):
+        """对全部常驻策略增量判断，返回 [{name, date, new, dropped, count, mode, seconds}]"""
+        snapshot = self.data_fetcher.snapshot or self.data_fetcher.load_snapshot()
+        deltas = []
+        for name in self.names():
+            try:
+                deltas.append(self.run(name, snapshot))
+            except Exception as e:
+                print(f'[ERROR] 常驻策略 {name} 运行失败: {e}')
+        return deltas
+
+    def run(self, name, snapshot=None):
+        entry = self._load(name)
+        if entry is None:
+            raise ValueError(f'常驻策略不存在: {name}')
+        strategy = entry['strategy']
+        conditions = strategy.get('conditions', [])
+        previous = entry.get('results') or []
+        start = time.time()
+
+        if (snapshot is not None and entry.get('last_date') and supports_incremental(conditions)
+                and snapshot.last_date is not None and snapshot.last_date >= entry['last_date']):
+            results, last_date = self._run_incremental(entry, snapshot)
+            mode = 'incremental'
+        else:
+            results = self.strategy_engine.backtest(strategy, strategy_name=name)
+            last_date = snapshot.last_date if snapshot is not None else self.data_fetcher._get_last_trading_day()
+            mode = 'full'
+        seconds = time.time() - start
+
+        before = {(r['code'], r['match_date']) for r in previous}
+        codes_now = {r['code'] for r in results}
+        delta = {
+            'name': name,
+            'date': last_date,
+            'new': [r for r in results if (r['code'], r['match_date']) not in before],
+            'dropped': [r for r in previous if r['code'] not in codes_now],
+            'count': len(results),
+            'mode': mode,
+            'seconds': round(seconds, 4),
+        }
+        entry['results'] = results
+        entry['last_date'] = last_date
+        entry['updated_at'] = datetime.now().isoformat()
+        entry['last_delta'] = {
+            'date': last_date, 'count': len(results), 'mode': mode, 'seconds': delta['seconds'],
+            'new': [r['code'] for r in delta['new']],
+            'dropped': [r['code'] for r in delta['dropped']],
+        }
+        self._save(entry)
+        if mode == 'incremental' and results:
+            write_results_file(self.strategy_engine.get_results_path(name), name, results)
+        print(f"[INFO] 常驻策略 {name}（{'增量' if mode == 'incremental' else '完整回测'}）: "
+              f"新增 {len(delta['new'])} 只，移出 {len(delta['dropped'])} 只，共 {len(results)} 只，"
+              f"耗时 {seconds * 1000:.1f} 毫秒")
+        return delta
+
+    def _run_incremental(self, entry, snapshot):
+        """只判断 last_date 之后的交易日，更新已有结果"""
+        strategy = entry['strategy']
+        conditions = strategy.get('conditions', [])
+        time_range = strategy.get('timeRange', 30)
+        calendar = snapshot.arrays['calendar']
+        first_new = int(np.searchsorted(calendar, np.datetime64(entry['last_date']), side='right'))
+        # 与完整回测相同的股票池：历史时点股票池可用时每个 T 只判断当天在池内的股票，否则为当前股票列表
+        universe_stocks, universe = None, None
+        if first_new < len(calendar):
+            universe_stocks, universe = self.strategy_engine.resolve_universe(
+                strategy, datetime.fromisoformat(str(calendar[first_new])), datetime.fromisoformat(str(calendar[-1])))
+        stocks = universe_stocks if universe is not None else self.data_fetcher.get_stock_list()
+        names = {s['code']: s['name'] for s in stocks}
+        codes = np.array(snapshot.codes)
+        listed = np.array([c in names for c in snapshot.codes], dtype=bool)
+
+        results = {r['code']: dict(r) for r in entry.get('results') or []}
+        for t_idx in range(first_new, len(calendar)):
+            matched, close = self.evaluate_day(snapshot, conditions, t_idx)
+            date_str = str(calendar[t_idx])
+            if universe is not None:
+                members = set(universe.members(date_str))
+                listed = np.array([c in members for c in snapshot.codes], dtype=bool)
+            for i in np.flatnonzero(matched & listed):
+                code = str(codes[i])
+                results[code] = {'code': code, 'name': names.get(code, code), 'match_date': date_str,
+                                 'current_price': float(close[i]), 'match_price': float(close[i])}
+
+        # 现价为最新收盘价；符合日超出每只股票最近 time_range 个交易日的移出
+        day, values = snapshot.tail_panel(['收盘'], max(int(time_range), 1))
+        index = snapshot._index
+        kept = []
+        for code, r in results.items():
+            i = index.get(code)
+            if i is None:
+                continue
+            cutoff = day[i, 0]
+            if cutoff >= 0 and r['match_date'] < str(calendar[cutoff]):
+                continue
+            last_close = values['收盘'][i, -1]
+            if not np.isnan(last_close):
+                r['current_price'] = float(last_close)
+            kept.append(r)
+        return sort_results(kept), str(calendar[-1])
+
+    def evaluate_day(self, snapshot, conditions, t_idx):
+        """全市场在交易日 t_idx 是否符合全部条件（向量化），返回 (布尔数组, T 日收盘价)，顺序同 snapshot.codes"""
+        back = max([0] + [-d for d in _offsets(conditions)])
+        k = back + 2
+        day, values = snapshot.tail_panel(['涨跌幅', '成交量', '收盘'], k, end_day=t_idx)
+        # T 日有数据，且 T 之前至少有 back + 1 个交易日（与 backtest 的 min_required_days 一致）
+        ok = (day[:, -1] == t_idx) & (day[:, 0] >= 0)
+        pct, vol = values['涨跌幅'], values['成交量']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for c in conditions:
+                cond_type = c.get('type')
+                p1 = k - 1 + int(c.get('date1', 0))
+                if cond_type == 'limit_up':
+                    ok &= pct[:, p1] >= LIMIT_PCT
+                elif cond_type == 'pct_change_gt':
+                    ok &= pct[:, p1] > c.get('value', 0)
+                elif cond_type == 'pct_change_lt':
+                    ok &= pct[:, p1] < c.get('value', 0)
+                elif cond_type == 'volume_ratio':
+                    p2 = k - 1 + int(c.get('date2', 0))
+                    v2 = vol[:, p2]
+                    ok &= (v2 != 0) & (vol[:, p1] / v2 > c.get('ratio', 1))
+                elif cond_type in ('breadth_gt', 'breadth_lt'):
+                    ok &= self._breadth_mask(snapshot, c, day[:, p1])
+                else:
+                    ok[:] = False
+        return ok, values['收盘'][:, -1]
+
+    def _breadth_mask(self, snapshot, condition, days):
+        """每只股票 date1 当日的市场宽度条件（按交易日查一次）"""
+        metric = condition.get('metric', 'limit_up_count')
+        threshold = condition.get('value', 0)
+        unique, inverse = np.unique(days, return_inverse=True)
+        calendar = snapshot.arrays['calendar']
+        passed = np.zeros(len(unique), dtype=bool)
+        for j, d in enumerate(unique):
+            if d < 0:
+                continue
+            value = self.data_fetcher.market_breadth.value(str(calendar[d]), metric)
+            if value is not None:
+                passed[j] = value > threshold if condition['type'] == 'breadth_gt' else value < threshold
+        return passed[inverse.ravel()]
+
+    def write_report(self, deltas, results_dir=None):
+        """写出变化报告（文本），同时更新 常驻策略_变化_latest.txt 供 send_email.py 作为正文"""
+        results_dir = results_dir or self.strategy_engine.results_dir
+        date = max((d['date'] for d in deltas if d.get('date')), default=datetime.now().strftime('%Y-%m-%d'))
+        lines = [f'常驻策略每日变化（{date}）', '']
+        for d in deltas:
+            lines.append(f"==== {d['name']} ====")
+            lines.append(f"新增 {len(d['new'])} 只：")
+            for r in d['new']:
+                lines.append(f"  {r['code']} {r['name']} | 匹配日: {r['match_date']} | 匹配价: {r['match_price']:.2f}")
+            if d['dropped']:
+                lines.append(f"移出 {len(d['dropped'])} 只：" + '、'.join(f"{r['code']} {r['name']}" for r in d['dropped']))
+            lines.append(f"当前共 {d['count']} 只")
+            lines.append('')
+        if not deltas:
+            lines.append('没有常驻策略')
+        path = os.path.join(results_dir, f'常驻策略_变化_{date}.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+        shutil.copyfile(path, os.path.join(results_dir, DELTA_REPORT))
+        return path
+
+
+def main():
+    from data_fetcher import DataFetcher
+    from strategy_engine import StrategyEngine
+
+    parser = argparse.ArgumentParser(description='常驻策略：每日增量判断')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    a = sub.add_parser('add', help='保存常驻策略')
+    a.add_argument('name')
+    a.add_argument('strategy', help='策略 JSON 文件')
+    r = sub.add_parser('remove', help='删除常驻策略')
+    r.add_argument('name')
+    sub.add_parser('list', help='列出常驻策略')
+    sub.add_parser('run', help='增量判断全部常驻策略并写出变化报告')
+    args = parser.parse_args()
+
+    fetcher = DataFetcher()
+    standing = StandingStrategies(fetcher, StrategyEngine(fetcher, max_workers=30))
+    if args.cmd == 'add':
+        with open(args.strategy, 'r', encoding='utf-8') as f:
+            standing.add(args.name, json.load(f))
+        print(f'[INFO] 已保存常驻策略: {args.name}')
+    elif args.cmd == 'remove':
+        print(f'[INFO] 已删除: {args.name}' if standing.remove(args.name) else f'[WARNING] 不存在: {args.name}')
+    elif args.cmd == 'list':
+        for e in standing.list():
+            print(f"{e['name']} | 最新判断日: {e['last_date']} | 当前 {e['count']} 只")
+    else:
+        path = standing.write_report(standing.run_all())
+        print(f'[INFO] 变化报告: {path}')
+
+
+if __name__ == '__main__':
+    main()
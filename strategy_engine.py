@@ -1,24 +1,84 @@
 from datetime import datetime, timedelta
 from data_fetcher import DataFetcher
+from resample import period_ordinal, period_to_date
+from cross_section import CrossSection, has_cross_sectional, is_cross_sectional, offset_trading_day
+from scheduler import FairScheduler
+from similarity import DEFAULT_WINDOW as SIMILAR_WINDOW, frame_features
+from strategy_profile import StrategyProfile
+from preview import DEFAULT_FRACTION, MIN_PER_BOARD, board_of, estimate_matches, stratified_sample
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from concurrent.futures import as_completed
 from threading import Lock
 import json
 import os
+import time
+
+CHUNK_DAYS = 250  # 回测区间超过该交易日数时按时间分块判断（约一年）
+
+def sort_results(results):
+    """按符合日期从小到大排序（日期早的在前），同日期按代码排"""
+    results.sort(key=lambda r: (r.get('match_date', '9999-99-99'), r.get('code', '')))
+    return results
+
+
+def write_results_file(filepath, strategy_name, results):
+    """写入结果文件：首行元信息，之后每行一条结果"""
+    with open(filepath, 'w', encoding='utf-8') as f:
+        meta = {'_meta': {'strategy_name': strategy_name, 'run_at': datetime.now().isoformat(), 'count': len(results)}}
+        f.write(json.dumps(meta, ensure_ascii=False, default=str) + '\n')
+        for r in results:
+            f.write(json.dumps(r, ensure_ascii=False, default=str) + '\n')
+
+
+def offset_span(conditions):
+    """日线条件中最大的向前、向后偏移（交易日数）(backward, forward)；绝对日期的偏移不计"""
+    backward, forward = 0, 0
+    for c in conditions:
+        if c.get('timeframe', 'D') != 'D':
+            continue
+        for key in ('date1', 'date2'):
+            offset = c.get(key, 0)
+            if isinstance(offset, (int, float)):
+                backward = max(backward, -int(offset))
+                forward = max(forward, int(offset))
+    return backward, forward
+
 
 class StrategyEngine:
     """策略回测引擎"""
     
-    def __init__(self, data_fetcher: DataFetcher, max_workers=10):
+    def __init__(self, data_fetcher: DataFetcher, max_workers=10, results_dir=None, scheduler=None,
+                 chunk_days=CHUNK_DAYS):
         self.data_fetcher = data_fetcher
         self.max_workers = max_workers  # 并发线程数
+        self.chunk_days = chunk_days  # 分块判断时每块的交易日数
+        # 所有回测共用的有界线程池，并发回测之间按作业轮转公平分配线程
+        self.scheduler = scheduler or FairScheduler(max_workers)
         self.results_lock = Lock()  # 线程锁
+        self._similar_refs = {}  # (code, date, window) -> 参照形态特征（similar 条件）
+        self._similar_lock = Lock()
+        # 预览判断过的股票 {(策略, 缓存版本, 窗口): {code: 结果或 None}}，完整回测时复用
+        self._preview_outcomes = OrderedDict()
+        self._preview_lock = Lock()
         # 结果持久化目录
-        self.results_dir = os.path.join(os.path.dirname(__file__), 'results')
+        self.results_dir = results_dir or os.path.join(os.path.dirname(__file__), 'results')
         os.makedirs(self.results_dir, exist_ok=True)
     
-    def backtest(self, strategy, strategy_name=None):
-        """执行策略回测（优化版：分阶段筛选 + 实时持久化）"""
+    def backtest(self, strategy, strategy_name=None, stocks=None, explain=False):
+        """执行策略回测（优化版：分阶段筛选 + 实时持久化）
+
+        Args:
+            stocks: 只回测这些股票（[{'code', 'name'}]），默认全部主板股票；已建立历史时点股票池时默认为
+                    窗口内曾在池内的股票（含已退市），每个 T 只判断当天在池内的股票（策略 universe='current' 关闭）
+            explain: 为 True 时返回 (results, StrategyProfile)，记录各条件作用/通过的候选数与耗时
+
+        整个回测固定读同一个日线缓存版本，入库同时进行也不会读到一半新一半旧的数据
+        """
+        with self.data_fetcher.pin_cache_version() as cache_version:
+            return self._backtest(strategy, strategy_name, stocks, explain, cache_version)
+
+    def _backtest(self, strategy, strategy_name, stocks, explain, cache_version):
         # 解析策略条件
         conditions = strategy.get('conditions', [])
         exclude_rules = strategy.get('exclude', {})
@@ -29,94 +89,389 @@ class StrategyEngine:
             strategy_name = f"策略_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
         # 结果文件路径（每条结果实时追加）
-        results_filepath = os.path.join(self.results_dir, f"{strategy_name}_结果.jsonl")
-        
-        # 获取所有股票
-        stocks = self.data_fetcher.get_stock_list()
+        results_filepath = self.get_results_path(strategy_name)
         
         # 计算回测时间范围：timeRange 为交易日数，不含周末
-        # 约 1 交易日 ≈ 1.4 日历日，多取一些确保覆盖
-        end_date = datetime.now()
-        calendar_days = int(time_range * 1.6) + 10  # 确保覆盖 timeRange 个交易日
-        start_date = end_date - timedelta(days=calendar_days)
+        start_date, end_date = self.get_backtest_window(time_range, conditions=conditions)
+        
+        # 获取所有股票（历史时点股票池优先，包括窗口内退市的股票）
+        universe_stocks, universe = self.resolve_universe(strategy, start_date, end_date)
+        if stocks is None:
+            stocks = universe_stocks if universe is not None else self.data_fetcher.get_stock_list()
+        self._similar_refs.clear()
         
         results = []
         total_stocks = len(stocks)
-        processed_count = [0]  # 使用列表以便在闭包中修改
+        # 刚预览过同一策略（同一缓存版本）时，样本中的股票直接复用预览的判断结果
+        reused = {} if explain else self._take_preview(strategy, cache_version, start_date, end_date)
+        pending = [s for s in stocks if s['code'] not in reused]
+        for stock in stocks:
+            if reused.get(stock['code']):
+                results.append(reused[stock['code']])
+                self._append_result(results_filepath, strategy_name, reused[stock['code']], len(results))
+        if reused:
+            print(f"复用预览结果: {total_stocks - len(pending)} 只股票，其中 {len(results)} 只符合条件")
+        processed_count = [total_stocks - len(pending)]  # 使用列表以便在闭包中修改
+        profile = StrategyProfile(conditions) if explain else None
+        if profile is not None:
+            profile.counters['stocks'] = total_stocks
         
-        print(f"开始回测，共 {total_stocks} 只股票，回测最近 {time_range} 个交易日，使用 {self.max_workers} 个并发线程")
+        print(f"开始回测，共 {total_stocks} 只股票，回测最近 {time_range} 个交易日，共享 {self.scheduler.max_workers} 个工作线程")
         
-        # 使用线程池并发处理
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # 提交所有任务（time_range=交易日数）
-            future_to_stock = {
-                executor.submit(self._process_stock, stock, conditions, start_date, end_date, time_range): stock
-                for stock in stocks
-            }
+        # 回测区间超过 chunk_days 个交易日时按时间分块，从新到旧逐块判断，每块只加载本块及回看重叠部分的数据；
+        # 已在较新的块中找到匹配的股票不再判断更早的块（结果本就取最近的匹配日）
+        chunks = self.time_chunks(time_range, conditions) if time_range > self.chunk_days else [None]
+        if chunks[0] is not None:
+            print(f"按时间分块判断: {len(chunks)} 块，每块 {self.chunk_days} 个交易日（从新到旧）")
+            # 各块按日期范围从快照切片：每只股票的缓存文件最多解析一次，内存随块长而不随历史长度增长
+            self.data_fetcher.ensure_snapshot(cache_version)
+        for k, chunk in enumerate(chunks):
+            if chunk is None:
+                load_start, load_end, t_range = start_date, end_date, None
+            else:
+                load_start, load_end, t_range = chunk[0], chunk[1], (chunk[2], chunk[3])
+                print(f"分块 {k + 1}/{len(chunks)}: T 为 {chunk[2]:%Y-%m-%d} ~ {chunk[3]:%Y-%m-%d}，待判断 {len(pending)} 只股票")
+            processed_count[0] = total_stocks - len(pending)
             
-            # 处理完成的任务
-            for future in as_completed(future_to_stock):
-                stock = future_to_stock[future]
-                processed_count[0] += 1
-                
-                # 每10只股票显示一次进度（更频繁的进度更新）
-                if processed_count[0] % 10 == 0:
-                    percentage = 100 * processed_count[0] // total_stocks if total_stocks > 0 else 0
-                    print(f"进度: {processed_count[0]}/{total_stocks} ({percentage}%) - 已找到 {len(results)} 只符合条件的股票", flush=True)
+            # 含截面条件时先加载全市场数据（分块时只加载本块），每个交易日的排名只算一次
+            stock_frames, cross_section = {}, None
+            if has_cross_sectional(conditions):
+                cs_start = time.time()
+                stock_frames = self.load_stock_frames(stocks, load_start, load_end, cache_version)
+                cross_section = CrossSection.build(self._universe_frames(stock_frames, universe), conditions,
+                                                   self._trading_days(load_start, load_end))
+                print(f"截面排名已计算: {len(stock_frames)} 只股票")
+                if profile is not None:
+                    profile.timers['cross_section_seconds'] += time.time() - cs_start
+            
+            matched = set()
+            # 提交到共享线程池（与同时进行的其他回测轮流执行）
+            with self.scheduler.job(strategy_name) as job:
+                # 提交所有任务（time_range=交易日数）
+                future_to_stock = {
+                    job.submit(self._process_stock, stock, conditions, load_start, load_end, time_range,
+                               stock_frames.get(stock['code']), cross_section, profile, universe, cache_version,
+                               t_range): stock
+                    for stock in pending
+                }
                 
-                try:
-                    result = future.result(timeout=30)  # 添加30秒超时
-                    if result:
-                        with self.results_lock:
-                            results.append(result)
-                            self._append_result(results_filepath, strategy_name, result, len(results))
-                            print(f"✓ 找到符合条件的股票: {result['code']} {result['name']}", flush=True)
-                except Exception as e:
-                    # 输出错误信息以便调试
-                    if processed_count[0] % 100 == 0:  # 每100只股票输出一次错误统计
-                        print(f"[WARNING] 处理股票时出错: {type(e).__name__}", flush=True)
-                    continue
+                # 处理完成的任务
+                for future in as_completed(future_to_stock):
+                    stock = future_to_stock[future]
+                    processed_count[0] += 1
+                    
+                    # 每10只股票显示一次进度（更频繁的进度更新）
+                    if processed_count[0] % 10 == 0:
+                        percentage = 100 * processed_count[0] // total_stocks if total_stocks > 0 else 0
+                        print(f"进度: {processed_count[0]}/{total_stocks} ({percentage}%) - 已找到 {len(results)} 只符合条件的股票", flush=True)
+                    
+                    try:
+                        result = future.result(timeout=30)  # 添加30秒超时
+                        if result:
+                            if k > 0:
+                                # 较早的块不含最新数据，现价取最近收盘价
+                                result['current_price'] = self._latest_close(result['code'], cache_version) or result['current_price']
+                            matched.add(result['code'])
+                            with self.results_lock:
+                                results.append(result)
+                                self._append_result(results_filepath, strategy_name, result, len(results))
+                                print(f"✓ 找到符合条件的股票: {result['code']} {result['name']}", flush=True)
+                    except Exception as e:
+                        # 输出错误信息以便调试
+                        if processed_count[0] % 100 == 0:  # 每100只股票输出一次错误统计
+                            print(f"[WARNING] 处理股票时出错: {type(e).__name__}", flush=True)
+                        continue
+            pending = [s for s in pending if s['code'] not in matched]
+            if not pending:
+                break
         
         print(f"回测完成！共检查 {total_stocks} 只股票，找到 {len(results)} 只符合条件的股票")
         if results:
-            # 按符合日期从小到大排序（日期早的在前），同日期按代码排
-            results.sort(key=lambda r: (r.get('match_date', '9999-99-99'), r.get('code', '')))
+            sort_results(results)
             self._write_sorted_results(results_filepath, strategy_name, results)
             print(f"结果已保存（按符合日期排序）: {results_filepath}")
+        if profile is not None:
+            profile.counters['matched_stocks'] = len(results)
+            profile.finish()
+            print(profile.format())
+            return results, profile
         return results
     
+    def preview(self, strategy, fraction=DEFAULT_FRACTION, seed=None, min_per_board=MIN_PER_BOARD):
+        """预览：在按板块分层的随机样本上判断策略，估计全市场匹配数（见 preview.py）
+
+        Returns:
+            {'population', 'sampled', 'sample_matches', 'estimated_matches', 'ci95': [下限, 上限],
+             'strata': {板块: {'population', 'sampled', 'matches'}}, 'results': 样本中的匹配, 'seconds'}
+
+        样本中每只股票的判断结果保留到同一策略的下一次完整回测（缓存版本不变时复用，不重复判断）；
+        含截面条件时排名仍需全市场数据，预览只省去逐只判断的时间
+        """
+        started = time.time()
+        with self.data_fetcher.pin_cache_version() as cache_version:
+            conditions = strategy.get('conditions', [])
+            time_range = strategy.get('timeRange', 30)
+            start_date, end_date = self.get_backtest_window(time_range, conditions=conditions)
+            universe_stocks, universe = self.resolve_universe(strategy, start_date, end_date)
+            stocks = universe_stocks if universe is not None else self.data_fetcher.get_stock_list()
+            sample, strata = stratified_sample(stocks, fraction, seed, min_per_board)
+            self._similar_refs.clear()
+
+            stock_frames, cross_section = {}, None
+            if has_cross_sectional(conditions):
+                stock_frames = self.load_stock_frames(stocks, start_date, end_date, cache_version)
+                cross_section = CrossSection.build(self._universe_frames(stock_frames, universe), conditions,
+                                                   self._trading_days(start_date, end_date))
+
+            outcomes = {}
+            with self.scheduler.job(f"预览_{datetime.now().strftime('%H%M%S')}") as job:
+                future_to_stock = {
+                    job.submit(self._process_stock, stock, conditions, start_date, end_date, time_range,
+                               stock_frames.get(stock['code']), cross_section, None, universe, cache_version): stock
+                    for stock in sample
+                }
+                for future in as_completed(future_to_stock):
+                    try:
+                        outcomes[future_to_stock[future]['code']] = future.result(timeout=30)
+                    except Exception:
+                        continue  # 出错的股票不计入样本，完整回测时重新判断
+
+        for board in strata:
+            strata[board]['matches'] = 0
+        for code, result in outcomes.items():
+            if result:
+                strata[board_of(code)]['matches'] += 1
+        for board in strata:
+            strata[board]['sampled'] = sum(1 for code in outcomes if board_of(code) == board)
+        estimate, (low, high) = estimate_matches(strata)
+        with self._preview_lock:
+            key = self._preview_key(strategy, cache_version, start_date, end_date)
+            self._preview_outcomes[key] = outcomes
+            self._preview_outcomes.move_to_end(key)
+            while len(self._preview_outcomes) > 8:
+                self._preview_outcomes.popitem(last=False)
+
+        results = sort_results([r for r in outcomes.values() if r])
+        report = {
+            'population': len(stocks),
+            'sampled': len(outcomes),
+            'sample_matches': len(results),
+            'estimated_matches': round(estimate, 1),
+            'ci95': [round(low, 1), round(high, 1)],
+            'strata': strata,
+            'results': results,
+            'seconds': round(time.time() - started, 3),
+        }
+        print(f"预览完成: 样本 {report['sampled']}/{report['population']} 只，匹配 {report['sample_matches']} 只，"
+              f"估计全市场 {report['estimated_matches']:.0f} 只（95% 区间 {report['ci95'][0]:.0f}~{report['ci95'][1]:.0f}），"
+              f"耗时 {report['seconds']:.2f} 秒")
+        return report
+
+    @staticmethod
+    def _preview_key(strategy, cache_version, start_date, end_date):
+        return (json.dumps(strategy, sort_keys=True, ensure_ascii=False, default=str), cache_version,
+                start_date.date(), end_date.date())
+
+    def _take_preview(self, strategy, cache_version, start_date, end_date):
+        """取出（并移除）同一策略、同一缓存版本与窗口的预览判断结果 {code: 结果或 None}"""
+        with self._preview_lock:
+            return self._preview_outcomes.pop(self._preview_key(strategy, cache_version, start_date, end_date), {})
+
+    def get_backtest_window(self, time_range=30, end_date=None, conditions=None):
+        """回测所需的日历日期范围 (start_date, end_date)
+
+        约 1 交易日 ≈ 1.4 日历日，多取一些确保覆盖 timeRange 个交易日；
+        含周线/月线条件时再往前多取一个周期，保证最早的 T 所在周期的当期K线完整
+        """
+        if end_date is None:
+            end_date = datetime.now()
+        calendar_days = int(time_range * 1.6) + 10
+        timeframes = {c.get('timeframe', 'D') for c in (conditions or [])}
+        if 'M' in timeframes:
+            calendar_days += 31
+        elif 'W' in timeframes:
+            calendar_days += 7
+        windows = [int(c.get('window', SIMILAR_WINDOW)) for c in (conditions or []) if c.get('type') == 'similar']
+        if windows:
+            calendar_days += int(max(windows) * 1.6) + 5  # 形态窗口在 T+date1 之前
+        return end_date - timedelta(days=calendar_days), end_date
+
+    def time_chunks(self, time_range, conditions=None, end_date=None):
+        """分块判断的时间块（从新到旧）：最近 time_range 个交易日按 chunk_days 切分
+
+        Returns:
+            [(load_start, load_end, first_t, last_t)]：只把 [first_t, last_t] 内的交易日作为 T，
+            数据加载 [load_start, load_end]，向前重叠最大回看偏移，向后留出 T+n 偏移
+        """
+        start_date, end_date = self.get_backtest_window(time_range, end_date, conditions)
+        days = self.data_fetcher.get_trading_days(start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))
+        days = days[-time_range:]
+        chunks = []
+        for hi in range(len(days), 0, -self.chunk_days):
+            first_t, last_t = pd.Timestamp(days[max(0, hi - self.chunk_days)]), pd.Timestamp(days[hi - 1])
+            chunks.append((*self._load_range(conditions or [], first_t, last_t), first_t, last_t))
+        return chunks
+
+    def _load_range(self, conditions, first_t, last_t):
+        """判断 T ∈ [first_t, last_t] 需要加载的日期范围 (start, end)
+
+        向前留出最大回看偏移（含周线/月线当期、形态窗口，同 get_backtest_window），向后留出最大的 T+n 偏移
+        """
+        backward, forward = offset_span(conditions)
+        load_start, _ = self.get_backtest_window(backward + 1, end_date=first_t.to_pydatetime(), conditions=conditions)
+        load_end = last_t + timedelta(days=int(forward * 1.6) + 10 if forward else 0)
+        return load_start, load_end.to_pydatetime()
+
+    def _latest_close(self, code, cache_version=None):
+        """最近交易日收盘价，无数据返回 None"""
+        end = datetime.now()
+        df = self.data_fetcher.get_stock_data(code, (end - timedelta(days=30)).strftime('%Y%m%d'), end.strftime('%Y%m%d'),
+                                              version=cache_version)
+        if df is None or df.empty:
+            return None
+        return float(df.sort_values('日期').iloc[-1]['收盘'])
+
+    def resolve_universe(self, strategy, start_date, end_date):
+        """历史时点股票池：已建立且策略未指定 universe='current' 时返回 (窗口内曾在池内的股票, StockUniverse)，
+        否则返回 (None, None)，回测使用当前股票列表且不逐日过滤"""
+        universe = self.data_fetcher.universe
+        if strategy.get('universe', 'point_in_time') == 'current' or not universe.available():
+            return None, None
+        info = universe.info()
+        if info.get('start') and start_date.strftime('%Y-%m-%d') < info['start']:
+            print(f"[WARNING] 回测窗口早于股票池起始日 {info['start']}，此前的 ST 区间可能不完整")
+        return universe.stocks_between(start_date, end_date), universe
+
+    @staticmethod
+    def _universe_frames(stock_frames, universe):
+        """截面排名只在当天的股票池内比较：去掉每只股票不在池内的交易日"""
+        if universe is None:
+            return stock_frames
+        frames = {}
+        for code, df in stock_frames.items():
+            mask = universe.mask(code, pd.to_datetime(df['日期']).to_numpy())
+            frames[code] = df[mask] if mask is not None else df
+        return frames
+
+    def get_results_path(self, strategy_name):
+        """结果文件路径（每条结果实时追加）"""
+        return os.path.join(self.results_dir, f"{strategy_name}_结果.jsonl")
+
+    def load_stock_frames(self, stocks, start_date, end_date, cache_version=None):
+        """并发加载全部股票在回测窗口内的数据，返回 {code: df}；cache_version 为固定读取的日线缓存版本"""
+        frames = {}
+        def load(code):
+            return code, self.data_fetcher.get_stock_data(code, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'),
+                                                          version=cache_version)
+        with self.scheduler.job() as job:
+            for future in as_completed([job.submit(load, s['code']) for s in stocks]):
+                try:
+                    code, df = future.result()
+                    if df is not None and not df.empty:
+                        frames[code] = df
+                except Exception:
+                    continue
+        return frames
+
+    def trim_to_window(self, df, conditions, time_range=30):
+        """把完整历史截取为回测窗口内的数据，与 backtest 加载的范围一致"""
+        start_date, _ = self.get_backtest_window(time_range, conditions=conditions)
+        return df[pd.to_datetime(df['日期']) >= pd.Timestamp(start_date.date())]
+
+    def evaluate_stock_df(self, stock, df, conditions, time_range=30, cross_section=None, universe=None,
+                          cache_version=None):
+        """对已在内存中的单只股票数据评估策略（不读磁盘，供流水线使用）
+
+        df 可以是完整历史，只截取回测窗口内的数据参与判断；universe（历史时点股票池）与 cache_version
+        （周线/月线读取的日线缓存版本）同 _process_stock，与 backtest 结果一致。出错时抛出异常，由调用方计数
+        """
+        if df is None or df.empty:
+            return None
+        df = self.trim_to_window(df, conditions, time_range)
+        check_result = self._check_strategy_df(df, conditions, time_range, stock['code'], cross_section, None,
+                                               universe, None, cache_version)
+        if check_result:
+            detail = self._get_stock_detail_from_check(stock['code'], stock['name'], conditions, check_result)
+            if detail:
+                return {'code': stock['code'], 'name': stock['name'], **detail}
+        return None
+
+    def inspect_match(self, code, conditions, match_date, cache_version=None):
+        """单只股票以 match_date 为 T 时每个条件的取值与是否成立（查看回测结果用，不短路）
+
+        Returns:
+            {'match_date', 'in_universe', 'conditions': [{'index', 'type', 'timeframe', 'passed', 'dates', 'values'}]}；
+            截面条件需要全市场排名，单只查看时 passed 为 None
+        """
+        base = pd.Timestamp(match_date)
+        start_date, end_date = self._load_range(conditions, base, base)
+        df = self.data_fetcher.get_stock_data(code, start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'),
+                                              version=cache_version)
+        if df is None or df.empty:
+            raise ValueError(f'{code} 没有 {base.date()} 附近的数据')
+        df = df.sort_values('日期').reset_index(drop=True)
+        if not (pd.to_datetime(df['日期']) == base).any():
+            raise ValueError(f'{code} 在 {base.date()} 没有K线（非交易日或停牌）')
+
+        date_map = self._build_date_map(df)
+        frames = self._prepare_timeframes(code, conditions, df, cache_version)
+        base_date = base.to_pydatetime()
+        items = []
+        for index, condition in enumerate(conditions):
+            passed = None
+            if not is_cross_sectional(condition):
+                passed = bool(self._evaluate_condition(condition, base_date, date_map, df, frames, code=code))
+            dates, values = self._condition_values(condition, base_date, date_map, df, frames)
+            items.append({'index': index, 'type': condition.get('type'), 'timeframe': condition.get('timeframe', 'D'),
+                          'passed': passed, 'dates': dates, 'values': values})
+
+        universe = self.data_fetcher.universe
+        mask = universe.mask(code, pd.to_datetime([base]).to_numpy()) if universe.available() else None
+        return {'match_date': base.strftime('%Y-%m-%d'),
+                'in_universe': bool(mask[0]) if mask is not None else None,
+                'conditions': items}
+
     def _append_result(self, filepath, strategy_name, result, count):
-        """每找到一条符合条件的结果就追加到文件"""
+        """每找到一条符合条件的结果就登记追加到文件（后台批量落盘，回测线程不等待磁盘）"""
         try:
+            lines = [json.dumps(result, ensure_ascii=False, default=str)]
             if count == 1:
-                # 第一条：写入元信息
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    meta = {'_meta': {'strategy_name': strategy_name, 'run_at': datetime.now().isoformat()}}
-                    f.write(json.dumps(meta, ensure_ascii=False, default=str) + '\n')
-            with open(filepath, 'a', encoding='utf-8') as f:
-                f.write(json.dumps(result, ensure_ascii=False, default=str) + '\n')
+                # 第一条：清空文件并写入元信息
+                meta = {'_meta': {'strategy_name': strategy_name, 'run_at': datetime.now().isoformat()}}
+                lines.insert(0, json.dumps(meta, ensure_ascii=False, default=str))
+            self.data_fetcher.writer.append(filepath, lines, reset=count == 1)
         except Exception as e:
             print(f"[WARNING] 追加结果失败: {e}")
     
     def _write_sorted_results(self, filepath, strategy_name, results):
-        """按符合日期排序后重写结果文件"""
+        """按符合日期排序后重写结果文件（取代尚未落盘的追加），等待落盘后返回"""
+        def render():
+            meta = {'_meta': {'strategy_name': strategy_name, 'run_at': datetime.now().isoformat(), 'count': len(results)}}
+            return ''.join(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in [meta] + results)
+
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                meta = {'_meta': {'strategy_name': strategy_name, 'run_at': datetime.now().isoformat(), 'count': len(results)}}
-                f.write(json.dumps(meta, ensure_ascii=False, default=str) + '\n')
-                for r in results:
-                    f.write(json.dumps(r, ensure_ascii=False, default=str) + '\n')
+            self.data_fetcher.writer.put(filepath, render)
+            self.data_fetcher.writer.flush()
         except Exception as e:
             print(f"[WARNING] 保存排序结果失败: {e}")
     
-    def _process_stock(self, stock, conditions, start_date, end_date, time_range=30):
-        """处理单只股票（用于并发）"""
+    def _process_stock(self, stock, conditions, start_date, end_date, time_range=30, df=None, cross_section=None,
+                       profile=None, universe=None, cache_version=None, t_range=None):
+        """处理单只股票（用于并发）；df 为已预加载的数据（可选）；profile 为 explain 模式的剖析汇总；
+        universe 为历史时点股票池，只把当天在池内的交易日作为 T；cache_version 为固定读取的日线缓存版本；
+        t_range 为分块判断时本块的 (first_t, last_t)"""
         code = stock['code']
         name = stock['name']
-        
+        stats = profile.local() if profile is not None else None
+
         try:
             # 检查是否符合策略（time_range=回测的交易日数，不含周末）
-            check_result = self._check_strategy(code, conditions, start_date, end_date, time_range)
+            if df is not None:
+                check_result = self._check_strategy_df(df, conditions, time_range, code, cross_section, stats,
+                                                       universe, t_range, cache_version)
+            else:
+                check_result = self._check_strategy(code, conditions, start_date, end_date, time_range, cross_section,
+                                                    stats, universe, cache_version, t_range)
             if check_result:
                 # 获取详细信息（check_result包含df和base_date，避免重复获取）
                 detail = self._get_stock_detail_from_check(code, name, conditions, check_result)
@@ -131,24 +486,56 @@ class StrategyEngine:
             if 'timeout' in str(e).lower() or 'connection' in str(e).lower():
                 pass  # 网络错误静默处理
             # 其他错误也静默处理，避免影响性能
-        
+            if stats is not None:
+                stats.error(-1, e)
+        finally:
+            if stats is not None:
+                profile.merge(stats)
+
         return None
     
-    def _check_strategy(self, code, conditions, start_date, end_date, time_range=30):
+    def _check_strategy(self, code, conditions, start_date, end_date, time_range=30, cross_section=None, stats=None,
+                        universe=None, cache_version=None, t_range=None):
         """检查股票是否符合策略条件
         
         优化：先检查是否有涨停日，无则直接跳过；只遍历最近 time_range 个交易日作为 T
         """
         try:
             # 获取股票数据
+            load_start = time.perf_counter()
             df = self.data_fetcher.get_stock_data(
                 code, 
                 start_date.strftime('%Y%m%d'), 
-                end_date.strftime('%Y%m%d')
+                end_date.strftime('%Y%m%d'),
+                version=cache_version
             )
-            
+            if stats is not None:
+                stats.timers['data_seconds'] += time.perf_counter() - load_start
+
+            return self._check_strategy_df(df, conditions, time_range, code, cross_section, stats, universe, t_range,
+                                           cache_version)
+        except Exception as e:
+            # 静默处理错误
+            if stats is not None:
+                stats.error(-1, e)
+            return False
+    
+    def _check_strategy_df(self, df, conditions, time_range=30, code=None, cross_section=None, stats=None,
+                           universe=None, t_range=None, cache_version=None):
+        """对给定的 DataFrame 检查策略条件，返回 {'df', 'base_date'} 或 False
+
+        cross_section: 全市场截面排名（CrossSection），策略含 cs_* 条件时必须传入
+        stats: explain 模式下本只股票的剖析计数（StrategyProfile.local()）
+        universe: 历史时点股票池（StockUniverse），不在池内（未上市、已退市、ST）的交易日不作为 T
+        t_range: 分块判断时本块的 (first_t, last_t)，只把其中的交易日作为 T（df 含前后重叠部分）；
+                 不传时为最近 time_range 个交易日
+        cache_version: df 所读的日线缓存版本，周线/月线读同一版本
+        """
+        try:
             if df is None or df.empty:
                 return False
+            if stats is not None:
+                stats.counters['stocks_with_data'] += 1
             
             # 确保有足够的列
             required_columns = ['日期', '涨跌幅', '成交量']
@@ -158,106 +545,237 @@ class StrategyEngine:
             # 按日期排序（从早到晚）
             df = df.sort_values('日期').reset_index(drop=True)
             
-            # 优化：若无任何涨停日，直接跳过（T-5 需涨停，无涨停则不可能符合）
-            if (df['涨跌幅'] >= 9.8).sum() == 0:
+            # 优化：策略含日线涨停条件时，若无任何涨停日，直接跳过（T-5 需涨停，无涨停则不可能符合）
+            has_limit_up = any(c.get('type') == 'limit_up' and c.get('timeframe', 'D') == 'D' for c in conditions)
+            if has_limit_up and (df['涨跌幅'] >= 9.8).sum() == 0:
+                if stats is not None:
+                    stats.counters['pruned_no_limit_up'] += 1
                 return False
             
-            # 计算需要的最少交易日数（T-5 需预留 5 个交易日）
+            # 计算需要的最少交易日数（T-5 需预留 5 个交易日；周线/月线条件的偏移按周期计，不占日线）
             max_backward_offset = 0
             for c in conditions:
+                if c.get('timeframe', 'D') != 'D':
+                    continue
                 date1 = c.get('date1', 0)
                 date2 = c.get('date2', 0)
                 if date1 < 0:
                     max_backward_offset = max(max_backward_offset, abs(date1))
                 if date2 < 0:
                     max_backward_offset = max(max_backward_offset, abs(date2))
+                if c.get('type') == 'similar':
+                    window = int(c.get('window', SIMILAR_WINDOW))
+                    max_backward_offset = max(max_backward_offset, window + max(0, -int(date1)))
             min_required_days = max_backward_offset + 1
             
+            # 周线/月线条件：已完成周期用持久化的聚合K线，当期用截至 T 的当期K线
+            frames = self._prepare_timeframes(code, conditions, df, cache_version)
+            
             # 只检查最近 time_range 个交易日作为 T（不含周末，df 每行即一交易日）
-            min_i = max(min_required_days, len(df) - time_range)
-            for i in range(len(df) - 1, min_i - 1, -1):
+            min_i, max_i = max(min_required_days, len(df) - time_range), len(df) - 1
+            if t_range is not None:
+                dates = pd.to_datetime(df['日期'])
+                min_i = max(min_required_days, int(dates.searchsorted(t_range[0], side='left')))
+                max_i = int(dates.searchsorted(t_range[1], side='right')) - 1
+            if stats is not None and min_i > max_i:
+                stats.counters['pruned_short_history'] += 1
+            allowed = universe.mask(code, pd.to_datetime(df['日期']).to_numpy()) if universe is not None else None
+            date_map = None
+            for i in range(max_i, min_i - 1, -1):
+                if allowed is not None and not allowed[i]:
+                    if stats is not None:
+                        stats.counters['outside_universe'] += 1
+                    continue
                 base_date = df.iloc[i]['日期']  # 回测日期（比如1月12日）
+                if date_map is None:
+                    # 日期索引每只股票只建一次，所有 T 共用
+                    map_start = time.perf_counter()
+                    date_map = self._build_date_map(df)
+                    if stats is not None:
+                        stats.timers['date_map_seconds'] += time.perf_counter() - map_start
                 
                 # 检查从base_date开始是否符合所有条件
-                if self._check_conditions_from_date(code, conditions, base_date, df):
+                if self._check_conditions_from_date(code, conditions, base_date, df, frames, cross_section, stats,
+                                                    date_map):
                     # 返回df和base_date，避免重复获取数据
                     return {'df': df, 'base_date': base_date}
             
             return False
         except Exception as e:
             # 静默处理错误
+            if stats is not None:
+                stats.error(-1, e)
             return False
     
-    def _check_conditions_from_date(self, code, conditions, base_date, df):
-        """从指定日期开始检查条件"""
+    @staticmethod
+    def _build_date_map(df):
+        """日期字符串 -> 该行 {列: 值}（用日期字符串作为键，条件按 row['涨跌幅'] 取值）"""
+        dates = pd.to_datetime(df['日期']).dt.strftime('%Y-%m-%d')
+        return dict(zip(dates, df.to_dict('records')))
+
+    def _check_conditions_from_date(self, code, conditions, base_date, df, frames=None, cross_section=None,
+                                    stats=None, date_map=None):
+        """从指定日期开始检查条件（按顺序短路）；stats 不为 None 时记录每个条件的作用/通过次数与耗时
+
+        date_map 为 _build_date_map(df)，同一只股票的多个 T 共用；不传时现建
+        """
         try:
-            # 创建日期映射（使用日期字符串作为键）
-            date_map = {}
-            for _, row in df.iterrows():
-                date_str = pd.to_datetime(row['日期']).strftime('%Y-%m-%d')
-                date_map[date_str] = row
-            
+            if date_map is None:
+                map_start = time.perf_counter() if stats is not None else 0
+                date_map = self._build_date_map(df)
+                if stats is not None:
+                    stats.timers['date_map_seconds'] += time.perf_counter() - map_start
+
+            if stats is not None:
+                stats.counters['candidates'] += 1
+                for index, condition in enumerate(conditions):
+                    errors = []
+                    cond_start = time.perf_counter()
+                    passed = self._evaluate_condition(condition, base_date, date_map, df, frames,
+                                                      cross_section=cross_section, code=code, errors=errors)
+                    elapsed = time.perf_counter() - cond_start
+                    entry = stats.condition_stats[index]
+                    entry[0] += 1
+                    entry[2] += elapsed
+                    stats.timers['condition_seconds'] += elapsed
+                    for e in errors:
+                        stats.error(index, e)
+                    if not passed:
+                        return False
+                    entry[1] += 1
+                return True
+
             # 解析每个条件
             for condition in conditions:
-                if not self._evaluate_condition(condition, base_date, date_map, df):
+                if not self._evaluate_condition(condition, base_date, date_map, df, frames,
+                                                cross_section=cross_section, code=code):
                     return False
             
             return True
         except Exception as e:
+            if stats is not None:
+                stats.error(-1, e)
             return False
     
-    def _evaluate_condition(self, condition, base_date, date_map, df):
-        """评估单个条件（确保只使用交易日）"""
+    def _prepare_timeframes(self, code, conditions, df, cache_version=None):
+        """为周线/月线条件准备数据（cache_version 为日线所读的缓存版本，已完成周期的聚合K线与之一致）
+
+        Returns:
+            {timeframe: {'bars': 已完成周期的聚合K线, 'partial': 截至每个交易日的当期K线（按日期索引）}}
+        """
+        frames = {}
+        for timeframe in {c.get('timeframe', 'D') for c in conditions} - {'D'}:
+            bars = self.data_fetcher.get_resampled_data(code, timeframe, version=cache_version) if code else None
+            partial = period_to_date(df, timeframe).set_index('日期')
+            frames[timeframe] = {'bars': bars, 'partial': partial}
+        return frames
+    
+    def _get_row(self, condition, date_key, base_date, date_map, df, frames=None):
+        """取条件中 date_key（date1/date2）所指的那根K线，找不到返回 None"""
+        timeframe = condition.get('timeframe', 'D')
+        if timeframe == 'D':
+            target = self._get_date_offset(base_date, condition.get(date_key, 0), df)
+            if target is None:
+                return None  # 无法找到对应的交易日
+            return date_map.get(target.strftime('%Y-%m-%d'))
+        
+        frame = (frames or {}).get(timeframe)
+        if frame is None:
+            return None
+        offset = int(condition.get(date_key, 0))
+        base_ts = pd.Timestamp(base_date)
+        if offset == 0:
+            # 当期K线只用截至 T 的日线，避免未来数据
+            partial = frame['partial']
+            return partial.loc[base_ts] if base_ts in partial.index else None
+        bars = frame['bars']
+        if bars is None or bars.empty:
+            return None
+        base_period = int(period_ordinal([base_ts], timeframe)[0])
+        if offset < 0:
+            done = bars[bars['周期'] < base_period]
+            return done.iloc[offset] if len(done) >= -offset else None
+        later = bars[bars['周期'] > base_period]
+        return later.iloc[offset - 1] if len(later) >= offset else None
+    
+    def _evaluate_condition(self, condition, base_date, date_map, df, frames=None, cross_section=None, code=None,
+                            errors=None):
+        """评估单个条件（确保只使用交易日）
+
+        condition['timeframe'] 为 'D'（默认，日线）/'W'（周线）/'M'（月线），
+        date1/date2 为相对 T 所在K线的偏移（按该周期的K线数计）；
+        errors 不为 None 时把被吞掉的异常追加进去（explain 模式）
+        """
         try:
             cond_type = condition.get('type')
             
-            if cond_type == 'limit_up':
-                # 涨停条件：date1涨停
+            if is_cross_sectional(condition):
+                # 截面条件：查全市场当日排名/分位数；T-k 按市场交易日历取，停牌的股票当天无排名
+                if cross_section is None:
+                    return False
+                date1 = cross_section.offset_date(base_date, condition.get('date1', 0))
+                if date1 is None:
+                    return False
+                return cross_section.evaluate(condition, date1, code)
+            
+            if cond_type in ('breadth_gt', 'breadth_lt'):
+                # 市场宽度条件：date1 全市场指标（如涨停家数）大于/小于 value
                 date1 = self._get_date_offset(base_date, condition.get('date1', 0), df)
                 if date1 is None:
-                    return False  # 无法找到对应的交易日
-                date1_str = date1.strftime('%Y-%m-%d')
-                if date1_str not in date_map:
                     return False
-                row = date_map[date1_str]
+                value = self.data_fetcher.market_breadth.value(date1, condition.get('metric', 'limit_up_count'))
+                if value is None:
+                    return False
+                if cond_type == 'breadth_gt':
+                    return value > condition.get('value', 0)
+                return value < condition.get('value', 0)
+            
+            if cond_type == 'limit_up':
+                # 涨停条件：date1涨停
+                row = self._get_row(condition, 'date1', base_date, date_map, df, frames)
+                if row is None:
+                    return False
                 return row['涨跌幅'] >= 9.8
             
             elif cond_type == 'pct_change_gt':
                 # 涨幅大于零：date1涨幅>0
-                date1 = self._get_date_offset(base_date, condition.get('date1', 0), df)
-                if date1 is None:
-                    return False  # 无法找到对应的交易日
-                date1_str = date1.strftime('%Y-%m-%d')
-                if date1_str not in date_map:
+                row = self._get_row(condition, 'date1', base_date, date_map, df, frames)
+                if row is None:
                     return False
-                row = date_map[date1_str]
                 return row['涨跌幅'] > condition.get('value', 0)
             
             elif cond_type == 'pct_change_lt':
                 # 涨幅小于零：date1涨幅<0
-                date1 = self._get_date_offset(base_date, condition.get('date1', 0), df)
-                if date1 is None:
-                    return False  # 无法找到对应的交易日
-                date1_str = date1.strftime('%Y-%m-%d')
-                if date1_str not in date_map:
+                row = self._get_row(condition, 'date1', base_date, date_map, df, frames)
+                if row is None:
                     return False
-                row = date_map[date1_str]
                 return row['涨跌幅'] < condition.get('value', 0)
             
+            elif cond_type == 'similar':
+                # 形态相似：T+date1 为终点的窗口与参照形态的相似度 >= value
+                target = self._get_date_offset(base_date, condition.get('date1', 0), df)
+                if target is None:
+                    return False
+                reference = self._similar_reference(condition)
+                if reference is None:
+                    return False
+                end = int(df['日期'].searchsorted(pd.Timestamp(target)))
+                if end >= len(df) or pd.Timestamp(df['日期'].iloc[end]) != pd.Timestamp(target):
+                    return False
+                features = frame_features(df, end, int(condition.get('window', SIMILAR_WINDOW)))
+                if features is None:
+                    return False
+                return float(features @ reference) >= condition.get('value', 0.8)
+            
             elif cond_type == 'volume_ratio':
                 # 成交量比例：date1成交量 / date2成交量 > ratio
-                date1 = self._get_date_offset(base_date, condition.get('date1', 0), df)
-                date2 = self._get_date_offset(base_date, condition.get('date2', 0), df)
-                if date1 is None or date2 is None:
-                    return False  # 无法找到对应的交易日
-                date1_str = date1.strftime('%Y-%m-%d')
-                date2_str = date2.strftime('%Y-%m-%d')
-                
-                if date1_str not in date_map or date2_str not in date_map:
+                row1 = self._get_row(condition, 'date1', base_date, date_map, df, frames)
+                row2 = self._get_row(condition, 'date2', base_date, date_map, df, frames)
+                if row1 is None or row2 is None:
                     return False
                 
-                vol1 = date_map[date1_str]['成交量']
-                vol2 = date_map[date2_str]['成交量']
+                vol1 = row1['成交量']
+                vol2 = row2['成交量']
                 
                 if vol2 == 0:
                     return False
@@ -268,8 +786,84 @@ class StrategyEngine:
             return False
         except Exception as e:
             # 静默处理错误
+            if errors is not None:
+                errors.append(e)
             return False
     
+    def _condition_values(self, condition, base_date, date_map, df, frames=None):
+        """条件在 T 时引用的日期和数值 (dates, values)，与 _evaluate_condition 的判断口径一致"""
+        dates, values = {}, {}
+        try:
+            cond_type = condition.get('type')
+            keys = ['date1', 'date2'] if cond_type == 'volume_ratio' else ['date1']
+            if is_cross_sectional(condition):
+                target = self._market_date_offset(base_date, condition.get('date1', 0))
+                dates['date1'] = target.strftime('%Y-%m-%d') if target is not None else None
+            elif condition.get('timeframe', 'D') == 'D':
+                for key in keys:
+                    target = self._get_date_offset(base_date, condition.get(key, 0), df)
+                    dates[key] = target.strftime('%Y-%m-%d') if target is not None else None
+
+            if cond_type in ('breadth_gt', 'breadth_lt'):
+                metric = condition.get('metric', 'limit_up_count')
+                if dates.get('date1'):
+                    values[metric] = self.data_fetcher.market_breadth.value(dates['date1'], metric)
+            elif cond_type in ('limit_up', 'pct_change_gt', 'pct_change_lt'):
+                row = self._get_row(condition, 'date1', base_date, date_map, df, frames)
+                if row is not None:
+                    values['pct_change'] = round(float(row['涨跌幅']), 6)
+            elif cond_type == 'volume_ratio':
+                row1 = self._get_row(condition, 'date1', base_date, date_map, df, frames)
+                row2 = self._get_row(condition, 'date2', base_date, date_map, df, frames)
+                if row1 is not None:
+                    values['volume1'] = float(row1['成交量'])
+                if row2 is not None:
+                    values['volume2'] = float(row2['成交量'])
+                if row1 is not None and row2 is not None and row2['成交量'] != 0:
+                    values['ratio'] = float(row1['成交量'] / row2['成交量'])
+            elif cond_type == 'similar' and dates.get('date1'):
+                reference = self._similar_reference(condition)
+                end = int(df['日期'].searchsorted(pd.Timestamp(dates['date1'])))
+                features = frame_features(df, end, int(condition.get('window', SIMILAR_WINDOW))) if end < len(df) else None
+                if reference is not None and features is not None:
+                    values['similarity'] = float(features @ reference)
+        except Exception:
+            pass
+        return dates, values
+
+    def _similar_reference(self, condition):
+        """similar 条件的参照形态：condition['code'] 以 condition['date'] 为终点的窗口特征
+
+        按条件缓存，每次回测开始时清空（参照股票的数据可能在两次回测之间补齐）
+        """
+        window = int(condition.get('window', SIMILAR_WINDOW))
+        key = (condition.get('code'), str(condition.get('date')), window)
+        if key in self._similar_refs:
+            return self._similar_refs[key]
+        with self._similar_lock:
+            if key not in self._similar_refs:
+                end = pd.Timestamp(condition['date'])
+                start = end - timedelta(days=int(window * 1.6) + 20)
+                df = self.data_fetcher.get_stock_data(condition['code'], start.strftime('%Y%m%d'),
+                                                      end.strftime('%Y%m%d'))
+                reference = None
+                if df is not None and not df.empty:
+                    df = df.sort_values('日期').reset_index(drop=True)
+                    reference = frame_features(df, len(df) - 1, window)
+                self._similar_refs[key] = reference
+            return self._similar_refs[key]
+    
+    def _trading_days(self, start_date, end_date):
+        """[start, end] 内的市场交易日（YYYY-MM-DD），截面条件按它偏移"""
+        return self.data_fetcher.get_trading_days(start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d'))
+
+    def _market_date_offset(self, base_date, offset_days):
+        """按市场交易日历偏移（与截面条件的判断口径一致），找不到返回 None"""
+        base = pd.Timestamp(base_date)
+        span = timedelta(days=abs(int(offset_days)) * 2 + 15 if not isinstance(offset_days, str) else 0)
+        calendar = pd.to_datetime(self._trading_days(base - span, base + span))
+        return offset_trading_day(calendar, base, offset_days)
+
     def _get_date_offset(self, base_date, offset_days, df=None):
         """获取相对于基准日期的日期（交易日，跳过非交易日）
         
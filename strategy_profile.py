@@ -0,0 +1,117 @@
+"""
+策略执行剖析（explain / profile）
+
+backtest(..., explain=True) 时记录：
+    各阶段：股票数、有数据的股票数、被涨停预筛/历史不足剔除的股票数、不在当天股票池内跳过的 T 数、
+            (股票, T) 候选数、匹配数，
+            以及读数据、建日期索引、判断条件的耗时
+    各条件：按评估顺序，作用到多少个 (股票, T) 候选、通过多少个、耗时、异常次数（平时被静默吞掉的异常）
+
+条件按策略中的顺序逐个判断，遇到不满足即停止（短路），所以越靠前的条件作用的候选越多。
+suggested_order 按 "每秒淘汰的候选数" 从高到低给出建议顺序（选择性强、代价低的条件放前面）。
+"""
+from threading import Lock
+import time
+
+STAGE_COUNTERS = ['stocks', 'stocks_with_data', 'pruned_no_limit_up', 'pruned_short_history',
+                  'outside_universe', 'candidates', 'matched_stocks', 'errors']
+STAGE_TIMERS = ['data_seconds', 'date_map_seconds', 'condition_seconds', 'cross_section_seconds']
+
+
+class StrategyProfile:
+    """一次回测的剖析数据；并发时每只股票用 local() 单独累计，完成后 merge 一次"""
+
+    def __init__(self, conditions):
+        self.conditions = list(conditions)
+        self.counters = {k: 0 for k in STAGE_COUNTERS}
+        self.timers = {k: 0.0 for k in STAGE_TIMERS}
+        # 每个条件: [作用候选数, 通过数, 耗时, 异常次数]
+        self.condition_stats = [[0, 0, 0.0, 0] for _ in self.conditions]
+        self.first_errors = {}  # 条件序号（-1 为条件之外）-> 第一条异常信息
+        self.started_at = time.time()
+        self.total_seconds = None
+        self._lock = Lock()
+
+    def local(self):
+        return StrategyProfile(self.conditions)
+
+    def error(self, index, exc):
+        if index < 0:
+            self.counters['errors'] += 1
+        else:
+            self.condition_stats[index][3] += 1
+        self.first_errors.setdefault(index, f'{type(exc).__name__}: {exc}')
+
+    def merge(self, other):
+        with self._lock:
+            for k, v in other.counters.items():
+                self.counters[k] += v
+            for k, v in other.timers.items():
+                self.timers[k] += v
+            for mine, theirs in zip(self.condition_stats, other.condition_stats):
+                for i in range(4):
+                    mine[i] += theirs[i]
+            for k, v in other.first_errors.items():
+                self.first_errors.setdefault(k, v)
+
+    def finish(self):
+        self.total_seconds = time.time() - self.started_at
+
+    def to_dict(self):
+        conditions = []
+        for i, (cond, (applied, passed, seconds, errors)) in enumerate(zip(self.conditions, self.condition_stats)):
+            conditions.append({
+                'index': i,
+                'condition': cond,
+                'applied': applied,
+                'passed': passed,
+                'selectivity': round(passed / applied, 4) if applied else None,
+                'seconds': round(seconds, 4),
+                'us_per_candidate': round(seconds / applied * 1e6, 2) if applied else None,
+                'errors': errors,
+                'first_error': self.first_errors.get(i),
+            })
+        return {
+            **self.counters,
+            **{k: round(v, 4) for k, v in self.timers.items()},
+            'total_seconds': round(self.total_seconds, 4) if self.total_seconds is not None else None,
+            'first_error': self.first_errors.get(-1),
+            'order': list(range(len(self.conditions))),
+            'suggested_order': self.suggested_order(),
+            'conditions': conditions,
+        }
+
+    def suggested_order(self):
+        """按每秒淘汰的候选数排序；未被评估到的条件保持原相对顺序放在最后"""
+        def rank(i):
+            applied, passed, seconds, _ = self.condition_stats[i]
+            if not applied:
+                return (1, 0.0, i)
+            return (0, -(applied - passed) / max(seconds, 1e-9), i)
+        return sorted(range(len(self.conditions)), key=rank)
+
+    def format(self):
+        """文本表格（打印到控制台）"""
+        d = self.to_dict()
+        lines = [
+            f"股票 {d['stocks']} 只（有数据 {d['stocks_with_data']}，涨停预筛剔除 {d['pruned_no_limit_up']}，"
+            f"历史不足 {d['pruned_short_history']}），(股票, T) 候选 {d['candidates']} 个"
+            f"（不在股票池跳过 {d['outside_universe']}），匹配 {d['matched_stocks']} 只",
+            f"耗时: 读数据 {d['data_seconds']:.3f}s | 建日期索引 {d['date_map_seconds']:.3f}s | "
+            f"判断条件 {d['condition_seconds']:.3f}s | 截面排名 {d['cross_section_seconds']:.3f}s（各线程累计）",
+            f"{'序号':<4}{'条件':<28}{'作用':>10}{'通过':>10}{'通过率':>8}{'耗时(s)':>10}{'μs/个':>9}{'异常':>6}",
+        ]
+        for c in d['conditions']:
+            cond = c['condition']
+            desc = cond.get('type', '')
+            if cond.get('timeframe', 'D') != 'D':
+                desc += f"[{cond['timeframe']}]"
+            desc += f" T{int(cond.get('date1', 0)):+d}" if isinstance(cond.get('date1', 0), (int, float)) else ''
+            sel = f"{c['selectivity'] * 100:.1f}%" if c['selectivity'] is not None else '-'
+            per = f"{c['us_per_candidate']:.1f}" if c['us_per_candidate'] is not None else '-'
+            lines.append(f"{c['index']:<6}{desc:<30}{c['applied']:>10}{c['passed']:>10}{sel:>9}"
+                         f"{c['seconds']:>10.3f}{per:>9}{c['errors']:>6}")
+        lines.append(f"建议顺序: {d['suggested_order']}")
+        for i, msg in sorted(self.first_errors.items()):
+            lines.append(f"[WARNING] {'条件 ' + str(i) if i >= 0 else '条件之外'} 异常: {msg}")
+        return '\n'.join(lines)
@@ -0,0 +1,102 @@
+"""
+交易日历与缺口计算
+
+交易日历（含节假日）从 Baostock 拉取后持久化到 cache/trade_calendar.json，只在请求范围超出
+已存范围时补拉超出的部分。拉取数据前用日历算出每只股票缺失的交易日，把连续缺失的交易日合并为
+区间，只请求这些区间。
+"""
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from threading import Lock
+import json
+import os
+
+
+def _fmt(date_str):
+    """yyyymmdd / YYYY-MM-DD -> YYYY-MM-DD"""
+    s = str(date_str).replace('-', '')[:8]
+    return f"{s[:4]}-{s[4:6]}-{s[6:]}"
+
+
+def missing_spans(days, known):
+    """days 中不在 known 里的交易日，按日历连续性分组
+
+    Args:
+        days: 升序的交易日列表（YYYY-MM-DD）
+        known: 已有数据或已确认无数据的日期集合
+    Returns:
+        [[day, day, ...], ...]，每组为日历上连续的缺失交易日
+    """
+    spans, current = [], []
+    for day in days:
+        if day in known:
+            if current:
+                spans.append(current)
+                current = []
+        else:
+            current.append(day)
+    if current:
+        spans.append(current)
+    return spans
+
+
+class TradeCalendar:
+    """持久化的交易日历：记录已拉取的日期范围 [start, end] 及其中的交易日"""
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'trade_calendar.json')
+        self._lock = Lock()
+        self._data = None  # {'start': 'YYYY-MM-DD', 'end': 'YYYY-MM-DD', 'days': [...]}
+
+    def _load(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    data = {'start': None, 'end': None, 'days': []}
+                    try:
+                        if os.path.exists(self.path):
+                            with open(self.path, 'r', encoding='utf-8') as f:
+                                stored = json.load(f)
+                            if stored.get('start') and stored.get('end'):
+                                data = {'start': stored['start'], 'end': stored['end'],
+                                        'days': sorted(stored.get('days') or [])}
+                    except Exception as e:
+                        print(f"[WARNING] 读取交易日历失败: {e}")
+                    self._data = data
+        return self._data
+
+    def uncovered(self, start_date, end_date):
+        """[start, end] 中尚未拉取过日历的部分，返回 [(start, end), ...]（YYYY-MM-DD）"""
+        start, end = _fmt(start_date), _fmt(end_date)
+        data = self._load()
+        if data['start'] is None:
+            return [(start, end)]
+        ranges = []
+        if start < data['start']:
+            ranges.append((start, min(end, data['start'])))
+        if end > data['end']:
+            ranges.append((max(start, data['end']), end))
+        return ranges
+
+    def extend(self, start_date, end_date, trading_days):
+        """合并新拉取的一段日历（trading_days 为该范围内的交易日）"""
+        start, end = _fmt(start_date), _fmt(end_date)
+        data = self._load()
+        days = set(data['days'])
+        days.update(trading_days)
+        merged = {
+            'start': min(start, data['start']) if data['start'] else start,
+            'end': max(end, data['end']) if data['end'] else end,
+            'days': sorted(days),
+        }
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'  # 多个进程可能同时补拉
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'cache_time': datetime.now().isoformat(), **merged}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        with self._lock:
+            self._data = merged
+
+    def days(self, start_date, end_date):
+        """[start, end] 内的交易日（含两端，YYYY-MM-DD 升序）"""
+        days = self._load()['days']
+        return days[bisect_left(days, _fmt(start_date)):bisect_right(days, _fmt(end_date))]
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+历史时点股票池（point-in-time universe）
+
+get_stock_list() 只有今天的主板股票，回测历史日期时会漏掉已退市的股票、混入当时尚未上市或处于 ST 的股票。
+这里按股票保存两类区间集合（日期含两端，end 为 null 表示至今仍在区间内）：
+    listed   上市区间（上市日 ~ 退市日）
+    st       ST / *ST / 退市整理期区间（这段时间不在股票池内）
+某个交易日 T 的股票池 = 在 T 处于上市区间、且不处于 st 区间的主板股票。
+
+存储为 cache/universe.json（version 每次写入加 1，as_of 为最近记录的交易日），几千只股票只有几千个区间，
+加载后编译成按股票连续排列的区间数组（与快照的 offsets 布局相同），判断一只股票在一组日期上是否在池内
+是一次 searchsorted，求某一天的全市场股票池是一次向量比较。
+
+数据来源：
+    build()       一次性回填：数据源的上市/退市日期（Baostock query_stock_basic）+ 每只股票每日的 isST 标记
+    record_day()  每日任务记录当天的全市场列表（含名称），延长或新开区间
+
+用法:
+    python universe.py build --start 2015-01-01      # 回填（每只股票一次请求）
+    python universe.py show 2020-06-01               # 某日股票池
+"""
+import os
+os.environ['NO_PROXY'] = '*'
+os.environ['no_proxy'] = '*'
+
+from datetime import datetime
+from threading import Lock
+import argparse
+import json
+
+import numpy as np
+
+OPEN_END = np.iinfo(np.int32).max  # 区间至今未结束
+
+
+def is_main_board(code):
+    """主板：00开头（深市主板）、60开头（沪市主板）"""
+    return len(code) == 6 and (code.startswith('00') or code.startswith('60'))
+
+
+def is_st_name(name):
+    """名称带 ST / *ST / 退 的股票不进入股票池（与 DataFetcher._should_exclude 一致）"""
+    return 'ST' in name or 'st' in name or '退' in name
+
+
+def _day(date):
+    """YYYY-MM-DD / yyyymmdd / datetime -> 自 1970-01-01 起的天数"""
+    if isinstance(date, str):
+        s = date.replace('-', '')[:8]
+        date = f'{s[:4]}-{s[4:6]}-{s[6:]}'
+    return int(np.datetime64(date, 'D').astype('int64'))
+
+
+def _days(dates):
+    """日期数组 -> 天数数组（int64）"""
+    return np.asarray(dates).astype('datetime64[D]').astype('int64')
+
+
+def runs_to_intervals(dates, flags):
+    """按日期排列的 (日期, 标记) 中连续为真的段 -> [[start, end], ...]
+
+    停牌日没有数据行，前后都为真时视为同一段（停牌期间状态不变）
+    """
+    intervals, start, prev = [], None, None
+    for date, flag in zip(dates, flags):
+        if flag and start is None:
+            start = date
+        elif not flag and start is not None:
+            intervals.append([start, prev])
+            start = None
+        prev = date
+    if start is not None:
+        intervals.append([start, prev])
+    return intervals
+
+
+class _IntervalSet:
+    """按股票连续排列的区间：第 i 只股票的区间为 starts/ends[offsets[i]:offsets[i+1]]（按起点升序）"""
+
+    def __init__(self, codes, stocks, kind):
+        starts, ends, offsets = [], [], [0]
+        for code in codes:
+            for start, end in sorted(stocks[code].get(kind) or []):
+                starts.append(_day(start))
+                ends.append(_day(end) if end else OPEN_END)
+            offsets.append(len(starts))
+        self.starts = np.asarray(starts, dtype=np.int32)
+        self.ends = np.asarray(ends, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.owner = np.repeat(np.arange(len(codes), dtype=np.int32), np.diff(self.offsets))
+
+    def contains(self, i, days):
+        """第 i 只股票在 days（天数数组）上是否处于区间内"""
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        if lo == hi:
+            return np.zeros(len(days), dtype=bool)
+        starts, ends = self.starts[lo:hi], self.ends[lo:hi]
+        k = np.searchsorted(starts, days, side='right') - 1
+        return (k >= 0) & (days <= ends[np.maximum(k, 0)])
+
+    def owners_at(self, day):
+        """day 处于区间内的股票序号"""
+        return self.owner[(self.starts <= day) & (self.ends >= day)]
+
+    def owners_overlapping(self, start, end):
+        """区间与 [start, end] 有交集的股票序号"""
+        return self.owner[(self.starts <= end) & (self.ends >= start)]
+
+
+class StockUniverse:
+    """持久化的历史时点股票池（区间集合），线程安全；未建立时 available() 为 False"""
+
+    MAX_MEMBER_CACHE = 512
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'universe.json')
+        self._lock = Lock()
+        self._data = None      # 文件内容
+        self._compiled = None  # (codes, index, listed, st)
+        self._mtime = None
+        self._members = {}     # day -> 股票序号数组
+
+    def _load(self):
+        """读取（文件被其他进程更新后重新读取），返回文件内容；文件不存在返回 None"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        if self._data is not None and mtime == self._mtime:
+            return self._data
+        with self._lock:
+            if self._data is None or mtime != self._mtime:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self._set(json.load(f))
+                    self._mtime = mtime
+                except Exception as e:
+                    print(f'[WARNING] 读取股票池失败: {e}')
+                    return self._data
+        return self._data
+
+    def _set(self, data):
+        codes = sorted(data.get('stocks') or {})
+        stocks = data['stocks']
+        self._compiled = (codes, {c: i for i, c in enumerate(codes)},
+                          _IntervalSet(codes, stocks, 'listed'), _IntervalSet(codes, stocks, 'st'))
+        self._members = {}
+        self._data = data
+
+    def _save(self, data):
+        data['version'] = int(data.get('version') or 0) + 1
+        data['updated_at'] = datetime.now().isoformat()
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data, ensure_ascii=False))
+        os.replace(tmp_path, self.path)
+        with self._lock:
+            self._set(data)
+            self._mtime = os.path.getmtime(self.path)
+
+    def available(self):
+        return self._load() is not None
+
+    def info(self):
+        """{'version', 'start', 'as_of', 'stocks'}，未建立返回 None"""
+        data = self._load()
+        if data is None:
+            return None
+        return {'version': data.get('version'), 'start': data.get('start'), 'as_of': data.get('as_of'),
+                'stocks': len(data.get('stocks') or {})}
+
+    # ---------- 查询 ----------
+
+    def mask(self, code, dates):
+        """code 在 dates 各日是否在股票池内（bool 数组）；股票池未建立时返回 None（不过滤）"""
+        if self._load() is None:
+            return None
+        codes, index, listed, st = self._compiled
+        days = _days(dates)
+        i = index.get(code)
+        if i is None:
+            return np.zeros(len(days), dtype=bool)
+        return listed.contains(i, days) & ~st.contains(i, days)
+
+    def members(self, date):
+        """date 当天股票池内的股票代码（升序）"""
+        if self._load() is None:
+            return []
+        codes, _, listed, st = self._compiled
+        day = _day(date)
+        ids = self._members.get(day)
+        if ids is None:
+            ids = np.setdiff1d(listed.owners_at(day), st.owners_at(day))
+            if len(self._members) >= self.MAX_MEMBER_CACHE:
+                self._members.clear()
+            self._members[day] = ids
+        return [codes[i] for i in ids]
+
+    def stocks_between(self, start_date, end_date):
+        """[start, end] 内任一交易日在池内的股票 [{'code', 'name'}]（含期间退市的股票）
+
+        只按上市区间取并集，个别交易日是否在池内由 mask() 逐日判断
+        """
+        data = self._load()
+        if data is None:
+            return []
+        codes, _, listed, _ = self._compiled
+        ids = np.unique(listed.owners_overlapping(_day(start_date), _day(end_date)))
+        return [{'code': codes[i], 'name': data['stocks'][codes[i]].get('name', codes[i])} for i in ids]
+
+    def delisted_on(self, code):
+        """已退市股票的最后上市日（yyyymmdd）；仍在上市、不在股票池中或股票池未建立时返回 None"""
+        data = self._load()
+        if data is None:
+            return None
+        intervals = (data['stocks'].get(code) or {}).get('listed') or []
+        if not intervals or any(not end for _, end in intervals):
+            return None
+        return max(end for _, end in intervals).replace('-', '')
+
+    # ---------- 写入 ----------
+
+    def build(self, source, start_date, end_date=None, st_history=True):
+        """从数据源回填：上市/退市日期 + 每只主板股票在 [start, end] 内每日的 ST 标记
+
+        Args:
+            source: data_sources.DataSource（需实现 stock_basics，st_history 时还需 st_flags）
+            st_history: 为 False 时只按当前名称判断 ST（不逐只请求，历史 ST 区间不准确）
+        Returns:
+            写入的股票数
+        """
+        start = datetime.strptime(str(start_date).replace('-', '')[:8], '%Y%m%d').strftime('%Y-%m-%d')
+        end = (datetime.strptime(str(end_date).replace('-', '')[:8], '%Y%m%d') if end_date
+               else datetime.now()).strftime('%Y-%m-%d')
+        stocks, by_name = {}, 0
+        basics = [b for b in source.stock_basics() if is_main_board(b[0])]
+        for n, (code, name, ipo, out) in enumerate(basics, 1):
+            if not ipo or (out and out < start) or ipo > end:
+                continue
+            entry = {'name': name, 'listed': [[ipo, out or None]], 'st': []}
+            if st_history:
+                flags = source.st_flags(code, max(ipo, start), min(out or end, end))
+                if flags is None:
+                    by_name += 1
+                    entry['st'] = [[max(ipo, start), None]] if is_st_name(name) else []
+                else:
+                    entry['st'] = runs_to_intervals([d for d, _ in flags], [f for _, f in flags])
+                    if entry['st'] and not out and entry['st'][-1][1] == flags[-1][0]:
+                        entry['st'][-1][1] = None  # 最近仍为 ST
+            elif is_st_name(name):
+                entry['st'] = [[max(ipo, start), None]]
+            stocks[code] = entry
+            if n % 200 == 0:
+                print(f'[INFO] 股票池回填进度: {n}/{len(basics)}', flush=True)
+        if by_name:
+            print(f'[WARNING] {by_name} 只股票的历史 ST 标记获取失败，按当前名称判断')
+        old = self._load() or {}
+        self._save({'version': old.get('version', 0), 'start': start, 'as_of': end, 'stocks': stocks})
+        print(f'[INFO] 股票池已建立: {len(stocks)} 只股票，{start} ~ {end}')
+        return len(stocks)
+
+    def record_day(self, date, stocks):
+        """记录 date 当天数据源的全市场列表 [(code, name)]（未过滤 ST 的原始列表）
+
+        当天在列表中的股票延长（或新开）上市区间，名称带 ST 的延长（或新开）st 区间；
+        不在列表中的股票、名称已去掉 ST 的股票，其未结束的区间在上一记录日结束。
+        股票池未建立或 date 不晚于已记录的日期时不做任何事。
+
+        Returns:
+            是否写入
+        """
+        data = self._load()
+        day = datetime.strptime(str(date).replace('-', '')[:8], '%Y%m%d').strftime('%Y-%m-%d')
+        if data is None or not stocks or day <= (data.get('as_of') or ''):
+            return False
+        prev = data.get('as_of')
+        entries = {code: dict(entry, listed=[list(x) for x in entry.get('listed') or []],
+                              st=[list(x) for x in entry.get('st') or []])
+                   for code, entry in data['stocks'].items()}
+        today = {code: name for code, name in stocks if is_main_board(code)}
+
+        def extend(intervals, present):
+            is_open = bool(intervals) and intervals[-1][1] is None
+            if present and not is_open:
+                intervals.append([day, None])
+            elif not present and is_open:
+                intervals[-1][1] = prev if prev and prev >= intervals[-1][0] else intervals[-1][0]
+
+        for code in set(entries) | set(today):
+            entry = entries.setdefault(code, {'name': today.get(code, code), 'listed': [], 'st': []})
+            present = code in today
+            if present:
+                entry['name'] = today[code]
+            extend(entry['listed'], present)
+            extend(entry['st'], present and is_st_name(today.get(code, '')))
+        self._save({**data, 'as_of': day, 'stocks': entries})
+        return True
+
+
+def main():
+    from data_fetcher import DataFetcher
+
+    parser = argparse.ArgumentParser(description='历史时点股票池')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('build', help='从数据源回填上市区间和 ST 区间')
+    p.add_argument('--start', default='2015-01-01')
+    p.add_argument('--end', default=None)
+    p.add_argument('--no-st-history', action='store_true', help='不逐只请求历史 ST 标记，只按当前名称判断')
+    p = sub.add_parser('show', help='打印某日的股票池')
+    p.add_argument('date')
+    args = parser.parse_args()
+
+    fetcher = DataFetcher()
+    universe = fetcher.universe
+    if args.cmd == 'build':
+        universe.build(fetcher.source, args.start, args.end, st_history=not args.no_st_history)
+    else:
+        if not universe.available():
+            print('[ERROR] 股票池尚未建立，先运行 python universe.py build')
+            return
+        codes = universe.members(args.date)
+        print(f'{args.date}: {len(codes)} 只股票（股票池 {universe.info()}）')
+        print(' '.join(codes[:50]) + (' ...' if len(codes) > 50 else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+后台批量写入（write-behind）
+
+拉取线程、回测线程只把待写内容登记到队列（不序列化、不打开文件），由一个后台线程批量落盘：
+    替换写 put(path, render): 整个文件的新内容，后台调用 render() 序列化后写 tmp + fsync + os.replace，
+        读取方要么看到旧文件、要么看到完整的新文件；同一路径尚未落盘的旧内容直接被新内容取代，
+        被取代的写入的 done 回调不丢弃，改在新内容落盘（或失败）后依次调用
+    追加写 append(path, lines, reset): 同一文件的多行在一批中只打开一次；reset=True 时先清空文件（丢弃尚未落盘的行）
+同一路径的操作按登记顺序执行。待写操作数达到 max_pending 或最早一条已等待 interval 秒时落盘一批；
+flush() 等待此前登记的全部写入完成（发布缓存版本、生成快照、重写结果文件之前调用）；
+进程退出时（atexit）自动 drain，未落盘的数据不会丢失；关闭之后登记的写入直接同步执行。
+写入失败（序列化或 IO 出错）不重试：计入 stats()['errors']，并以错误调用 done(path, error)，
+由登记方撤销落盘前的替代读取（如 DataFetcher 中尚未落盘的缓存），之后按磁盘上的旧文件重新补齐。
+
+队列超过 max_backlog 条时登记方等待后台追上，避免写入远慢于拉取时无限占用内存。
+"""
+from collections import OrderedDict
+from threading import Condition, Thread
+import atexit
+import os
+import time
+
+
+def _chain(callbacks):
+    """依次调用多个 done(path, error) 回调，其中一个出错不影响其余"""
+    def done(path, error):
+        for callback in callbacks:
+            try:
+                callback(path, error)
+            except Exception as e:
+                print(f"[WARNING] 写入 {path} 的回调失败: {e}")
+    return done
+
+
+class WriteBehind:
+    """后台批量写入器（见模块说明）"""
+
+    def __init__(self, max_pending=256, interval=0.5, max_backlog=5000, fsync=True):
+        self.max_pending = max_pending
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self.fsync = fsync
+        self._ops = OrderedDict()  # path -> [('replace', render, done) | ('append', [lines], reset, done)]
+        self._count = 0  # 待写操作数
+        self._oldest = None  # 最早一条待写操作的登记时间
+        self._queued = 0  # 已登记的操作序号
+        self._written = 0  # 已落盘的操作序号
+        self._flush_requested = False
+        self._closed = False
+        self._cond = Condition()
+        self._thread = None
+        self._stats = {'batches': 0, 'files': 0, 'appends': 0, 'coalesced': 0, 'errors': 0}
+        atexit.register(self.close)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def _enqueue(self, path, op):
+        """登记一个操作；写入器已关闭时返回 False，由调用方同步写入"""
+        with self._cond:
+            if self._closed:
+                return False
+            self._start()
+            while self._count >= self.max_backlog:
+                self._flush_requested = True
+                self._cond.notify_all()
+                self._cond.wait()
+            ops = self._ops.setdefault(path, [])
+            if op[0] == 'replace' or (op[0] == 'append' and op[2]):
+                # 新的完整内容取代尚未落盘的旧操作；旧操作的 done 回调串到新操作上，落盘后照常调用
+                callbacks = [old[-1] for old in ops if old[-1] is not None]
+                if callbacks:
+                    op = op[:-1] + (_chain(callbacks + [op[-1]] if op[-1] is not None else callbacks),)
+                self._stats['coalesced'] += len(ops)
+                self._count -= len(ops)
+                ops.clear()
+            if op[0] == 'append' and ops and ops[-1][0] == 'append':
+                ops[-1][1].extend(op[1])
+            else:
+                ops.append(op)
+                self._count += 1
+            self._queued += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            if self._count >= self.max_pending:
+                self._cond.notify_all()
+        return True
+
+    def put(self, path, render, done=None):
+        """登记整文件写入：render() 在后台线程中调用，返回文件内容（str）；
+        done(path, error) 在替换完成（error 为 None）或失败后调用"""
+        op = ('replace', render, done)
+        if not self._enqueue(path, op):
+            self._record(self._execute(path, op))
+
+    def append(self, path, lines, reset=False):
+        """登记追加写入若干行（不含换行符）；reset=True 时先清空文件"""
+        op = ('append', list(lines), reset, None)
+        if not self._enqueue(path, op):
+            self._record(self._execute(path, op))
+
+    def flush(self, timeout=None):
+        """立即落盘并等待此前登记的全部写入完成，返回是否在 timeout 内完成"""
+        with self._cond:
+            target = self._queued
+            if self._written >= target:
+                return True
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._written >= target, timeout)
+
+    def close(self):
+        """drain 队列并停止后台线程（进程退出时自动调用）"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def pending(self):
+        with self._cond:
+            return self._count
+
+    def stats(self):
+        """累计的批次、文件、追加行、被取代的操作、失败数，以及当前待写数"""
+        with self._cond:
+            return dict(self._stats, pending=self._count)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._count and (self._closed or self._flush_requested or self._count >= self.max_pending
+                                        or time.time() - self._oldest >= self.interval):
+                        break
+                    if self._closed:
+                        return
+                    wait = self.interval - (time.time() - self._oldest) if self._count else None
+                    self._cond.wait(wait)
+                ops, self._ops = self._ops, OrderedDict()
+                target = self._queued
+                self._count, self._oldest, self._flush_requested = 0, None, False
+            counts = {'batches': 1, 'files': 0, 'appends': 0, 'errors': 0}
+            for path, path_ops in ops.items():
+                for op in path_ops:
+                    for key, n in self._execute(path, op).items():
+                        counts[key] += n
+            with self._cond:
+                self._record(counts)
+                self._written = target
+                self._cond.notify_all()
+
+    def _record(self, counts):
+        with self._cond:  # Condition 默认基于 RLock，可在已持有时调用
+            for key, n in counts.items():
+                self._stats[key] += n
+
+    def _execute(self, path, op):
+        """执行一个操作，返回计数 {'files'|'appends'|'errors': n}；done 回调在成功或失败后都会调用"""
+        error = None
+        try:
+            if op[0] == 'replace':
+                self._replace(path, op[1])
+                counts = {'files': 1}
+            else:
+                self._append(path, op[1], op[2])
+                counts = {'appends': len(op[1])}
+        except Exception as e:
+            error = e
+            counts = {'errors': 1}
+            print(f"[WARNING] 后台写入 {path} 失败: {e}")
+        if op[-1] is not None:
+            try:
+                op[-1](path, error)
+            except Exception as e:
+                print(f"[WARNING] 写入 {path} 的回调失败: {e}")
+        return counts
+
+    def _replace(self, path, render):
+        content = render()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _append(self, path, lines, reset):
+        with open(path, 'w' if reset else 'a', encoding='utf-8') as f:
+            if lines:
+                f.write('\n'.join(lines) + '\n')
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())